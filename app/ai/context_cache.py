@@ -0,0 +1,148 @@
+import hashlib
+import json
+import logging
+import os
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _fingerprint(*parts: str) -> str:
+    return hashlib.sha1("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+@dataclass
+class ContextEntry:
+    model: str
+    system_hash: str
+    # Отпечаток последней пары реплик, после которой был получен context
+    tail_hash: str
+    context: array
+
+
+class OllamaContextCache:
+    """LRU-кэш KV-контекстов Ollama по чатам.
+
+    Ollama возвращает вектор ``context`` после генерации; передав его обратно,
+    можно не пересчитывать системный промпт и всю историю заново. Контекст
+    переиспользуется только если последние две реплики истории совпадают с теми,
+    на которых он был получен, иначе запись сбрасывается и строится полный промпт.
+    """
+    
+    def __init__(self, capacity: int = 1000, max_tokens: int = 3072):
+        self.capacity = capacity
+        self.max_tokens = max_tokens
+        self._entries: "OrderedDict[int, ContextEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def lookup(
+        self,
+        chat_id: int,
+        model: str,
+        system_prompt: str,
+        conversation_history: List[dict]
+    ) -> Optional[List[int]]:
+        """Контекст для продолжения разговора или None, если нужен полный промпт"""
+        entry = self._entries.get(chat_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        tail = conversation_history[-2:]
+        continuous = (
+            entry.model == model
+            and entry.system_hash == _fingerprint(system_prompt)
+            and len(tail) == 2
+            and tail[0]["is_user_message"]
+            and not tail[1]["is_user_message"]
+            and entry.tail_hash == _fingerprint(tail[0]["content"], tail[1]["content"])
+        )
+        if not continuous:
+            # История была изменена или сменилась модель/персонаж
+            del self._entries[chat_id]
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(chat_id)
+        self.hits += 1
+        return entry.context.tolist()
+    
+    def store(
+        self,
+        chat_id: int,
+        model: str,
+        system_prompt: str,
+        user_message: str,
+        response: str,
+        context: List[int]
+    ):
+        """Сохранение контекста после ответа модели"""
+        if not context or len(context) > self.max_tokens:
+            # Слишком длинный контекст: следующий ход начнется с полного промпта
+            self._entries.pop(chat_id, None)
+            return
+        
+        self._entries[chat_id] = ContextEntry(
+            model=model,
+            system_hash=_fingerprint(system_prompt),
+            tail_hash=_fingerprint(user_message, response),
+            context=array("l", context)
+        )
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+    
+    def invalidate(self, chat_id: int):
+        self._entries.pop(chat_id, None)
+    
+    def save(self, path: str):
+        """Сохранение кэша на диск"""
+        data: Dict[str, dict] = {
+            str(chat_id): {
+                "model": entry.model,
+                "system_hash": entry.system_hash,
+                "tail_hash": entry.tail_hash,
+                "context": entry.context.tolist()
+            }
+            for chat_id, entry in self._entries.items()
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    
+    def load(self, path: str):
+        """Загрузка кэша с диска (порядок LRU сохраняется)"""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Ошибка загрузки кэша контекстов Ollama: {e}")
+            return
+        
+        for chat_id, item in data.items():
+            self._entries[int(chat_id)] = ContextEntry(
+                model=item["model"],
+                system_hash=item["system_hash"],
+                tail_hash=item["tail_hash"],
+                context=array("l", item["context"])
+            )
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+
+context_cache = OllamaContextCache(
+    capacity=settings.ollama_context_cache_size,
+    max_tokens=settings.ollama_context_max_tokens
+)
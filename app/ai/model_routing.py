@@ -0,0 +1,98 @@
+import logging
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from app.ai.scheduler import GenerationScheduler, generation_scheduler
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Уровни нагрузки: обычный, укороченные ответы, легкая модель
+NORMAL, SHORTEN, LIGHT_MODEL = 0, 1, 2
+
+
+@dataclass
+class ModelChoice:
+    """Модель Ollama и длина ответа для одного хода"""
+    model: str
+    max_tokens: int
+    level: int = NORMAL
+
+
+class ModelRouter:
+    """Выбор модели Ollama и длины ответа по нагрузке, тарифу и персонажу.
+
+    Нагрузка - ожидающие на слот генерации и средняя длительность генерации
+    из планировщика. При превышении порогов бесплатный тариф получает
+    укороченные ответы, при двукратном превышении - еще и легкую модель.
+    Премиум всегда получает модель персонажа и полную длину ответа.
+    """
+    
+    def __init__(
+        self,
+        default_model: str,
+        max_tokens: int = 250,
+        degraded_max_tokens: int = 120,
+        light_model: str = "",
+        character_models: Optional[Dict[str, str]] = None,
+        queue_threshold: float = 1.0,
+        latency_threshold: float = 30.0,
+        scheduler: Optional[GenerationScheduler] = None
+    ):
+        self.default_model = default_model
+        self.max_tokens = max_tokens
+        self.degraded_max_tokens = degraded_max_tokens
+        self.light_model = light_model
+        self.character_models = character_models or {}
+        self.queue_threshold = queue_threshold
+        self.latency_threshold = latency_threshold
+        self.scheduler = scheduler or generation_scheduler
+        self.decisions: Counter = Counter()
+    
+    def character_model(self, character_name: Optional[str]) -> str:
+        return self.character_models.get(character_name, self.default_model)
+    
+    def pressure(self, model: str) -> int:
+        """Уровень нагрузки на модель"""
+        queue_ratio, avg_duration = self.scheduler.load(model)
+        overload = max(
+            queue_ratio / self.queue_threshold if self.queue_threshold > 0 else 0.0,
+            avg_duration / self.latency_threshold if self.latency_threshold > 0 else 0.0
+        )
+        if overload >= 2:
+            return LIGHT_MODEL
+        if overload >= 1:
+            return SHORTEN
+        return NORMAL
+    
+    def choose(self, premium: bool = False, character_name: Optional[str] = None) -> ModelChoice:
+        model = self.character_model(character_name)
+        level = NORMAL if premium else self.pressure(model)
+        choice = ModelChoice(model, self.max_tokens, level)
+        if level >= SHORTEN:
+            choice.max_tokens = self.degraded_max_tokens
+        if level >= LIGHT_MODEL and self.light_model:
+            choice.model = self.light_model
+        
+        self.decisions["premium" if premium else f"free:{level}"] += 1
+        if level != NORMAL:
+            logger.debug(f"Degraded turn for {character_name}: {choice.model}, num_predict={choice.max_tokens}")
+        return choice
+    
+    def status(self) -> Dict[str, object]:
+        return {
+            "levels": {model: self.pressure(model) for model in {self.default_model, *self.character_models.values()}},
+            "decisions": dict(self.decisions),
+        }
+
+
+model_router = ModelRouter(
+    settings.ollama_default_model,
+    max_tokens=settings.ollama_max_tokens,
+    degraded_max_tokens=settings.ollama_degraded_max_tokens,
+    light_model=settings.ollama_light_model,
+    character_models=settings.ollama_character_models,
+    queue_threshold=settings.ollama_degrade_queue_ratio,
+    latency_threshold=settings.ollama_degrade_latency
+)
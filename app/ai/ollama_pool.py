@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable, List, Optional, Set
+
+import httpx
+
+from app.ai.providers import OllamaProvider, get_http_client
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых запрос можно повторить на другом сервере
+BACKEND_UNREACHABLE = (httpx.ConnectError, httpx.ConnectTimeout, ConnectionError)
+
+
+class OllamaBackend:
+    """Один сервер Ollama и то, что о нем известно по последней проверке"""
+    
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self.provider = OllamaProvider(base_url=self.base_url)
+        self.healthy = True
+        # None: список моделей еще не получен, считаем, что есть любая
+        self.models_available: Optional[Set[str]] = None
+        self.models_loaded: Set[str] = set()
+        self.outstanding = 0
+        self.last_probe: Optional[float] = None
+        self.last_error: Optional[str] = None
+    
+    def has_model(self, model: str) -> bool:
+        return self.models_available is None or model in self.models_available
+    
+    def is_loaded(self, model: str) -> bool:
+        return model in self.models_loaded
+    
+    def status(self) -> Dict[str, object]:
+        return {
+            "base_url": self.base_url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "models_loaded": sorted(self.models_loaded),
+            "models_available": sorted(self.models_available) if self.models_available is not None else None,
+            "last_error": self.last_error,
+        }
+
+
+def _model_names(payload: dict) -> Set[str]:
+    names = set()
+    for item in payload.get("models", []):
+        name = item.get("name") or item.get("model")
+        if name:
+            names.add(name)
+            # Ollama отдает "llama2:latest", а в настройках обычно просто "llama2"
+            if name.endswith(":latest"):
+                names.add(name[:-len(":latest")])
+    return names
+
+
+class OllamaPool:
+    """Пул серверов Ollama с проверками здоровья и выбором наименее загруженного.
+
+    Раз в ``probe_interval`` для каждого сервера запрашиваются ``/api/tags``
+    (какие модели есть) и ``/api/ps`` (какие загружены в память). Запрос
+    уходит на здоровый сервер с наименьшим числом незавершенных запросов;
+    сервер без загруженной модели считается занятым еще на ``cold_penalty``
+    запросов, поэтому модель загружается на новый сервер, только когда на
+    прежних уже собралась очередь. Оставшуюся ничью решает хэш чата, чтобы
+    чат возвращался на тот же сервер.
+    """
+    
+    def __init__(
+        self,
+        base_urls: List[str],
+        probe_interval: float = 10.0,
+        probe_timeout: float = 3.0,
+        cold_penalty: int = 4
+    ):
+        self.backends = [OllamaBackend(url) for url in base_urls]
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.cold_penalty = cold_penalty
+        self._task: Optional[asyncio.Task] = None
+    
+    async def probe(self, backend: OllamaBackend):
+        client = get_http_client()
+        try:
+            tags = await client.get(f"{backend.base_url}/api/tags", timeout=self.probe_timeout)
+            tags.raise_for_status()
+            ps = await client.get(f"{backend.base_url}/api/ps", timeout=self.probe_timeout)
+            ps.raise_for_status()
+        except (httpx.HTTPError, ValueError) as e:
+            if backend.healthy:
+                logger.warning(f"Ollama backend {backend.base_url} is unhealthy: {e}")
+            backend.healthy = False
+            backend.last_error = str(e) or type(e).__name__
+        else:
+            if not backend.healthy:
+                logger.info(f"Ollama backend {backend.base_url} is healthy again")
+            backend.healthy = True
+            backend.last_error = None
+            backend.models_available = _model_names(tags.json())
+            backend.models_loaded = _model_names(ps.json())
+        backend.last_probe = time.monotonic()
+    
+    async def probe_all(self):
+        await asyncio.gather(*(self.probe(backend) for backend in self.backends))
+    
+    async def _probe_loop(self):
+        while True:
+            await self.probe_all()
+            await asyncio.sleep(self.probe_interval)
+    
+    def start(self):
+        # Один сервер проверять незачем: выбирать все равно не из чего
+        if self._task is None and len(self.backends) > 1:
+            self._task = asyncio.create_task(self._probe_loop())
+    
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+    
+    @staticmethod
+    def _affinity(backend: OllamaBackend, key: Hashable) -> str:
+        return hashlib.md5(f"{key}:{backend.base_url}".encode()).hexdigest()
+    
+    def select(self, model: str, key: Hashable = None) -> OllamaBackend:
+        """Сервер для запроса к модели ``model``"""
+        if len(self.backends) == 1:
+            return self.backends[0]
+        
+        candidates = [backend for backend in self.backends if backend.healthy and backend.has_model(model)]
+        if not candidates:
+            # Проверки могли устареть: лучше попытаться, чем отказать сразу
+            candidates = [backend for backend in self.backends if backend.has_model(model)] or self.backends
+        
+        return min(candidates, key=lambda backend: (
+            backend.outstanding + (0 if backend.is_loaded(model) else self.cold_penalty),
+            self._affinity(backend, key)
+        ))
+    
+    @asynccontextmanager
+    async def acquire(self, model: str, key: Hashable = None):
+        """Сервер на время запроса: учитывается в нагрузке, пока запрос не завершен"""
+        backend = self.select(model, key)
+        backend.outstanding += 1
+        # Модель загрузится этим запросом: следующие чаты с ней пойдут сюда же
+        backend.models_loaded.add(model)
+        try:
+            yield backend
+        except BACKEND_UNREACHABLE as e:
+            backend.healthy = False
+            backend.last_error = str(e) or type(e).__name__
+            logger.warning(f"Ollama backend {backend.base_url} unreachable, excluded until next probe: {e}")
+            raise
+        finally:
+            backend.outstanding -= 1
+    
+    def status(self) -> List[Dict[str, object]]:
+        return [backend.status() for backend in self.backends]
+
+
+def configured_backends() -> List[str]:
+    urls = [url.strip() for url in settings.ollama_backends.split(",") if url.strip()]
+    return urls or [settings.ollama_base_url]
+
+
+ollama_pool = OllamaPool(
+    configured_backends(),
+    probe_interval=settings.ollama_probe_interval,
+    probe_timeout=settings.ollama_probe_timeout,
+    # Загрузка модели на свободный сервер окупается, когда на занятом заполнены все слоты
+    cold_penalty=settings.ollama_max_in_flight
+)
@@ -1,16 +1,41 @@
 import json
 import logging
-from typing import List, Optional, Dict, Any
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
 from ollama import Client
 
+from app.ai.context_cache import OllamaContextCache, context_cache as default_context_cache
+from app.ai.prompt_builder import prompt_builder
+from app.ai.prompt_templates import DEFAULT_CHARACTER_NAME, prompt_templates
+from app.ai.providers import GenerationRequest, LLMProvider, OllamaProvider
+
 logger = logging.getLogger(__name__)
 
+# Параметры генерации ответов персонажа; температура немного выше для креативности
+CHARACTER_TEMPERATURE = 0.85
+CHARACTER_OPTIONS = {
+    "top_p": 0.92,
+    "repeat_penalty": 1.15,
+    "top_k": 40
+}
+
+
+class EmptyResponseError(Exception):
+    """Модель вернула пустой ответ"""
+
 
 class OllamaService:
-    def __init__(self, base_url: str = "http://localhost:11434"):
+    def __init__(
+        self,
+        base_url: str = "http://localhost:11434",
+        provider: Optional[LLMProvider] = None,
+        context_cache: Optional[OllamaContextCache] = None
+    ):
         self.base_url = base_url
         self.default_model = "llama2"
+        # Синхронный клиент только для управления моделями, генерация идет через async провайдер
         self.client = Client(host=base_url)
+        self.provider = provider or OllamaProvider(base_url=base_url)
+        self.context_cache = context_cache if context_cache is not None else default_context_cache
     
     def list_models(self) -> List[Dict[str, Any]]:
         """Получение списка доступных моделей"""
@@ -44,49 +69,47 @@ class OllamaService:
             model = model_name or self.default_model
             
             # Формируем промпт
-            system_prompt = f"""Ты {character_description}
-
-Твоя личность: {character_personality}
-
-Ты должна отвечать от первого лица, как будто ты действительно этот персонаж. 
-Будь естественной, игривой и немного кокетливой. Отвечай на русском языке.
-Не используй формальный тон, будь дружелюбной и интимной.
-Максимальная длина ответа - 200 слов."""
-
-            # Формируем контекст разговора
+            system_prompt = prompt_templates.system_prompt(
+                DEFAULT_CHARACTER_NAME, character_personality, character_description
+            )
+            
+            # Формируем контекст разговора в пределах токенного бюджета
+            history = prompt_builder.pack_history(
+                conversation_history, model, system_prompt, user_message, max_tokens=300
+            )
             conversation_text = ""
-            for msg in conversation_history[-10:]:  # Последние 10 сообщений
+            for msg in history:
                 speaker = "Пользователь" if msg["is_user_message"] else "Ты"
                 conversation_text += f"{speaker}: {msg['content']}\n"
             
             conversation_text += f"Пользователь: {user_message}\nТы:"
             
             # Запрос к Ollama
-            response = self.client.generate(
+            response_text = await self.provider.generate(GenerationRequest(
                 model=model,
+                system_prompt=system_prompt,
                 prompt=conversation_text,
-                system=system_prompt,
+                max_tokens=300,
+                temperature=0.8,
                 options={
-                    "temperature": 0.8,
                     "top_p": 0.9,
-                    "num_predict": 300,
                     "repeat_penalty": 1.1
                 }
-            )
+            ))
             
-            if response and hasattr(response, 'response'):
-                return response.response.strip()
+            if response_text:
+                return response_text
             else:
-                logger.error(f"Неожиданный ответ от Ollama: {response}")
+                logger.error("Пустой ответ от Ollama")
                 return "Извините, произошла ошибка. Попробуйте еще раз."
                 
         except Exception as e:
             logger.error(f"Ошибка генерации ответа: {e}")
             return "Извините, произошла ошибка. Попробуйте еще раз."
     
-    def count_tokens(self, text: str) -> int:
-        """Простая оценка количества токенов"""
-        return len(text.split())
+    def count_tokens(self, text: str, model_name: str = None) -> int:
+        """Количество токенов в тексте для модели"""
+        return prompt_builder.count_tokens(text, model_name or self.default_model)
     
     def get_model_info(self, model_name: str) -> Optional[Dict[str, Any]]:
         """Получение информации о модели"""
@@ -117,74 +140,245 @@ class OllamaService:
             "wizard-vicuna-uncensored"
         ]
     
-    async def generate_character_response(
+    def _character_system_prompt(
+        self,
+        character_name: str,
+        character_personality: str,
+        character_description: str,
+        summary: Optional[str] = None
+    ) -> str:
+        return prompt_templates.system_prompt(character_name, character_personality, character_description, summary)
+    
+    def _build_character_request(
         self,
         character_name: str,
         character_personality: str,
         character_description: str,
         conversation_history: List[dict],
         user_message: str,
-        model_name: str = None
-    ) -> str:
-        """Специализированная генерация ответа для персонажа"""
+        model_name: str = None,
+        chat_id: Optional[int] = None,
+        summary: Optional[str] = None,
+        memories: Optional[List[str]] = None,
+        max_tokens: int = 250
+    ) -> GenerationRequest:
+        """Формирование промпта персонажа, общее для обычной и потоковой генерации"""
+        model = model_name or self.default_model
+        system_prompt = self._character_system_prompt(
+            character_name, character_personality, character_description, summary
+        )
         
-        # Адаптируем промпт под эротический контент
-        system_prompt = f"""Ты {character_name} - {character_description}
-
-Твоя личность: {character_personality}
-
-ВАЖНЫЕ ПРАВИЛА:
-1. Отвечай от первого лица, как будто ты действительно этот персонаж
-2. Будь естественной, игривой и кокетливой
-3. Отвечай на русском языке
-4. Не используй формальный тон, будь дружелюбной и интимной
-5. Можешь быть немного игривой и флиртовать
-6. Максимальная длина ответа - 200 слов
-7. Сохраняй консистентность характера
-8. Реагируй на эмоции пользователя
-9. Задавай вопросы и проявляй интерес к собеседнику
-10. Используй эмодзи для выражения эмоций"""
-
-        try:
-            model = model_name or self.default_model
-            
+        context = None
+        if chat_id is not None:
+            context = self.context_cache.lookup(chat_id, model, system_prompt, conversation_history)
+        
+        memory_note = prompt_builder.format_memories(memories)
+        if context is not None:
+            # Системный промпт и история уже в KV-контексте модели, передаем только новую реплику
+            conversation_text = f"\n{memory_note}Пользователь: {user_message}\n{character_name}:"
+            system_prompt = None
+        else:
             # Формируем контекст разговора
+            history = prompt_builder.pack_history(
+                conversation_history,
+                model,
+                system_prompt,
+                memory_note + user_message,
+                max_tokens=max_tokens,
+                system_tokens=prompt_templates.count_tokens(
+                    model, character_name, character_personality, character_description, summary
+                )
+            )
             conversation_text = ""
-            for msg in conversation_history[-8:]:  # Последние 8 сообщений для лучшего контекста
+            for msg in history:
                 speaker = "Пользователь" if msg["is_user_message"] else f"{character_name}"
                 conversation_text += f"{speaker}: {msg['content']}\n"
             
-            conversation_text += f"Пользователь: {user_message}\n{character_name}:"
-            
-            # Запрос к Ollama с оптимизированными параметрами
-            response = self.client.generate(
-                model=model,
-                prompt=conversation_text,
-                system=system_prompt,
-                options={
-                    "temperature": 0.85,  # Немного выше для креативности
-                    "top_p": 0.92,
-                    "num_predict": 250,
-                    "repeat_penalty": 1.15,
-                    "top_k": 40
-                }
+            conversation_text += f"{memory_note}Пользователь: {user_message}\n{character_name}:"
+        
+        # Оптимизированные параметры генерации
+        return GenerationRequest(
+            model=model,
+            system_prompt=system_prompt,
+            prompt=conversation_text,
+            max_tokens=max_tokens,
+            temperature=CHARACTER_TEMPERATURE,
+            options=dict(CHARACTER_OPTIONS),
+            context=context,
+            queue_key=chat_id
+        )
+    
+    def _remember_context(
+        self,
+        chat_id: int,
+        request: GenerationRequest,
+        character_name: str,
+        character_personality: str,
+        character_description: str,
+        user_message: str,
+        response_text: str,
+        context: Optional[List[int]],
+        summary: Optional[str] = None
+    ):
+        """Сохранение KV-контекста хода для следующего сообщения в чате"""
+        if not context:
+            self.context_cache.invalidate(chat_id)
+            return
+        self.context_cache.store(
+            chat_id,
+            request.model,
+            self._character_system_prompt(character_name, character_personality, character_description, summary),
+            user_message,
+            response_text,
+            context
+        )
+    
+    async def generate_character_response(
+        self,
+        character_name: str,
+        character_personality: str,
+        character_description: str,
+        conversation_history: List[dict],
+        user_message: str,
+        model_name: str = None,
+        chat_id: Optional[int] = None,
+        summary: Optional[str] = None,
+        memories: Optional[List[str]] = None,
+        max_tokens: int = 250
+    ) -> str:
+        """Специализированная генерация ответа для персонажа"""
+        try:
+            return await self.generate_character_reply(
+                character_name,
+                character_personality,
+                character_description,
+                conversation_history,
+                user_message,
+                model_name,
+                chat_id,
+                summary,
+                memories,
+                max_tokens
             )
-            
-            if response and hasattr(response, 'response'):
-                response_text = response.response.strip()
-                
-                # Постобработка ответа
-                response_text = self._post_process_response(response_text, character_name)
-                
-                return response_text
-            else:
-                logger.error(f"Неожиданный ответ от Ollama: {response}")
-                return f"Извини, {character_name} сейчас немного занята. Попробуй написать позже! 😊"
-                
+        except EmptyResponseError:
+            return f"Извини, {character_name} сейчас немного занята. Попробуй написать позже! 😊"
         except Exception as e:
             logger.error(f"Ошибка генерации ответа персонажа: {e}")
             return f"Ой, {character_name} не может ответить прямо сейчас. Попробуй еще раз! 💕"
     
+    async def generate_character_reply(
+        self,
+        character_name: str,
+        character_personality: str,
+        character_description: str,
+        conversation_history: List[dict],
+        user_message: str,
+        model_name: str = None,
+        chat_id: Optional[int] = None,
+        summary: Optional[str] = None,
+        memories: Optional[List[str]] = None,
+        max_tokens: int = 250
+    ) -> str:
+        """Ответ персонажа без подмены ошибок: их обрабатывает вызывающий код (цепочка провайдеров)"""
+        captured: Dict[str, List[int]] = {}
+        try:
+            request = self._build_character_request(
+                character_name,
+                character_personality,
+                character_description,
+                conversation_history,
+                user_message,
+                model_name,
+                chat_id,
+                summary,
+                memories,
+                max_tokens
+            )
+            if chat_id is not None:
+                request.on_context = lambda context: captured.update(context=context)
+            response_text = await self.provider.generate(request)
+        except Exception:
+            if chat_id is not None:
+                self.context_cache.invalidate(chat_id)
+            raise
+        
+        if not response_text:
+            logger.error("Пустой ответ от Ollama")
+            raise EmptyResponseError("Empty response from Ollama")
+        
+        # Постобработка ответа
+        response_text = self._post_process_response(response_text, character_name)
+        
+        if chat_id is not None:
+            self._remember_context(
+                chat_id,
+                request,
+                character_name,
+                character_personality,
+                character_description,
+                user_message,
+                response_text,
+                captured.get("context"),
+                summary
+            )
+        return response_text
+    
+    async def stream_character_response(
+        self,
+        character_name: str,
+        character_personality: str,
+        character_description: str,
+        conversation_history: List[dict],
+        user_message: str,
+        model_name: str = None,
+        chat_id: Optional[int] = None,
+        summary: Optional[str] = None,
+        memories: Optional[List[str]] = None,
+        on_queue: Optional[Callable[[int, float], None]] = None,
+        max_tokens: int = 250
+    ) -> AsyncIterator[str]:
+        """Потоковая генерация ответа персонажа (без постобработки, ее делает вызывающий код)"""
+        captured: Dict[str, List[int]] = {}
+        request = self._build_character_request(
+            character_name,
+            character_personality,
+            character_description,
+            conversation_history,
+            user_message,
+            model_name,
+            chat_id,
+            summary,
+            memories,
+            max_tokens
+        )
+        if chat_id is not None:
+            request.on_context = lambda context: captured.update(context=context)
+        request.on_queue = on_queue
+        
+        chunks = []
+        try:
+            async for chunk in self.provider.stream(request):
+                chunks.append(chunk)
+                yield chunk
+        except Exception:
+            if chat_id is not None:
+                self.context_cache.invalidate(chat_id)
+            raise
+        
+        if chat_id is not None:
+            # Отпечаток считаем по тому же тексту, что будет сохранен в истории
+            self._remember_context(
+                chat_id,
+                request,
+                character_name,
+                character_personality,
+                character_description,
+                user_message,
+                self._post_process_response("".join(chunks), character_name),
+                captured.get("context"),
+                summary
+            )
+    
     def _post_process_response(self, response: str, character_name: str) -> str:
         """Постобработка ответа для улучшения качества"""
         
@@ -240,28 +434,26 @@ class OllamaService:
             logger.error(f"Ошибка чата с моделью: {e}")
             return "Извините, произошла ошибка. Попробуйте еще раз."
     
-    def stream_generate(
+    async def stream_generate(
         self,
         model_name: str,
         prompt: str,
         system_prompt: str = None
-    ):
+    ) -> AsyncIterator[str]:
         """Потоковая генерация ответа"""
         try:
-            for chunk in self.client.generate(
+            async for chunk in self.provider.stream(GenerationRequest(
                 model=model_name,
+                system_prompt=system_prompt,
                 prompt=prompt,
-                system=system_prompt,
-                stream=True,
+                max_tokens=300,
+                temperature=0.8,
                 options={
-                    "temperature": 0.8,
                     "top_p": 0.9,
-                    "num_predict": 300,
                     "repeat_penalty": 1.1
                 }
-            ):
-                if hasattr(chunk, 'response'):
-                    yield chunk.response
+            )):
+                yield chunk
                     
         except Exception as e:
             logger.error(f"Ошибка потоковой генерации: {e}")
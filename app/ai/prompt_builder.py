@@ -0,0 +1,132 @@
+import logging
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import tiktoken
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Служебные токены чат-шаблона на одно сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+FALLBACK_ENCODING = "cl100k_base"
+# Через сколько секунд снова пробовать загрузить кодировку после сбоя
+ENCODING_RETRY_INTERVAL = 60.0
+
+_encodings: Dict[str, tiktoken.Encoding] = {}
+_encoding_failed_at: Dict[str, float] = {}
+
+
+@lru_cache(maxsize=None)
+def _encoding_for_model(model: str) -> str:
+    try:
+        return tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        # Локальные модели (llama, mistral) считаем общей кодировкой: точнее, чем split()
+        return FALLBACK_ENCODING
+
+
+def _encoding_name(model: str) -> str:
+    """Имя загруженной BPE-кодировки для модели; пустая строка, если токенизатор недоступен.
+
+    Файлы кодировок берутся из ``TIKTOKEN_CACHE_DIR`` (образ скачивает их при
+    сборке). Сбой загрузки не запоминается навсегда: через
+    ``ENCODING_RETRY_INTERVAL`` секунд загрузка повторяется.
+    """
+    name = _encoding_for_model(model)
+    if name in _encodings:
+        return name
+    failed_at = _encoding_failed_at.get(name)
+    if failed_at is not None and time.monotonic() - failed_at < ENCODING_RETRY_INTERVAL:
+        return ""
+    try:
+        _encodings[name] = tiktoken.get_encoding(name)
+    except Exception as e:
+        _encoding_failed_at[name] = time.monotonic()
+        logger.error(f"Токенизатор {name} недоступен (нет в TIKTOKEN_CACHE_DIR и нет сети), используется оценка по длине: {e}")
+        return ""
+    _encoding_failed_at.pop(name, None)
+    return name
+
+
+@lru_cache(maxsize=50000)
+def _count_encoded(encoding_name: str, text: str) -> int:
+    # Кэш по тексту: история чата пересчитывается на каждом ходе, а сообщения в ней не меняются
+    if not encoding_name:
+        return max(1, len(text) // 3) if text else 0
+    return len(_encodings[encoding_name].encode(text, disallowed_special=()))
+
+
+class PromptBuilder:
+    """Сборка истории диалога в пределах токенного бюджета модели"""
+    
+    def load_tokenizer(self, model: Optional[str] = None) -> bool:
+        """Загрузка кодировки при старте, чтобы ее отсутствие было видно сразу, а не в счетах"""
+        return bool(_encoding_name(model or settings.ollama_default_model))
+    
+    def count_tokens(self, text: str, model: Optional[str] = None) -> int:
+        return _count_encoded(_encoding_name(model or settings.ollama_default_model), text)
+    
+    def context_window(self, model: str) -> int:
+        windows = settings.model_context_windows
+        if model in windows:
+            return windows[model]
+        # "llama2:13b" -> "llama2", "gpt-4-0613" -> "gpt-4"
+        for name in sorted(windows, key=len, reverse=True):
+            if model.startswith(name):
+                return windows[name]
+        return settings.default_context_window
+    
+    def history_budget(
+        self,
+        model: str,
+        system_prompt: Optional[str],
+        user_message: str,
+        max_tokens: int,
+        system_tokens: Optional[int] = None
+    ) -> int:
+        """Сколько токенов можно отдать под историю"""
+        if system_tokens is None:
+            system_tokens = self.count_tokens(system_prompt or "", model)
+        reserved = (
+            max_tokens
+            + system_tokens
+            + self.count_tokens(user_message, model)
+            + 2 * MESSAGE_OVERHEAD_TOKENS
+        )
+        return max(0, min(self.context_window(model) - reserved, settings.prompt_history_max_tokens))
+    
+    def pack_history(
+        self,
+        conversation_history: List[dict],
+        model: str,
+        system_prompt: Optional[str],
+        user_message: str,
+        max_tokens: int,
+        system_tokens: Optional[int] = None
+    ) -> List[dict]:
+        """Самые свежие сообщения, помещающиеся в бюджет, в хронологическом порядке"""
+        budget = self.history_budget(model, system_prompt, user_message, max_tokens, system_tokens)
+        
+        packed = []
+        for msg in reversed(conversation_history):
+            cost = self.count_tokens(msg["content"], model) + MESSAGE_OVERHEAD_TOKENS
+            if cost > budget:
+                break
+            budget -= cost
+            packed.append(msg)
+        
+        packed.reverse()
+        return packed
+    
+    def format_memories(self, memories: Optional[List[str]]) -> str:
+        """Блок с найденными старыми сообщениями для вставки перед репликой пользователя"""
+        if not memories:
+            return ""
+        lines = "\n".join(f"- {memory}" for memory in memories)
+        return f"(Ты вспоминаешь из прошлых сообщений:\n{lines})\n"
+
+
+prompt_builder = PromptBuilder()
@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+from app.ai.prompt_builder import prompt_builder
+
+# Единый системный промпт персонажа для всех провайдеров
+CHARACTER_SYSTEM_TEMPLATE = """Ты {name} - {description}
+
+Твоя личность: {personality}
+
+ВАЖНЫЕ ПРАВИЛА:
+1. Отвечай от первого лица, как будто ты действительно этот персонаж
+2. Будь естественной, игривой и кокетливой
+3. Отвечай на русском языке
+4. Не используй формальный тон, будь дружелюбной и интимной
+5. Можешь быть немного игривой и флиртовать
+6. Максимальная длина ответа - 200 слов
+7. Сохраняй консистентность характера
+8. Реагируй на эмоции пользователя
+9. Задавай вопросы и проявляй интерес к собеседнику
+10. Используй эмодзи для выражения эмоций"""
+
+# Сводка меняется от чата к чату, поэтому идет после неизменного префикса
+SUMMARY_TEMPLATE = "\n\nКраткое содержание вашего предыдущего разговора: {summary}"
+
+DEFAULT_CHARACTER_NAME = "AI Girl"
+
+
+@dataclass(frozen=True, slots=True)
+class CompiledPrompt:
+    """Отрендеренный системный промпт персонажа и его длина в токенах по моделям"""
+    text: str
+    token_counts: Dict[str, int] = field(default_factory=dict, compare=False)
+    
+    def tokens(self, model: str) -> int:
+        count = self.token_counts.get(model)
+        if count is None:
+            count = prompt_builder.count_tokens(self.text, model)
+            self.token_counts[model] = count
+        return count
+
+
+class PromptTemplateRegistry:
+    """Скомпилированные системные промпты персонажей, общие для всех провайдеров.
+
+    Промпт рендерится один раз на персонажа; при изменении персонажей реестр
+    сбрасывается через ``clear()``. Строка не меняется между запросами, что
+    дает стабильный префикс для кэширования промпта на стороне провайдера.
+    """
+    
+    def __init__(self, capacity: int = 1024):
+        self.capacity = capacity
+        self._compiled: "OrderedDict[Tuple[str, str, str], CompiledPrompt]" = OrderedDict()
+    
+    def __len__(self) -> int:
+        return len(self._compiled)
+    
+    def compile(self, name: str, personality: str, description: str) -> CompiledPrompt:
+        key = (name, personality, description)
+        compiled = self._compiled.get(key)
+        if compiled is not None:
+            self._compiled.move_to_end(key)
+            return compiled
+        
+        compiled = CompiledPrompt(CHARACTER_SYSTEM_TEMPLATE.format(
+            name=name, description=description, personality=personality
+        ))
+        self._compiled[key] = compiled
+        while len(self._compiled) > self.capacity:
+            self._compiled.popitem(last=False)
+        return compiled
+    
+    def system_prompt(
+        self,
+        name: str,
+        personality: str,
+        description: str,
+        summary: Optional[str] = None
+    ) -> str:
+        text = self.compile(name, personality, description).text
+        if summary:
+            text += SUMMARY_TEMPLATE.format(summary=summary)
+        return text
+    
+    def count_tokens(
+        self,
+        model: str,
+        name: str,
+        personality: str,
+        description: str,
+        summary: Optional[str] = None
+    ) -> int:
+        """Длина системного промпта в токенах; постоянная часть считается один раз"""
+        tokens = self.compile(name, personality, description).tokens(model)
+        if summary:
+            tokens += prompt_builder.count_tokens(SUMMARY_TEMPLATE.format(summary=summary), model)
+        return tokens
+    
+    def clear(self):
+        self._compiled.clear()
+
+
+prompt_templates = PromptTemplateRegistry()
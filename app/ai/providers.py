@@ -0,0 +1,234 @@
+import logging
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, List, Optional
+
+import httpx
+from anthropic import AsyncAnthropic
+from ollama import AsyncClient as OllamaAsyncClient
+from openai import AsyncOpenAI
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Общие пулы соединений на процесс: все экземпляры AIService используют их совместно
+_http_client: Optional[httpx.AsyncClient] = None
+_ollama_clients: Dict[str, OllamaAsyncClient] = {}
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.llm_max_connections,
+        max_keepalive_connections=settings.llm_max_keepalive_connections
+    )
+
+
+def _http_timeout() -> httpx.Timeout:
+    return httpx.Timeout(settings.llm_request_timeout, connect=10.0)
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Общий пул HTTP-соединений для OpenAI и Anthropic"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(limits=_http_limits(), timeout=_http_timeout())
+    return _http_client
+
+
+def get_ollama_client(host: str) -> OllamaAsyncClient:
+    """Асинхронный клиент Ollama с пулом соединений, один на хост"""
+    client = _ollama_clients.get(host)
+    if client is None:
+        client = OllamaAsyncClient(host=host, limits=_http_limits(), timeout=_http_timeout())
+        _ollama_clients[host] = client
+    return client
+
+
+async def close_http_clients():
+    """Закрытие пулов соединений при остановке приложения"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    for client in _ollama_clients.values():
+        await client._client.aclose()
+    _ollama_clients.clear()
+
+
+@dataclass
+class GenerationRequest:
+    """Параметры одного запроса генерации, независимые от провайдера"""
+    model: str
+    system_prompt: str
+    messages: List[Dict[str, str]] = field(default_factory=list)
+    # Готовый текстовый промпт для completion-API (Ollama generate)
+    prompt: Optional[str] = None
+    max_tokens: int = 300
+    temperature: float = 0.8
+    options: Dict[str, Any] = field(default_factory=dict)
+    # KV-контекст предыдущего хода (поддерживает только Ollama generate)
+    context: Optional[List[int]] = None
+    # Вызывается с новым KV-контекстом после завершения генерации
+    on_context: Optional[Callable[[List[int]], None]] = None
+    # Ключ справедливой очереди планировщика (обычно id чата)
+    queue_key: Optional[Hashable] = None
+    # Вызывается с позицией в очереди и оценкой ожидания в секундах
+    on_queue: Optional[Callable[[int, float], None]] = None
+
+
+class LLMProvider(ABC):
+    """Базовый асинхронный провайдер LLM"""
+    name: str = "base"
+    
+    @abstractmethod
+    async def generate(self, request: GenerationRequest) -> str:
+        """Генерация полного ответа"""
+    
+    async def stream(self, request: GenerationRequest) -> AsyncIterator[str]:
+        """Потоковая генерация; по умолчанию отдает весь ответ одним куском"""
+        yield await self.generate(request)
+
+
+class OpenAIProvider(LLMProvider):
+    name = "openai"
+    
+    def __init__(self, api_key: Optional[str] = None):
+        self._api_key = settings.openai_api_key if api_key is None else api_key
+        self._client: Optional[AsyncOpenAI] = None
+    
+    @property
+    def client(self) -> AsyncOpenAI:
+        if self._client is None:
+            self._client = AsyncOpenAI(api_key=self._api_key, http_client=get_http_client())
+        return self._client
+    
+    async def generate(self, request: GenerationRequest) -> str:
+        response = await self.client.chat.completions.create(
+            model=request.model,
+            messages=[{"role": "system", "content": request.system_prompt}, *request.messages],
+            max_tokens=request.max_tokens,
+            temperature=request.temperature,
+            **request.options
+        )
+        return response.choices[0].message.content.strip()
+    
+    async def stream(self, request: GenerationRequest) -> AsyncIterator[str]:
+        stream = await self.client.chat.completions.create(
+            model=request.model,
+            messages=[{"role": "system", "content": request.system_prompt}, *request.messages],
+            max_tokens=request.max_tokens,
+            temperature=request.temperature,
+            stream=True,
+            **request.options
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class AnthropicProvider(LLMProvider):
+    name = "anthropic"
+    
+    def __init__(self, api_key: Optional[str] = None):
+        self._api_key = settings.anthropic_api_key if api_key is None else api_key
+        self._client: Optional[AsyncAnthropic] = None
+    
+    @property
+    def client(self) -> AsyncAnthropic:
+        if self._client is None:
+            self._client = AsyncAnthropic(api_key=self._api_key, http_client=get_http_client())
+        return self._client
+    
+    async def generate(self, request: GenerationRequest) -> str:
+        response = await self.client.messages.create(
+            model=request.model,
+            max_tokens=request.max_tokens,
+            temperature=request.temperature,
+            system=request.system_prompt,
+            messages=request.messages,
+            **request.options
+        )
+        return response.content[0].text.strip()
+    
+    async def stream(self, request: GenerationRequest) -> AsyncIterator[str]:
+        async with self.client.messages.stream(
+            model=request.model,
+            max_tokens=request.max_tokens,
+            temperature=request.temperature,
+            system=request.system_prompt,
+            messages=request.messages,
+            **request.options
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+
+
+class OllamaProvider(LLMProvider):
+    name = "ollama"
+    
+    def __init__(self, base_url: str = "http://localhost:11434"):
+        self.base_url = base_url
+    
+    @property
+    def client(self) -> OllamaAsyncClient:
+        return get_ollama_client(self.base_url)
+    
+    def _options(self, request: GenerationRequest) -> Dict[str, Any]:
+        return {
+            "temperature": request.temperature,
+            "num_predict": request.max_tokens,
+            **request.options
+        }
+    
+    async def generate(self, request: GenerationRequest) -> str:
+        if request.prompt is not None:
+            response = await self.client.generate(
+                model=request.model,
+                prompt=request.prompt,
+                system=request.system_prompt,
+                context=request.context,
+                options=self._options(request)
+            )
+            if request.on_context and response.context:
+                request.on_context(response.context)
+            return response.response.strip()
+        
+        response = await self.client.chat(
+            model=request.model,
+            messages=[{"role": "system", "content": request.system_prompt}, *request.messages],
+            options=self._options(request)
+        )
+        return response.message.content.strip()
+    
+    async def stream(self, request: GenerationRequest) -> AsyncIterator[str]:
+        if request.prompt is not None:
+            stream = await self.client.generate(
+                model=request.model,
+                prompt=request.prompt,
+                system=request.system_prompt,
+                context=request.context,
+                options=self._options(request),
+                stream=True
+            )
+            async for chunk in stream:
+                if chunk.response:
+                    yield chunk.response
+                if chunk.done and request.on_context and chunk.context:
+                    request.on_context(chunk.context)
+            return
+        
+        stream = await self.client.chat(
+            model=request.model,
+            messages=[{"role": "system", "content": request.system_prompt}, *request.messages],
+            options=self._options(request),
+            stream=True
+        )
+        async for chunk in stream:
+            if chunk.message.content:
+                yield chunk.message.content
+    
+    async def embed(self, model: str, texts: List[str]) -> List[List[float]]:
+        """Эмбеддинги пачки текстов одним запросом"""
+        response = await self.client.embed(model=model, input=texts)
+        return response.embeddings
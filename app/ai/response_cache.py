@@ -0,0 +1,198 @@
+import hashlib
+import json
+import logging
+import random
+import re
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+_PUNCTUATION = re.compile(r"[^\w\s]", re.UNICODE)
+_SPACES = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    """Текст реплики без регистра, знаков препинания и эмодзи: «Привет!!» и «привет» совпадают"""
+    text = text.lower().replace("ё", "е")
+    return _SPACES.sub(" ", _PUNCTUATION.sub(" ", text)).strip()
+
+
+class ResponseCacheStore(ABC):
+    """Хранилище пулов вариантов ответа по ключу"""
+    
+    @abstractmethod
+    async def get(self, key: str) -> List[str]:
+        pass
+    
+    @abstractmethod
+    async def add(self, key: str, response: str, variants: int, ttl: float):
+        """Новый вариант в пул; в пуле остаются ``variants`` последних"""
+    
+    async def close(self):
+        pass
+
+
+class MemoryResponseCacheStore(ResponseCacheStore):
+    """LRU с TTL в памяти процесса"""
+    
+    def __init__(self, capacity: int = 5000):
+        self.capacity = capacity
+        self._entries: "OrderedDict[str, Tuple[float, List[str]]]" = OrderedDict()
+    
+    async def get(self, key: str) -> List[str]:
+        item = self._entries.get(key)
+        if item is None:
+            return []
+        expires_at, responses = item
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return []
+        self._entries.move_to_end(key)
+        return responses
+    
+    async def add(self, key: str, response: str, variants: int, ttl: float):
+        item = self._entries.get(key)
+        responses = item[1] if item is not None and item[0] > time.monotonic() else []
+        # Срок жизни считается от первого варианта: пул не живет вечно на популярном ключе
+        expires_at = item[0] if responses else time.monotonic() + ttl
+        self._entries[key] = (expires_at, ([response] + responses)[:variants])
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+
+class RedisResponseCacheStore(ResponseCacheStore):
+    """Пулы в Redis-списках, общие для процессов; вытеснение - политикой maxmemory (allkeys-lru)"""
+    
+    def __init__(self, url: str):
+        self.client = redis.from_url(url, decode_responses=True)
+    
+    async def get(self, key: str) -> List[str]:
+        return await self.client.lrange(f"response-cache:{key}", 0, -1)
+    
+    async def add(self, key: str, response: str, variants: int, ttl: float):
+        redis_key = f"response-cache:{key}"
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.lpush(redis_key, response)
+            pipe.ltrim(redis_key, 0, variants - 1)
+            pipe.expire(redis_key, int(ttl), nx=True)
+            await pipe.execute()
+    
+    async def close(self):
+        await self.client.aclose()
+
+
+class ResponseCache:
+    """Кэш ответов на первые реплики чата.
+
+    Новые чаты почти всегда начинаются с «привет» или «как дела» к тому же
+    персонажу, и каждый такой ход стоит полной генерации. Ключ - персонаж
+    (имя, характер и описание), провайдер, модель, параметры генерации и
+    нормализованный текст разговора; в кэш попадают только короткие разговоры
+    без сводки и воспоминаний. Под ключом копится пул из ``variants``
+    сгенерированных ответов, и пока он не полон, ход генерируется как обычно.
+    Из полного пула выдается случайный вариант, чтобы ответы не повторялись
+    слово в слово.
+    """
+    
+    def __init__(
+        self,
+        store: Optional[ResponseCacheStore] = None,
+        variants: int = 3,
+        ttl: float = 86400.0,
+        max_history: int = 2,
+        max_message_chars: int = 60
+    ):
+        if store is None:
+            store = (
+                RedisResponseCacheStore(settings.redis_url)
+                if settings.response_cache_backend == "redis"
+                else MemoryResponseCacheStore(settings.response_cache_size)
+            )
+        self.store = store
+        self.variants = variants
+        self.ttl = ttl
+        self.max_history = max_history
+        self.max_message_chars = max_message_chars
+        self.hits = 0
+        self.misses = 0
+    
+    def key(
+        self,
+        character_name: str,
+        persona: str,
+        provider: str,
+        model: str,
+        sampling: Dict[str, Any],
+        conversation_history: List[dict],
+        user_message: str,
+        summary: Optional[str] = None,
+        memories: Optional[List[str]] = None
+    ) -> Optional[str]:
+        """Ключ кэша или None, если разговор не подходит для кэширования"""
+        if summary or memories or len(conversation_history) > self.max_history:
+            return None
+        turns = [
+            ("u" if msg["is_user_message"] else "a", normalize(msg["content"]))
+            for msg in conversation_history
+        ]
+        turns.append(("u", normalize(user_message)))
+        if not turns[-1][1] or any(len(text) > self.max_message_chars for _, text in turns):
+            return None
+        
+        payload = json.dumps(
+            [character_name, persona, provider, model, sampling, turns],
+            ensure_ascii=False,
+            sort_keys=True
+        )
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+    
+    async def lookup(self, key: Optional[str]) -> Optional[str]:
+        """Случайный вариант из полного пула или None"""
+        if key is None:
+            return None
+        try:
+            responses = await self.store.get(key)
+        except RedisError as e:
+            logger.warning(f"Response cache unavailable: {e}")
+            return None
+        if len(responses) < self.variants:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return random.choice(responses)
+    
+    async def remember(self, key: Optional[str], response: str):
+        if key is None or not response.strip():
+            return
+        try:
+            await self.store.add(key, response, self.variants, self.ttl)
+        except RedisError as e:
+            logger.warning(f"Response cache unavailable: {e}")
+    
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+        }
+    
+    async def close(self):
+        await self.store.close()
+
+
+response_cache = ResponseCache(
+    variants=settings.response_cache_variants,
+    ttl=settings.response_cache_ttl,
+    max_history=settings.response_cache_max_history,
+    max_message_chars=settings.response_cache_max_message_chars
+)
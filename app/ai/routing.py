@@ -0,0 +1,351 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ProviderUnavailable(Exception):
+    """Ни один провайдер цепочки не ответил в пределах бюджета"""
+
+
+class ProviderBusy(Exception):
+    """Провайдер отклонил запрос из-за нагрузки (очередь приложения), а не из-за сбоя"""
+
+
+@dataclass
+class _Attempt:
+    """Отсчет задержки попытки; провайдер с очередью сдвигает его на момент получения слота"""
+    started: float = field(default_factory=time.monotonic)
+    queued: bool = False
+
+
+_attempt: contextvars.ContextVar[Optional[_Attempt]] = contextvars.ContextVar("provider_attempt", default=None)
+
+
+def attempt_queued():
+    """Попытка ждала слот в очереди приложения: ее таймаут - нагрузка, а не сбой провайдера"""
+    attempt = _attempt.get()
+    if attempt is not None:
+        attempt.queued = True
+
+
+def attempt_started():
+    """Слот получен: задержка провайдера считается с этого момента"""
+    attempt = _attempt.get()
+    if attempt is not None:
+        attempt.started = time.monotonic()
+
+
+class CircuitBreaker:
+    """Предохранитель провайдера.
+
+    Размыкается после ``failure_threshold`` ошибок подряд или когда p95
+    задержки превышает ``slow_ratio`` от таймаута провайдера. Через
+    ``cooldown`` секунд пропускает один пробный запрос: успех замыкает
+    предохранитель, ошибка размыкает снова.
+    """
+    
+    def __init__(
+        self,
+        name: str,
+        timeout: float,
+        failure_threshold: int = 5,
+        slow_ratio: float = 0.8,
+        cooldown: float = 30.0,
+        window: int = 20,
+        min_samples: int = 10
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.slow_ratio = slow_ratio
+        self.cooldown = cooldown
+        self.window = window
+        self.min_samples = min_samples
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        # Задержки отдельно по видам запросов: до первого токена и до полного ответа
+        self._latencies: Dict[str, Deque[float]] = {}
+    
+    def allow(self) -> bool:
+        """Можно ли отправить запрос; в полуоткрытом состоянии занимает единственную пробу"""
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+    
+    def p95(self, kind: str) -> Optional[float]:
+        samples = self._latencies.get(kind)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    
+    def _open(self, reason: str):
+        if self.state != "open":
+            logger.warning(f"Circuit for {self.name} opened: {reason}")
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self._probing = False
+        # Старые замеры не должны сразу разомкнуть его снова после восстановления
+        self._latencies.clear()
+    
+    def record_success(self, kind: str, latency: float):
+        if self.state == "half_open":
+            logger.info(f"Circuit for {self.name} closed")
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+        samples = self._latencies.setdefault(kind, deque(maxlen=self.window))
+        samples.append(latency)
+        p95 = self.p95(kind)
+        if p95 is not None and p95 > self.slow_ratio * self.timeout:
+            self._open(f"p95 {kind} latency {p95:.1f}s")
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self._open(f"{self.failures} consecutive failures")
+    
+    def record_cancel(self):
+        """Запрос отменен (проиграл хедж или кончился бюджет): исход неизвестен"""
+        self._probing = False
+    
+    def status(self) -> Dict[str, object]:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "timeout": self.timeout,
+            "p95": {kind: round(value, 2) for kind in self._latencies if (value := self.p95(kind)) is not None},
+        }
+
+
+class ProviderRouter:
+    """Цепочка провайдеров с таймаутами, общим бюджетом задержки и хеджированием.
+
+    Провайдеры пробуются по порядку цепочки, пропуская разомкнутые
+    предохранители. Ошибка или таймаут сразу передают запрос следующему.
+    Если ответа нет дольше ``hedge_delay`` (но не раньше p95 этого
+    провайдера), параллельно запускается следующий, и побеждает первый
+    ответивший. Для потоков ответом считается первый фрагмент: после него
+    провайдер уже не меняется.
+    """
+    
+    def __init__(
+        self,
+        timeouts: Dict[str, float],
+        latency_budget: float = 120.0,
+        hedge_delay: float = 0.0,
+        failure_threshold: int = 5,
+        slow_ratio: float = 0.8,
+        cooldown: float = 30.0,
+        default_timeout: float = 60.0
+    ):
+        self.timeouts = timeouts
+        self.latency_budget = latency_budget
+        self.hedge_delay = hedge_delay
+        self.failure_threshold = failure_threshold
+        self.slow_ratio = slow_ratio
+        self.cooldown = cooldown
+        self.default_timeout = default_timeout
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.hedges = 0
+        self.fallbacks = 0
+    
+    def breaker(self, name: str) -> CircuitBreaker:
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                name,
+                self.timeouts.get(name, self.default_timeout),
+                failure_threshold=self.failure_threshold,
+                slow_ratio=self.slow_ratio,
+                cooldown=self.cooldown
+            )
+            self.breakers[name] = breaker
+        return breaker
+    
+    def _hedge_after(self, name: str, kind: str) -> Optional[float]:
+        if self.hedge_delay <= 0:
+            return None
+        # Хедж раньше p95 провайдера удвоил бы заметную долю запросов
+        return max(self.hedge_delay, self.breaker(name).p95(kind) or 0.0)
+    
+    async def _race(
+        self,
+        chain: List[str],
+        kind: str,
+        start: Callable[[str], Awaitable[T]],
+        discard: Optional[Callable[[T], Awaitable[None]]] = None,
+        on_provider: Optional[Callable[[str], None]] = None
+    ) -> Tuple[str, T]:
+        deadline = time.monotonic() + self.latency_budget
+        candidates = iter(chain)
+        running: Dict[asyncio.Task, Tuple[str, _Attempt, bool]] = {}
+        errors: List[str] = []
+        hedge_at: Optional[float] = None
+        
+        def launch() -> bool:
+            nonlocal hedge_at
+            for name in candidates:
+                breaker = self.breaker(name)
+                if not breaker.allow():
+                    errors.append(f"{name}: circuit open")
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    breaker.record_cancel()
+                    break
+                attempt = _Attempt()
+                context = contextvars.copy_context()
+                context.run(_attempt.set, attempt)
+                task = asyncio.create_task(
+                    asyncio.wait_for(start(name), min(breaker.timeout, remaining)),
+                    context=context
+                )
+                # Таймаут, урезанный общим бюджетом, - не вина провайдера
+                running[task] = (name, attempt, remaining < breaker.timeout)
+                hedge_delay = self._hedge_after(name, kind)
+                hedge_at = attempt.started + hedge_delay if hedge_delay is not None else None
+                return True
+            hedge_at = None
+            return False
+        
+        try:
+            launch()
+            while running:
+                now = time.monotonic()
+                if now >= deadline:
+                    errors.append("latency budget exceeded")
+                    break
+                wake_at = min(deadline, hedge_at) if hedge_at is not None else deadline
+                done, _ = await asyncio.wait(running, timeout=max(0.0, wake_at - now), return_when=asyncio.FIRST_COMPLETED)
+                
+                failed = False
+                for task in done:
+                    name, attempt, clipped = running.pop(task)
+                    breaker = self.breaker(name)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        timed_out = isinstance(e, asyncio.TimeoutError)
+                        # Отказ очереди и таймаут после ожидания в ней - перегрузка, предохранитель ее не учитывает
+                        if isinstance(e, ProviderBusy) or (timed_out and (clipped or attempt.queued)):
+                            breaker.record_cancel()
+                        else:
+                            breaker.record_failure()
+                        errors.append(f"{name}: {type(e).__name__}: {e}")
+                        logger.warning(f"Provider {name} failed after {time.monotonic() - attempt.started:.1f}s: {type(e).__name__}: {e}")
+                        failed = True
+                        continue
+                    breaker.record_success(kind, time.monotonic() - attempt.started)
+                    if on_provider is not None:
+                        on_provider(name)
+                    return name, result
+                
+                if failed:
+                    if launch():
+                        self.fallbacks += 1
+                elif not done and hedge_at is not None and time.monotonic() >= hedge_at:
+                    if launch():
+                        self.hedges += 1
+            raise ProviderUnavailable("; ".join(errors) or "no providers configured")
+        finally:
+            tasks = list(running)
+            for task in tasks:
+                task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for task, result in zip(tasks, results):
+                name, attempt, _ = running[task]
+                if isinstance(result, BaseException):
+                    self.breaker(name).record_cancel()
+                    continue
+                # Ответ пришел одновременно с победителем: он больше не нужен
+                self.breaker(name).record_success(kind, time.monotonic() - attempt.started)
+                if discard is not None:
+                    await discard(result)
+    
+    async def generate(
+        self,
+        chain: List[str],
+        attempts: Dict[str, Callable[[], Awaitable[str]]],
+        on_provider: Optional[Callable[[str], None]] = None
+    ) -> str:
+        """Полный ответ первого успешного провайдера цепочки; ``on_provider`` получает его имя"""
+        chain = [name for name in chain if name in attempts]
+        _, response = await self._race(chain, "generate", lambda name: attempts[name](), on_provider=on_provider)
+        return response
+    
+    async def stream(
+        self,
+        chain: List[str],
+        attempts: Dict[str, Callable[[], AsyncIterator[str]]],
+        on_provider: Optional[Callable[[str], None]] = None
+    ) -> AsyncIterator[str]:
+        """Поток провайдера, первым выдавшего фрагмент ответа; ``on_provider`` получает его имя"""
+        chain = [name for name in chain if name in attempts]
+        
+        async def first_chunk(name: str) -> Tuple[str, AsyncIterator[str]]:
+            stream = attempts[name]()
+            try:
+                async for chunk in stream:
+                    if chunk:
+                        return chunk, stream
+                raise ValueError("empty response")
+            except BaseException:
+                await stream.aclose()
+                raise
+        
+        async def discard(result: Tuple[str, AsyncIterator[str]]):
+            await result[1].aclose()
+        
+        name, (chunk, stream) = await self._race(chain, "stream", first_chunk, discard, on_provider)
+        breaker = self.breaker(name)
+        try:
+            yield chunk
+            while True:
+                # Таймаут провайдера действует и на паузу между фрагментами
+                try:
+                    chunk = await asyncio.wait_for(anext(stream), breaker.timeout)
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        except Exception:
+            breaker.record_failure()
+            raise
+        finally:
+            await stream.aclose()
+    
+    def status(self) -> Dict[str, object]:
+        return {
+            "hedges": self.hedges,
+            "fallbacks": self.fallbacks,
+            "providers": {name: breaker.status() for name, breaker in self.breakers.items()},
+        }
+
+
+provider_router = ProviderRouter(
+    settings.llm_provider_timeouts,
+    latency_budget=settings.llm_latency_budget,
+    hedge_delay=settings.llm_hedge_delay,
+    failure_threshold=settings.llm_breaker_failures,
+    slow_ratio=settings.llm_breaker_slow_ratio,
+    cooldown=settings.llm_breaker_cooldown,
+    default_timeout=settings.llm_request_timeout
+)
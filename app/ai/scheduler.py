@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from app.ai.ollama_pool import BACKEND_UNREACHABLE, OllamaPool, ollama_pool
+from app.ai.providers import GenerationRequest, LLMProvider
+from app.ai.routing import ProviderBusy, attempt_queued, attempt_started
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+QueueCallback = Callable[[int, float], None]
+
+
+class GenerationQueueFull(ProviderBusy):
+    """Очередь генерации переполнена: запрос отклонен сразу, без ожидания"""
+
+
+class GenerationQueueTimeout(ProviderBusy):
+    """Запрос простоял в очереди дольше допустимого"""
+
+
+@dataclass(eq=False)
+class _Waiter:
+    future: asyncio.Future
+    on_queue: Optional[QueueCallback] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+    position: int = 0
+
+
+class _Lane:
+    """Слоты одной модели на одном бэкенде и очередь к ним.
+
+    Очередь справедливая: ожидающие разложены по ключам (чатам) и
+    обслуживаются по кругу, поэтому один активный чат не займет все слоты.
+    """
+    
+    def __init__(self, capacity: int, max_queue: int, initial_duration: float):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.queued = 0
+        self.avg_duration = initial_duration
+        self._queues: "OrderedDict[Hashable, Deque[_Waiter]]" = OrderedDict()
+    
+    def _order(self) -> List[_Waiter]:
+        """Ожидающие в порядке будущей выдачи слотов (по кругу между ключами)"""
+        queues = list(self._queues.values())
+        order = []
+        for depth in range(max((len(queue) for queue in queues), default=0)):
+            order.extend(queue[depth] for queue in queues if depth < len(queue))
+        return order
+    
+    def eta(self, position: int) -> float:
+        # Каждые capacity запросов впереди занимают примерно одно среднее время генерации
+        return (position + self.in_flight) / self.capacity * self.avg_duration
+    
+    def notify(self):
+        for position, waiter in enumerate(self._order(), start=1):
+            # Сообщаем только о сдвиге в очереди
+            if waiter.on_queue is not None and waiter.position != position:
+                waiter.position = position
+                try:
+                    waiter.on_queue(position, self.eta(position))
+                except Exception as e:
+                    logger.debug(f"Queue callback failed: {e}")
+    
+    def enqueue(self, key: Hashable, on_queue: Optional[QueueCallback]) -> _Waiter:
+        if self.queued >= self.max_queue:
+            raise GenerationQueueFull(f"Generation queue is full ({self.queued} waiting)")
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), on_queue)
+        self._queues.setdefault(key, deque()).append(waiter)
+        self.queued += 1
+        self.notify()
+        return waiter
+    
+    def remove(self, key: Hashable, waiter: _Waiter):
+        queue = self._queues.get(key)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        self.queued -= 1
+        if not queue:
+            del self._queues[key]
+        self.notify()
+    
+    def release(self, duration: Optional[float]):
+        if duration is not None:
+            self.avg_duration = 0.8 * self.avg_duration + 0.2 * duration
+        self.in_flight -= 1
+        if not self._queues:
+            return
+        
+        key, queue = next(iter(self._queues.items()))
+        waiter = queue.popleft()
+        self.queued -= 1
+        # Ключ уходит в конец круга
+        if queue:
+            self._queues.move_to_end(key)
+        else:
+            del self._queues[key]
+        self.in_flight += 1
+        waiter.future.set_result(None)
+        self.notify()
+
+
+class GenerationScheduler:
+    """Ограничение одновременных генераций на модель и бэкенд с очередью.
+
+    Ollama параллельно обслуживает ограниченное число запросов
+    (``OLLAMA_NUM_PARALLEL``), остальные ждут внутри сервера без обратной
+    связи и падают по таймауту. Здесь лишние запросы ждут в очереди
+    приложения, а вызывающий код узнает свою позицию и примерное ожидание.
+    """
+    
+    def __init__(
+        self,
+        max_in_flight: int = 4,
+        max_queue: int = 200,
+        queue_timeout: float = 120.0,
+        initial_duration: float = 10.0
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.initial_duration = initial_duration
+        self._lanes: Dict[str, _Lane] = {}
+    
+    def _lane(self, lane_key: str) -> _Lane:
+        lane = self._lanes.get(lane_key)
+        if lane is None:
+            lane = _Lane(self.max_in_flight, self.max_queue, self.initial_duration)
+            self._lanes[lane_key] = lane
+        return lane
+    
+    @asynccontextmanager
+    async def slot(self, lane_key: str, key: Hashable = None, on_queue: Optional[QueueCallback] = None):
+        """Слот генерации; при занятых слотах ждет своей очереди"""
+        lane = self._lane(lane_key)
+        if lane.in_flight < lane.capacity and not lane.queued:
+            lane.in_flight += 1
+        else:
+            waiter = lane.enqueue(key, on_queue)
+            attempt_queued()
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            except BaseException as e:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # Слот успели выдать одновременно с отменой: возвращаем его
+                    lane.release(None)
+                else:
+                    waiter.future.cancel()
+                    lane.remove(key, waiter)
+                if isinstance(e, asyncio.TimeoutError):
+                    raise GenerationQueueTimeout(
+                        f"Waited more than {self.queue_timeout:g}s for a generation slot"
+                    ) from e
+                raise
+            logger.debug(f"Generation slot on {lane_key} after {time.monotonic() - waiter.enqueued_at:.1f}s in queue")
+        
+        attempt_started()
+        started = time.monotonic()
+        completed = False
+        try:
+            yield
+            completed = True
+        finally:
+            # Время прерванной генерации не показательно для оценки ETA
+            lane.release(time.monotonic() - started if completed else None)
+    
+    def load(self, model: str) -> Tuple[float, float]:
+        """Ожидающих на слот и средняя длительность генерации модели по всем бэкендам"""
+        lanes = [lane for lane_key, lane in self._lanes.items() if lane_key.endswith(f"/{model}")]
+        if not lanes:
+            return 0.0, 0.0
+        queued = sum(lane.queued for lane in lanes)
+        capacity = sum(lane.capacity for lane in lanes)
+        return queued / capacity, sum(lane.avg_duration for lane in lanes) / len(lanes)
+    
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            lane_key: {
+                "in_flight": lane.in_flight,
+                "queued": lane.queued,
+                "capacity": lane.capacity,
+                "avg_duration": round(lane.avg_duration, 2),
+            }
+            for lane_key, lane in self._lanes.items()
+        }
+
+
+generation_scheduler = GenerationScheduler(
+    max_in_flight=settings.ollama_max_in_flight,
+    max_queue=settings.ollama_max_queue,
+    queue_timeout=settings.ollama_queue_timeout
+)
+
+
+class ScheduledProvider(LLMProvider):
+    """Провайдер Ollama поверх пула серверов: выбор сервера, затем слот планировщика"""
+    name = "ollama"
+    
+    def __init__(self, pool: Optional[OllamaPool] = None, scheduler: Optional[GenerationScheduler] = None):
+        self.pool = pool or ollama_pool
+        self.scheduler = scheduler or generation_scheduler
+    
+    async def generate(self, request: GenerationRequest) -> str:
+        for attempt in range(1, len(self.pool.backends) + 1):
+            try:
+                async with self.pool.acquire(request.model, request.queue_key) as backend:
+                    async with self.scheduler.slot(f"{backend.base_url}/{request.model}", request.queue_key, request.on_queue):
+                        return await backend.provider.generate(request)
+            except BACKEND_UNREACHABLE:
+                if attempt == len(self.pool.backends):
+                    raise
+                logger.warning(f"Retrying {request.model} generation on another Ollama backend")
+    
+    async def stream(self, request: GenerationRequest) -> AsyncIterator[str]:
+        for attempt in range(1, len(self.pool.backends) + 1):
+            started = False
+            try:
+                async with self.pool.acquire(request.model, request.queue_key) as backend:
+                    async with self.scheduler.slot(f"{backend.base_url}/{request.model}", request.queue_key, request.on_queue):
+                        async for chunk in backend.provider.stream(request):
+                            started = True
+                            yield chunk
+                return
+            except BACKEND_UNREACHABLE:
+                # Начатый ответ повторять нельзя: пользователь уже видит его часть
+                if started or attempt == len(self.pool.backends):
+                    raise
+                logger.warning(f"Retrying {request.model} stream on another Ollama backend")
+    
+    async def embed(self, model: str, texts: List[str]) -> List[List[float]]:
+        """Эмбеддинги в слоте своей модели: не отнимают слоты у генерации, но и не перегружают сервер"""
+        for attempt in range(1, len(self.pool.backends) + 1):
+            try:
+                async with self.pool.acquire(model) as backend:
+                    async with self.scheduler.slot(f"{backend.base_url}/{model}"):
+                        return await backend.provider.embed(model, texts)
+            except BACKEND_UNREACHABLE:
+                if attempt == len(self.pool.backends):
+                    raise
+                logger.warning(f"Retrying {model} embedding on another Ollama backend")
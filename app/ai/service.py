@@ -1,25 +1,62 @@
-import json
 import logging
-from typing import List, Optional
+from typing import AsyncIterator, Callable, Dict, List, Optional
 
-import openai
-import anthropic
 from app.core.config import settings
-from app.ai.ollama_service import OllamaService
+from app.ai.model_routing import ModelChoice, ModelRouter, model_router as default_model_router
+from app.ai.ollama_service import CHARACTER_OPTIONS, CHARACTER_TEMPERATURE, OllamaService
+from app.ai.prompt_builder import prompt_builder
+from app.ai.prompt_templates import DEFAULT_CHARACTER_NAME, prompt_templates
+from app.ai.response_cache import ResponseCache, response_cache
+from app.ai.routing import ProviderRouter, provider_router
+from app.ai.scheduler import ScheduledProvider
+from app.ai.providers import (
+    AnthropicProvider, GenerationRequest, LLMProvider, OpenAIProvider
+)
 
 logger = logging.getLogger(__name__)
 
-openai.api_key = settings.openai_api_key
-anthropic_client = anthropic.Anthropic(api_key=settings.anthropic_api_key)
+# Параметры генерации для OpenAI и Anthropic
+REPLY_MAX_TOKENS = 300
+REPLY_TEMPERATURE = 0.8
 
 
 class AIService:
-    def __init__(self):
-        self.openai_client = openai.OpenAI(api_key=settings.openai_api_key)
-        self.anthropic_client = anthropic_client
+    def __init__(
+        self,
+        providers: Optional[Dict[str, LLMProvider]] = None,
+        router: Optional[ProviderRouter] = None,
+        model_router: Optional[ModelRouter] = None,
+        cache: Optional[ResponseCache] = None
+    ):
+        # Провайдеры можно подменить (например, локальным фейком в тестах)
+        self.providers = providers or {
+            "openai": OpenAIProvider(),
+            "anthropic": AnthropicProvider(),
+            "ollama": ScheduledProvider(),
+        }
         self.ollama_service = OllamaService(
-            base_url=settings.ollama_base_url
+            base_url=settings.ollama_base_url,
+            provider=self.providers["ollama"]
         )
+        self.router = router or provider_router
+        self.model_router = model_router or default_model_router
+        self.response_cache = cache or response_cache
+    
+    def provider_chain(self, use_anthropic: bool = False, use_ollama: bool = None) -> List[str]:
+        """Основной провайдер по флагам, за ним настроенные запасные в порядке llm_fallback_chain"""
+        if use_ollama is None:
+            use_ollama = settings.use_ollama
+        primary = "ollama" if use_ollama else "anthropic" if use_anthropic else "openai"
+        configured = {
+            "ollama": settings.use_ollama,
+            "openai": bool(settings.openai_api_key),
+            "anthropic": bool(settings.anthropic_api_key),
+        }
+        fallbacks = [name.strip() for name in settings.llm_fallback_chain.split(",")]
+        return [primary] + [
+            name for name in dict.fromkeys(fallbacks)
+            if name != primary and configured.get(name) and name in self.providers
+        ]
     
     async def generate_response(
         self,
@@ -28,122 +65,360 @@ class AIService:
         conversation_history: List[dict],
         user_message: str,
         use_anthropic: bool = False,
-        use_ollama: bool = None
+        use_ollama: bool = None,
+        chat_id: Optional[int] = None,
+        summary: Optional[str] = None,
+        memories: Optional[List[str]] = None,
+        character_name: Optional[str] = None,
+        premium: bool = False
     ) -> str:
-        # Определяем какой сервис использовать
-        if use_ollama is None:
-            use_ollama = settings.use_ollama
+        character_name = character_name or DEFAULT_CHARACTER_NAME
+        choice = self.model_router.choose(premium, character_name)
+        attempts = {
+            "ollama": lambda: self._generate_ollama_response(
+                character_name,
+                character_personality,
+                character_description,
+                conversation_history,
+                user_message,
+                chat_id,
+                summary,
+                memories,
+                choice
+            ),
+            "anthropic": lambda: self._generate_anthropic_response(
+                character_name,
+                character_personality,
+                character_description,
+                conversation_history,
+                user_message,
+                summary,
+                memories
+            ),
+            "openai": lambda: self._generate_openai_response(
+                character_name,
+                character_personality,
+                character_description,
+                conversation_history,
+                user_message,
+                summary,
+                memories
+            ),
+        }
+        
+        chain = self.provider_chain(use_anthropic, use_ollama)
+        cache_key = self._cache_key(
+            chain, choice, character_name, character_personality, character_description,
+            conversation_history, user_message, summary, memories
+        )
+        cached = await self.response_cache.lookup(cache_key)
+        if cached is not None:
+            return cached
         
+        served_by: List[str] = []
         try:
-            if use_ollama:
-                return await self._generate_ollama_response(
-                    character_personality,
-                    character_description,
-                    conversation_history,
-                    user_message
-                )
-            elif use_anthropic:
-                return await self._generate_anthropic_response(
-                    character_personality,
-                    character_description,
-                    conversation_history,
-                    user_message
-                )
-            else:
-                return await self._generate_openai_response(
-                    character_personality,
-                    character_description,
-                    conversation_history,
-                    user_message
-                )
+            response = await self.router.generate(chain, attempts, served_by.append)
         except Exception as e:
             logger.error(f"Error generating AI response: {e}")
             return "Извините, произошла ошибка. Попробуйте еще раз."
+        if served_by != ["ollama"]:
+            # Ответ Ollama уже обработан в OllamaService
+            response = self.post_process(response, served_by[0] if served_by else None, character_name)
+        # Ответ запасного провайдера не годится для ключа основного
+        if served_by == chain[:1]:
+            await self.response_cache.remember(cache_key, response)
+        return response
     
-    async def _generate_openai_response(
+    async def stream_response(
         self,
         character_personality: str,
         character_description: str,
         conversation_history: List[dict],
-        user_message: str
-    ) -> str:
-        system_prompt = f"""Ты {character_description}
-
-Твоя личность: {character_personality}
+        user_message: str,
+        use_anthropic: bool = False,
+        use_ollama: bool = None,
+        chat_id: Optional[int] = None,
+        summary: Optional[str] = None,
+        memories: Optional[List[str]] = None,
+        character_name: Optional[str] = None,
+        on_queue: Optional[Callable[[int, float], None]] = None,
+        premium: bool = False,
+        on_provider: Optional[Callable[[str], None]] = None
+    ) -> AsyncIterator[str]:
+        """Потоковая генерация ответа: отдает токены по мере их появления.
 
-Ты должна отвечать от первого лица, как будто ты действительно этот персонаж. 
-Будь естественной, игривой и немного кокетливой. Отвечай на русском языке.
-Не используй формальный тон, будь дружелюбной и интимной.
-Максимальная длина ответа - 200 слов."""
+        ``on_queue`` получает позицию в очереди и оценку ожидания, пока
+        локальная модель занята (для Ollama). ``premium`` исключает ход из
+        деградации модели под нагрузкой. ``on_provider`` получает имя
+        провайдера, выдавшего ответ: по нему выбирается постобработка.
+        """
+        character_name = character_name or DEFAULT_CHARACTER_NAME
+        choice = self.model_router.choose(premium, character_name)
+        attempts = {
+            "ollama": lambda: self.ollama_service.stream_character_response(
+                character_name=character_name,
+                character_personality=character_personality,
+                character_description=character_description,
+                conversation_history=conversation_history,
+                user_message=user_message,
+                model_name=choice.model,
+                chat_id=chat_id,
+                summary=summary,
+                memories=memories,
+                on_queue=on_queue,
+                max_tokens=choice.max_tokens
+            ),
+            "anthropic": lambda: self.providers["anthropic"].stream(self._build_anthropic_request(
+                character_name,
+                character_personality,
+                character_description,
+                conversation_history,
+                user_message,
+                summary,
+                memories
+            )),
+            "openai": lambda: self.providers["openai"].stream(self._build_openai_request(
+                character_name,
+                character_personality,
+                character_description,
+                conversation_history,
+                user_message,
+                summary,
+                memories
+            )),
+        }
+        chain = self.provider_chain(use_anthropic, use_ollama)
+        cache_key = self._cache_key(
+            chain, choice, character_name, character_personality, character_description,
+            conversation_history, user_message, summary, memories
+        )
+        cached = await self.response_cache.lookup(cache_key)
+        if cached is not None:
+            # В кэше уже обработанный текст, повторная постобработка ему не нужна
+            if on_provider is not None:
+                on_provider("cache")
+            yield cached
+            return
+        
+        served_by: List[str] = []
+        
+        def record_provider(name: str):
+            served_by.append(name)
+            if on_provider is not None:
+                on_provider(name)
+        
+        chunks = []
+        try:
+            async for chunk in self.router.stream(chain, attempts, record_provider):
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            logger.error(f"Error streaming AI response: {e}")
+            if not chunks:
+                yield "Извините, произошла ошибка. Попробуйте еще раз."
+            return
+        if served_by == chain[:1]:
+            await self.response_cache.remember(
+                cache_key, self.post_process("".join(chunks), served_by[0], character_name)
+            )
+    
+    def _cache_key(
+        self,
+        chain: List[str],
+        choice: ModelChoice,
+        character_name: str,
+        character_personality: str,
+        character_description: str,
+        conversation_history: List[dict],
+        user_message: str,
+        summary: Optional[str] = None,
+        memories: Optional[List[str]] = None
+    ) -> Optional[str]:
+        """Ключ кэша ответов по основному провайдеру цепочки или None, если кэш не применим"""
+        if not settings.response_cache_enabled:
+            return None
+        provider = chain[0]
+        if provider == "ollama":
+            model = choice.model
+            sampling = {"temperature": CHARACTER_TEMPERATURE, "max_tokens": choice.max_tokens, **CHARACTER_OPTIONS}
+        else:
+            model = settings.anthropic_model if provider == "anthropic" else settings.openai_model
+            sampling = {"temperature": REPLY_TEMPERATURE, "max_tokens": REPLY_MAX_TOKENS}
+        return self.response_cache.key(
+            character_name,
+            f"{character_personality}\n{character_description}",
+            provider,
+            model,
+            sampling,
+            conversation_history,
+            user_message,
+            summary,
+            memories
+        )
+    
+    def post_process(self, response: str, provider: Optional[str] = None, character_name: Optional[str] = None) -> str:
+        """Финальная обработка собранного потокового ответа перед сохранением.
 
-        messages = [{"role": "system", "content": system_prompt}]
+        ``provider`` - провайдер, который на самом деле выдал ответ (с учетом
+        запасных в цепочке).
+        """
+        if provider == "ollama":
+            return self.ollama_service._post_process_response(response, character_name or DEFAULT_CHARACTER_NAME)
+        return response.strip()
+    
+    def _build_openai_request(
+        self,
+        character_name: str,
+        character_personality: str,
+        character_description: str,
+        conversation_history: List[dict],
+        user_message: str,
+        summary: Optional[str] = None,
+        memories: Optional[List[str]] = None
+    ) -> GenerationRequest:
+        system_prompt = prompt_templates.system_prompt(
+            character_name, character_personality, character_description, summary
+        )
+        memory_note = prompt_builder.format_memories(memories)
+        history = prompt_builder.pack_history(
+            conversation_history,
+            settings.openai_model,
+            system_prompt,
+            memory_note + user_message,
+            max_tokens=REPLY_MAX_TOKENS,
+            system_tokens=prompt_templates.count_tokens(
+                settings.openai_model, character_name, character_personality, character_description, summary
+            )
+        )
+        
+        messages = []
         
-        for msg in conversation_history[-10:]:  # Последние 10 сообщений
+        for msg in history:
             role = "user" if msg["is_user_message"] else "assistant"
             messages.append({"role": role, "content": msg["content"]})
         
+        # Воспоминания идут после истории, чтобы не ломать стабильный префикс промпта
+        if memory_note:
+            messages.append({"role": "system", "content": memory_note})
         messages.append({"role": "user", "content": user_message})
         
-        response = self.openai_client.chat.completions.create(
+        return GenerationRequest(
             model=settings.openai_model,
+            system_prompt=system_prompt,
             messages=messages,
-            max_tokens=300,
-            temperature=0.8,
-            presence_penalty=0.1,
-            frequency_penalty=0.1
+            max_tokens=REPLY_MAX_TOKENS,
+            temperature=REPLY_TEMPERATURE,
+            options={"presence_penalty": 0.1, "frequency_penalty": 0.1}
         )
-        
-        return response.choices[0].message.content.strip()
     
-    async def _generate_anthropic_response(
+    def _build_anthropic_request(
         self,
+        character_name: str,
         character_personality: str,
         character_description: str,
         conversation_history: List[dict],
-        user_message: str
-    ) -> str:
-        system_prompt = f"""Ты {character_description}
-
-Твоя личность: {character_personality}
-
-Ты должна отвечать от первого лица, как будто ты действительно этот персонаж. 
-Будь естественной, игривой и немного кокетливой. Отвечай на русском языке.
-Не используй формальный тон, будь дружелюбной и интимной.
-Максимальная длина ответа - 200 слов."""
-
+        user_message: str,
+        summary: Optional[str] = None,
+        memories: Optional[List[str]] = None
+    ) -> GenerationRequest:
+        system_prompt = prompt_templates.system_prompt(
+            character_name, character_personality, character_description, summary
+        )
+        memory_note = prompt_builder.format_memories(memories)
+        history = prompt_builder.pack_history(
+            conversation_history,
+            settings.anthropic_model,
+            system_prompt,
+            memory_note + user_message,
+            max_tokens=REPLY_MAX_TOKENS,
+            system_tokens=prompt_templates.count_tokens(
+                settings.anthropic_model, character_name, character_personality, character_description, summary
+            )
+        )
+        
         conversation_text = ""
-        for msg in conversation_history[-10:]:
+        for msg in history:
             speaker = "Пользователь" if msg["is_user_message"] else "Ты"
             conversation_text += f"{speaker}: {msg['content']}\n"
         
-        conversation_text += f"Пользователь: {user_message}\nТы:"
+        conversation_text += f"{memory_note}Пользователь: {user_message}\nТы:"
         
-        response = self.anthropic_client.messages.create(
+        return GenerationRequest(
             model=settings.anthropic_model,
-            max_tokens=300,
-            temperature=0.8,
-            system=system_prompt,
-            messages=[{"role": "user", "content": conversation_text}]
+            system_prompt=system_prompt,
+            messages=[{"role": "user", "content": conversation_text}],
+            max_tokens=REPLY_MAX_TOKENS,
+            temperature=REPLY_TEMPERATURE
         )
-        
-        return response.content[0].text.strip()
+    
+    async def _generate_openai_response(
+        self,
+        character_name: str,
+        character_personality: str,
+        character_description: str,
+        conversation_history: List[dict],
+        user_message: str,
+        summary: Optional[str] = None,
+        memories: Optional[List[str]] = None
+    ) -> str:
+        return await self.providers["openai"].generate(self._build_openai_request(
+            character_name,
+            character_personality,
+            character_description,
+            conversation_history,
+            user_message,
+            summary,
+            memories
+        ))
+    
+    async def _generate_anthropic_response(
+        self,
+        character_name: str,
+        character_personality: str,
+        character_description: str,
+        conversation_history: List[dict],
+        user_message: str,
+        summary: Optional[str] = None,
+        memories: Optional[List[str]] = None
+    ) -> str:
+        return await self.providers["anthropic"].generate(self._build_anthropic_request(
+            character_name,
+            character_personality,
+            character_description,
+            conversation_history,
+            user_message,
+            summary,
+            memories
+        ))
     
     async def _generate_ollama_response(
         self,
+        character_name: str,
         character_personality: str,
         character_description: str,
         conversation_history: List[dict],
-        user_message: str
+        user_message: str,
+        chat_id: Optional[int] = None,
+        summary: Optional[str] = None,
+        memories: Optional[List[str]] = None,
+        choice: Optional[ModelChoice] = None
     ) -> str:
         """Генерация ответа через Ollama"""
-        return await self.ollama_service.generate_character_response(
-            character_name="AI Girl",
+        choice = choice or self.model_router.choose(character_name=character_name)
+        return await self.ollama_service.generate_character_reply(
+            character_name=character_name,
             character_personality=character_personality,
             character_description=character_description,
             conversation_history=conversation_history,
             user_message=user_message,
-            model_name=settings.ollama_default_model
+            model_name=choice.model,
+            chat_id=chat_id,
+            summary=summary,
+            memories=memories,
+            max_tokens=choice.max_tokens
         )
     
-    def count_tokens(self, text: str) -> int:
-        return len(text.split())  # Простая оценка токенов
+    def count_tokens(self, text: str, model: Optional[str] = None) -> int:
+        if model is None:
+            model = settings.ollama_default_model if settings.use_ollama else settings.openai_model
+        return prompt_builder.count_tokens(text, model)
@@ -5,7 +5,9 @@ from typing import Optional
 import stripe
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
+from sqlalchemy.orm import joinedload
 
+from app.core.auth import principal_cache
 from app.core.config import settings
 from app.models.database import User, Payment, UserRole, SubscriptionType
 
@@ -67,7 +69,9 @@ class BillingService:
             
             if payment_intent.status == "succeeded":
                 result = await db.execute(
-                    select(Payment).where(Payment.stripe_payment_intent_id == payment_intent_id)
+                    select(Payment)
+                    .options(joinedload(Payment.user))
+                    .where(Payment.stripe_payment_intent_id == payment_intent_id)
                 )
                 payment = result.scalar_one_or_none()
                 
@@ -83,6 +87,7 @@ class BillingService:
                         user.subscription_expires = datetime.utcnow() + timedelta(days=365)
                     
                     await db.commit()
+                    principal_cache.invalidate(payment.user_id)
                     return True
             
             return False
@@ -93,10 +98,13 @@ class BillingService:
     
     async def cancel_subscription(self, user: User, db: AsyncSession) -> bool:
         try:
+            # Пользователь может прийти из кэша аутентификации, отсоединенным от сессии
+            user = await db.merge(user)
             user.role = UserRole.FREE
             user.subscription_type = None
             user.subscription_expires = None
             await db.commit()
+            principal_cache.invalidate(user.id)
             return True
         except Exception as e:
             logger.error(f"Error canceling subscription: {e}")
@@ -0,0 +1,175 @@
+import hashlib
+import hmac
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from fastapi import Depends, HTTPException, status
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from jose import JWTError, jwt
+from sqlalchemy import select
+
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.models.database import User, UserRole
+
+logger = logging.getLogger(__name__)
+
+security = HTTPBearer(auto_error=False)
+
+# Пользователь, под которым работают демо-страницы в режиме отладки
+DEBUG_TELEGRAM_ID = 123456789
+
+
+@dataclass(frozen=True, slots=True)
+class TokenClaims:
+    user_id: int
+    role: str
+    subscription_expires: Optional[datetime]
+
+
+def create_access_token(user: User, expires_delta: Optional[timedelta] = None) -> str:
+    """JWT с id, ролью и сроком подписки пользователя"""
+    now = datetime.utcnow()
+    expire = now + (expires_delta or timedelta(minutes=settings.access_token_expire_minutes))
+    claims = {
+        "sub": str(user.id),
+        "role": user.role,
+        "sub_exp": int(user.subscription_expires.timestamp()) if user.subscription_expires else None,
+        "iat": int(now.timestamp()),
+        "exp": int(expire.timestamp()),
+    }
+    return jwt.encode(claims, settings.secret_key, algorithm=settings.algorithm)
+
+
+def decode_access_token(token: str) -> TokenClaims:
+    try:
+        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
+        subscription_expires = payload.get("sub_exp")
+        return TokenClaims(
+            user_id=int(payload["sub"]),
+            role=payload.get("role", UserRole.FREE),
+            subscription_expires=datetime.utcfromtimestamp(subscription_expires) if subscription_expires else None
+        )
+    except (JWTError, KeyError, ValueError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication credentials",
+            headers={"WWW-Authenticate": "Bearer"}
+        ) from e
+
+
+def verify_telegram_login(data: Dict[str, str]) -> bool:
+    """Проверка подписи данных Telegram Login Widget"""
+    received_hash = data.get("hash", "")
+    check_string = "\n".join(f"{key}={data[key]}" for key in sorted(data) if key != "hash")
+    secret = hashlib.sha256(settings.telegram_token.encode()).digest()
+    expected_hash = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    if not settings.telegram_token or not hmac.compare_digest(expected_hash, received_hash):
+        return False
+    # Устаревшие данные входа не принимаем
+    return time.time() - int(data.get("auth_date", 0)) < 86400
+
+
+class PrincipalCache:
+    """Короткоживущий LRU-кэш пользователей, прошедших проверку токена.
+
+    Объекты отсоединены от сессии: их можно читать в обработчиках, а для
+    изменения строки ``user`` объект нужно присоединить к сессии (``db.merge``).
+    Вместе с пользователем хранится роль из токена, уже сверенная с БД: токен,
+    выданный до смены роли, не заставляет перечитывать пользователя на
+    каждом запросе до своего истечения.
+    """
+    
+    def __init__(self, capacity: int = 10000, ttl: float = 60.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, Tuple[User, float, Optional[str]]]" = OrderedDict()
+    
+    def get(self, user_id: int, token_role: Optional[str] = None) -> Optional[User]:
+        """Пользователь из кэша; None, если роль токена расходится с ним и еще не сверялась с БД"""
+        item = self._entries.get(user_id)
+        if item is None:
+            return None
+        user, expires_at, checked_role = item
+        if expires_at <= time.monotonic():
+            del self._entries[user_id]
+            return None
+        if token_role is not None and token_role not in (user.role, checked_role):
+            return None
+        self._entries.move_to_end(user_id)
+        return user
+    
+    def put(self, user: User, token_role: Optional[str] = None):
+        self._entries[user.id] = (user, time.monotonic() + self.ttl, token_role)
+        self._entries.move_to_end(user.id)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+    
+    def invalidate(self, user_id: int):
+        """Сброс после изменения роли или подписки пользователя"""
+        self._entries.pop(user_id, None)
+
+
+principal_cache = PrincipalCache(
+    capacity=settings.auth_principal_cache_size,
+    ttl=settings.auth_principal_ttl
+)
+
+
+async def _load_user(user_id: int) -> Optional[User]:
+    async with AsyncSessionLocal() as db:
+        return await db.get(User, user_id)
+
+
+async def _debug_user() -> User:
+    """Тестовый пользователь для демо-страниц без входа (только при debug)"""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(User).where(User.telegram_id == DEBUG_TELEGRAM_ID))
+        user = result.scalar_one_or_none()
+        if not user:
+            user = User(
+                telegram_id=DEBUG_TELEGRAM_ID,
+                username="test_user",
+                first_name="Тест",
+                last_name="Пользователь",
+                role=UserRole.FREE
+            )
+            db.add(user)
+            await db.commit()
+            await db.refresh(user)
+        return user
+
+
+async def get_current_user(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)
+) -> User:
+    """Пользователь из bearer-токена; в типичном запросе без обращения к БД"""
+    try:
+        if credentials is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Not authenticated",
+                headers={"WWW-Authenticate": "Bearer"}
+            )
+        claims = decode_access_token(credentials.credentials)
+    except HTTPException:
+        if settings.debug:
+            return await _debug_user()
+        raise
+    
+    # Промах или роль токена расходится с кэшем и еще не сверялась: читаем из БД
+    user = principal_cache.get(claims.user_id, claims.role)
+    if user is None:
+        user = await _load_user(claims.user_id)
+        if user is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid authentication credentials",
+                headers={"WWW-Authenticate": "Bearer"}
+            )
+        principal_cache.put(user, claims.role)
+    return user
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Dict, Optional
 from pydantic_settings import BaseSettings
 
 
@@ -12,10 +12,40 @@ class Settings(BaseSettings):
     
     # Redis
     redis_url: str = "redis://localhost:6379"
+    # Счетчики дневного лимита: "redis" или "memory" (один процесс, тесты)
+    quota_backend: str = "redis"
+    quota_flush_interval: float = 30.0
+    # Отложенная запись сообщений: пакетная вставка в фоне вместо коммита в запросе
+    message_write_behind: bool = False
+    # Очередь записи: "memory" (быстро, теряется при падении) или "redis" (Redis Stream)
+    message_queue_backend: str = "memory"
+    message_flush_interval: float = 0.05
+    message_flush_batch: int = 500
+    # Отставание очереди, после которого сообщения пишутся напрямую
+    message_max_pending: int = 20000
+    message_overlay_ttl: float = 60.0
     
     # Telegram
     telegram_token: str = ""
+    # Имя бота для Telegram Login Widget на сайте; пусто - входа на сайте нет (API пускает только при debug)
+    telegram_bot_username: str = ""
     telegram_webhook_url: Optional[str] = None
+    # Секрет из заголовка X-Telegram-Bot-Api-Secret-Token (обязателен для webhook)
+    telegram_webhook_secret: str = ""
+    telegram_webhook_workers: int = 8
+    telegram_webhook_max_connections: int = 40
+    telegram_update_queue_size: int = 10000
+    # Необработанных обновлений одного пользователя, сверх этого новые отбрасываются
+    telegram_user_queue_limit: int = 5
+    # Потоковые ответы: правка сообщения не чаще раза в интервал и не меньше чем на N символов
+    telegram_stream_edit_interval: float = 1.0
+    telegram_stream_min_chars: int = 40
+    # Исходящие запросы: лимиты Bot API на бота, на личный чат и на группу
+    telegram_global_rate: float = 30.0
+    telegram_chat_rate: float = 1.0
+    telegram_chat_burst: float = 3.0
+    telegram_group_rate_per_minute: float = 20.0
+    telegram_send_retries: int = 3
     
     # OpenAI
     openai_api_key: str = ""
@@ -29,6 +59,77 @@ class Settings(BaseSettings):
     ollama_base_url: str = "http://localhost:11434"
     ollama_default_model: str = "llama2"
     use_ollama: bool = True
+    ollama_context_cache_size: int = 1000
+    ollama_context_max_tokens: int = 3072
+    ollama_context_cache_path: Optional[str] = None
+    # Планировщик генерации: одновременных запросов на модель (по OLLAMA_NUM_PARALLEL) и очередь к ним
+    ollama_max_in_flight: int = 4
+    ollama_max_queue: int = 200
+    ollama_queue_timeout: float = 120.0
+    # Пул серверов Ollama: URL через запятую (пусто - только ollama_base_url)
+    ollama_backends: str = ""
+    ollama_probe_interval: float = 10.0
+    ollama_probe_timeout: float = 3.0
+    # Адаптивный выбор модели: длина ответа, модель по персонажу и деградация бесплатного тарифа под нагрузкой
+    ollama_max_tokens: int = 250
+    ollama_character_models: Dict[str, str] = {}
+    ollama_degraded_max_tokens: int = 120
+    # Легкая модель при двукратной перегрузке (пусто - только укороченные ответы)
+    ollama_light_model: str = ""
+    # Пороги перегрузки: ожидающих на слот генерации и средняя длительность генерации, с
+    ollama_degrade_queue_ratio: float = 1.0
+    ollama_degrade_latency: float = 30.0
+    
+    # Пул HTTP-соединений к LLM провайдерам
+    llm_max_connections: int = 100
+    llm_max_keepalive_connections: int = 20
+    llm_request_timeout: float = 120.0
+    # Цепочка запасных провайдеров (после основного из use_ollama/use_anthropic),
+    # таймауты провайдеров (для потока - до первого фрагмента) и общий бюджет ответа
+    llm_fallback_chain: str = "ollama,openai,anthropic"
+    llm_provider_timeouts: Dict[str, float] = {
+        "ollama": 120.0,
+        "openai": 30.0,
+        "anthropic": 30.0,
+    }
+    llm_latency_budget: float = 150.0
+    # Параллельный запрос к следующему провайдеру, если ответа нет дольше (0 - выключено)
+    llm_hedge_delay: float = 8.0
+    # Предохранитель: ошибок подряд, доля таймаута для медленного p95, пауза до пробы
+    llm_breaker_failures: int = 5
+    llm_breaker_slow_ratio: float = 0.8
+    llm_breaker_cooldown: float = 30.0
+    
+    # Токенный бюджет промпта
+    model_context_windows: Dict[str, int] = {
+        "gpt-4": 8192,
+        "gpt-4o": 128000,
+        "gpt-4-turbo": 128000,
+        "gpt-3.5-turbo": 16385,
+        "claude-3": 200000,
+        "llama2": 4096,
+        "mistral": 8192,
+    }
+    default_context_window: int = 4096
+    prompt_history_max_tokens: int = 1500
+    prompt_history_fetch_limit: int = 50
+    
+    # Сводка длинных чатов
+    summary_enabled: bool = True
+    summary_every_messages: int = 10
+    summary_keep_recent: int = 8
+    summary_max_tokens: int = 300
+    
+    # Семантическая память персонажа (эмбеддинги через Ollama)
+    memory_enabled: bool = False
+    memory_embedding_model: str = "nomic-embed-text"
+    memory_top_k: int = 3
+    memory_min_score: float = 0.35
+    memory_max_chats: int = 5000
+    memory_embed_batch_size: int = 64
+    
+    # Каталог персонажей в памяти (секунды до принудительного перечитывания)
+    character_catalog_ttl: float = 300.0
     
     # Stripe
     stripe_secret_key: str = ""
@@ -39,10 +140,35 @@ class Settings(BaseSettings):
     secret_key: str = "your-secret-key-here"
     algorithm: str = "HS256"
     access_token_expire_minutes: int = 30
+    auth_principal_ttl: float = 60.0
+    auth_principal_cache_size: int = 10000
     
     # Лимиты
     free_messages_per_day: int = 10
     premium_messages_per_day: int = 100
+    # Допуск к генерации: одновременных ответов, веса очередей ролей, ожидание слота и ответов на пользователя
+    admission_max_concurrent: int = 16
+    admission_weights: Dict[str, int] = {
+        "free": 1,
+        "premium": 4,
+        "admin": 4,
+    }
+    admission_max_wait: float = 10.0
+    admission_per_user_limit: int = 1
+    admission_max_queue: int = 500
+    # Повторы запросов с тем же ключом идемпотентности и повторные обновления Telegram, с
+    idempotency_ttl: float = 300.0
+    idempotency_max_entries: int = 10000
+    
+    # Кэш ответов на первые реплики: "memory" или "redis", вариантов на ключ, срок жизни пула, с
+    response_cache_enabled: bool = False
+    response_cache_backend: str = "memory"
+    response_cache_size: int = 5000
+    response_cache_variants: int = 3
+    response_cache_ttl: float = 86400.0
+    # Кэшируются только разговоры не длиннее стольких реплик и с короткими сообщениями
+    response_cache_max_history: int = 2
+    response_cache_max_message_chars: int = 60
     
     class Config:
         env_file = ".env"
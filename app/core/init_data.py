@@ -2,6 +2,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from app.models.database import Character, User, UserRole
 from app.core.database import AsyncSessionLocal
+from app.services.character_catalog import character_catalog
 
 
 async def init_characters():
@@ -54,6 +55,7 @@ async def init_characters():
                     db.add(character)
             
             await db.commit()
+            character_catalog.invalidate()
             print("Персонажи успешно добавлены!")
             
         except Exception as e:
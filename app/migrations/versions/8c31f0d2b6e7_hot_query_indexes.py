@@ -0,0 +1,37 @@
+"""hot query indexes
+
+Revision ID: 8c31f0d2b6e7
+Revises: 5b7e2c9a4d13
+Create Date: 2026-10-17 14:03:27.918604
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c31f0d2b6e7'
+down_revision: Union[str, Sequence[str], None] = '5b7e2c9a4d13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # CONCURRENTLY не блокирует запись в таблицы, но не работает внутри транзакции
+    with op.get_context().autocommit_block():
+        op.create_index('ix_message_chat_id_id', 'message', ['chat_id', 'id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_chat_user_id_created_at', 'chat', ['user_id', 'created_at'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index(op.f('ix_payment_user_id'), 'payment', ['user_id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_character_active', 'character', ['id'], unique=False, postgresql_where=sa.text('is_active'), postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_character_active', table_name='character', postgresql_concurrently=True, if_exists=True)
+        op.drop_index(op.f('ix_payment_user_id'), table_name='payment', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_chat_user_id_created_at', table_name='chat', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_message_chat_id_id', table_name='message', postgresql_concurrently=True, if_exists=True)
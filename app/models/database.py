@@ -3,7 +3,7 @@ from enum import Enum
 from typing import Optional
 
 from sqlalchemy import (
-    Boolean, Column, DateTime, ForeignKey, Integer, String, Text, Float, JSON
+    Boolean, Column, DateTime, ForeignKey, Index, Integer, String, Text, Float, JSON
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
@@ -38,8 +38,8 @@ class User(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    chats = relationship("Chat", back_populates="user")
-    payments = relationship("Payment", back_populates="user")
+    chats = relationship("Chat", back_populates="user", lazy="raise_on_sql")
+    payments = relationship("Payment", back_populates="user", lazy="raise_on_sql")
 
 
 class Character(Base):
@@ -54,7 +54,12 @@ class Character(Base):
     is_premium = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
-    chats = relationship("Chat", back_populates="character")
+    chats = relationship("Chat", back_populates="character", lazy="raise_on_sql")
+    
+    __table_args__ = (
+        # Каталог показывает только активных персонажей
+        Index("ix_character_active", "id", postgresql_where=is_active),
+    )
 
 
 class Chat(Base):
@@ -64,12 +69,19 @@ class Chat(Base):
     user_id = Column(Integer, ForeignKey("user.id"))
     character_id = Column(Integer, ForeignKey("character.id"))
     title = Column(String(255), nullable=True)
+    # Сводка старой части переписки и id последнего сообщения, вошедшего в нее
+    summary = Column(Text, nullable=True)
+    summary_message_id = Column(Integer, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    user = relationship("User", back_populates="chats")
-    character = relationship("Character", back_populates="chats")
-    messages = relationship("Message", back_populates="chat")
+    user = relationship("User", back_populates="chats", lazy="raise_on_sql")
+    character = relationship("Character", back_populates="chats", lazy="raise_on_sql")
+    messages = relationship("Message", back_populates="chat", lazy="raise_on_sql")
+    
+    __table_args__ = (
+        Index("ix_chat_user_id_created_at", "user_id", "created_at"),
+    )
 
 
 class Message(Base):
@@ -82,14 +94,19 @@ class Message(Base):
     tokens_used = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
     
-    chat = relationship("Chat", back_populates="messages")
+    chat = relationship("Chat", back_populates="messages", lazy="raise_on_sql")
+    
+    __table_args__ = (
+        # История читается страницами по id внутри чата (keyset)
+        Index("ix_message_chat_id_id", "chat_id", "id"),
+    )
 
 
 class Payment(Base):
     __tablename__ = "payment"
     
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("user.id"))
+    user_id = Column(Integer, ForeignKey("user.id"), index=True)
     stripe_payment_intent_id = Column(String(255), unique=True)
     amount = Column(Float, nullable=False)
     currency = Column(String(3), default="USD")
@@ -97,7 +114,7 @@ class Payment(Base):
     status = Column(String(50), default="pending")
     created_at = Column(DateTime, default=datetime.utcnow)
     
-    user = relationship("User", back_populates="payments")
+    user = relationship("User", back_populates="payments", lazy="raise_on_sql")
 
 
 class UserSession(Base):
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import math
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Optional
+
+from app.core.config import settings
+from app.models.database import UserRole
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """Генерация не принята: сервис перегружен или у пользователя уже идет ответ"""
+    
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"Generation rejected: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+    
+    @property
+    def retry_after_seconds(self) -> int:
+        """Значение для заголовка Retry-After"""
+        return max(1, math.ceil(self.retry_after))
+
+
+@dataclass(eq=False)
+class AdmissionTicket:
+    user_id: int
+    role: str
+    future: Optional[asyncio.Future] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+    admitted_at: Optional[float] = None
+    released: bool = False
+
+
+class AdmissionController:
+    """Допуск запросов к генерации перед AIService.
+
+    Одновременно генерируется не больше ``max_concurrent`` ответов, остальные
+    ждут в очередях по ролям. Освободившийся слот достается очередям
+    взвешенным round-robin, поэтому премиум при весе 4 проходит вчетверо
+    чаще бесплатного, но бесплатные не голодают. У пользователя не больше
+    ``per_user_limit`` генераций (включая ожидающие). Запрос, который по
+    оценке не дождется слота за ``max_wait``, отклоняется сразу, а не
+    держит обработчик до таймаута.
+    """
+    
+    def __init__(
+        self,
+        max_concurrent: int = 16,
+        weights: Optional[Dict[str, int]] = None,
+        max_wait: float = 10.0,
+        per_user_limit: int = 1,
+        max_queue: int = 500,
+        initial_duration: float = 10.0
+    ):
+        self.max_concurrent = max_concurrent
+        self.weights = weights or {UserRole.FREE.value: 1, UserRole.PREMIUM.value: 4, UserRole.ADMIN.value: 4}
+        self.max_wait = max_wait
+        self.per_user_limit = per_user_limit
+        self.max_queue = max_queue
+        self.avg_duration = initial_duration
+        self.active = 0
+        self.admitted = 0
+        self.rejected: Counter = Counter()
+        self._queues: Dict[str, Deque[AdmissionTicket]] = defaultdict(deque)
+        # Текущие веса плавного взвешенного round-robin
+        self._current: Dict[str, float] = defaultdict(float)
+        self._per_user: Dict[int, int] = defaultdict(int)
+    
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+    
+    def _weight(self, role: str) -> int:
+        return self.weights.get(role, 1)
+    
+    def estimate_wait(self, role: str) -> float:
+        """Ожидание нового запроса роли ``role`` по текущим очередям"""
+        if self.active < self.max_concurrent and not self.queued:
+            return 0.0
+        busy = [name for name, queue in self._queues.items() if queue and name != role]
+        share = self._weight(role) / (self._weight(role) + sum(self._weight(name) for name in busy))
+        # Слоты освобождаются со скоростью max_concurrent / avg_duration, роли достается ее доля
+        return (len(self._queues.get(role, ())) + 1) * self.avg_duration / (self.max_concurrent * share)
+    
+    def _reject(self, reason: str, retry_after: float) -> AdmissionRejected:
+        self.rejected[reason] += 1
+        return AdmissionRejected(reason, retry_after)
+    
+    def _next(self) -> Optional[AdmissionTicket]:
+        roles = [role for role, queue in self._queues.items() if queue]
+        if not roles:
+            return None
+        total = sum(self._weight(role) for role in roles)
+        for role in roles:
+            self._current[role] += self._weight(role)
+        role = max(roles, key=lambda name: self._current[name])
+        self._current[role] -= total
+        ticket = self._queues[role].popleft()
+        if not self._queues[role]:
+            # Опустевшая очередь не копит вес, пока простаивает
+            del self._queues[role]
+            self._current.pop(role, None)
+        return ticket
+    
+    def _admit(self, ticket: AdmissionTicket):
+        self.active += 1
+        self.admitted += 1
+        ticket.admitted_at = time.monotonic()
+    
+    def _pump(self):
+        while self.active < self.max_concurrent:
+            ticket = self._next()
+            if ticket is None:
+                return
+            self._admit(ticket)
+            ticket.future.set_result(None)
+    
+    def _remove(self, ticket: AdmissionTicket):
+        queue = self._queues.get(ticket.role)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.role]
+                self._current.pop(ticket.role, None)
+    
+    async def acquire(self, user_id: int, role: UserRole) -> AdmissionTicket:
+        """Слот генерации; AdmissionRejected, если его не получить вовремя"""
+        role = UserRole(role).value
+        if self._per_user.get(user_id, 0) >= self.per_user_limit:
+            raise self._reject("user_busy", min(self.avg_duration, self.max_wait))
+        
+        ticket = AdmissionTicket(user_id, role)
+        if self.active < self.max_concurrent and not self.queued:
+            self._admit(ticket)
+            self._per_user[user_id] += 1
+            return ticket
+        
+        if self.queued >= self.max_queue:
+            raise self._reject("queue_full", self.estimate_wait(role))
+        wait = self.estimate_wait(role)
+        if wait > self.max_wait:
+            raise self._reject("overloaded", wait)
+        
+        ticket.future = asyncio.get_running_loop().create_future()
+        self._queues[role].append(ticket)
+        self._per_user[user_id] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), self.max_wait)
+        except BaseException as e:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # Слот выдан одновременно с отменой: возвращаем его
+                self.release(ticket)
+            else:
+                ticket.future.cancel()
+                self._remove(ticket)
+                self._release_user(user_id)
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject("timeout", self.estimate_wait(role)) from e
+            raise
+        return ticket
+    
+    def _release_user(self, user_id: int):
+        self._per_user[user_id] -= 1
+        if self._per_user[user_id] <= 0:
+            del self._per_user[user_id]
+    
+    def release(self, ticket: AdmissionTicket):
+        """Освобождение слота; повторный вызов ничего не делает"""
+        if ticket.released or ticket.admitted_at is None:
+            return
+        ticket.released = True
+        self.avg_duration = 0.8 * self.avg_duration + 0.2 * (time.monotonic() - ticket.admitted_at)
+        self.active -= 1
+        self._release_user(ticket.user_id)
+        self._pump()
+    
+    @asynccontextmanager
+    async def admit(self, user_id: int, role: UserRole):
+        ticket = await self.acquire(user_id, role)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+    
+    def stats(self) -> Dict[str, object]:
+        return {
+            "active": self.active,
+            "queued": {role: len(queue) for role, queue in self._queues.items()},
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "avg_duration": round(self.avg_duration, 2),
+        }
+
+
+admission_controller = AdmissionController(
+    max_concurrent=settings.admission_max_concurrent,
+    weights=settings.admission_weights,
+    max_wait=settings.admission_max_wait,
+    per_user_limit=settings.admission_per_user_limit,
+    max_queue=settings.admission_max_queue
+)
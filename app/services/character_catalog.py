@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional, Tuple
+
+from app.ai.prompt_templates import prompt_templates
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.models.database import Character
+from app.services.repository import list_characters
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class CharacterRecord:
+    """Неизменяемый снимок строки character"""
+    id: int
+    name: str
+    description: str
+    personality: str
+    avatar_url: Optional[str]
+    is_premium: bool
+    is_active: bool
+    
+    @classmethod
+    def from_model(cls, character: Character) -> "CharacterRecord":
+        return cls(
+            id=character.id,
+            name=character.name,
+            description=character.description,
+            personality=character.personality,
+            avatar_url=character.avatar_url,
+            is_premium=bool(character.is_premium),
+            is_active=bool(character.is_active)
+        )
+    
+    def public_dict(self) -> dict:
+        """Поля CharacterResponse"""
+        data = asdict(self)
+        del data["is_active"]
+        return data
+
+
+class CharacterCatalog:
+    """Каталог персонажей в памяти процесса.
+
+    Персонажей единицы и меняются они редко, поэтому таблица читается целиком
+    при старте, а список для API сериализуется один раз вместе с ETag. После
+    изменения персонажей нужно вызвать ``invalidate()``; в других процессах
+    каталог перечитается не позже чем через ``character_catalog_ttl`` секунд.
+    """
+    
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+        self._by_id: Dict[int, CharacterRecord] = {}
+        self._active: Tuple[CharacterRecord, ...] = ()
+        self._public_json = b"[]"
+        self._etag = '""'
+        self._loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+    
+    @property
+    def is_fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+    
+    async def load(self):
+        """Чтение всех персонажей из БД и пересборка снимка"""
+        async with AsyncSessionLocal() as db:
+            records = [CharacterRecord.from_model(char) for char in await list_characters(db)]
+        
+        active = tuple(record for record in records if record.is_active)
+        public_json = json.dumps(
+            [record.public_dict() for record in active], ensure_ascii=False, separators=(",", ":")
+        ).encode("utf-8")
+        
+        # Ссылки заменяются разом, читатели видят либо старый, либо новый снимок
+        self._by_id = {record.id: record for record in records}
+        self._active = active
+        self._public_json = public_json
+        self._etag = f'"{hashlib.sha1(public_json).hexdigest()}"'
+        self._loaded_at = time.monotonic()
+        
+        # Персонажи могли измениться: промпты компилируются заново
+        prompt_templates.clear()
+        for record in active:
+            prompt_templates.compile(record.name, record.personality, record.description)
+        logger.info(f"Character catalog loaded: {len(records)} characters, {len(active)} active")
+    
+    async def ensure_loaded(self):
+        if self.is_fresh:
+            return
+        async with self._lock:
+            if not self.is_fresh:
+                await self.load()
+    
+    def invalidate(self):
+        """Сброс снимка: следующее обращение перечитает таблицу"""
+        self._loaded_at = None
+    
+    async def get(self, character_id: int) -> Optional[CharacterRecord]:
+        await self.ensure_loaded()
+        return self._by_id.get(character_id)
+    
+    async def active(self) -> Tuple[CharacterRecord, ...]:
+        await self.ensure_loaded()
+        return self._active
+    
+    async def public_json(self) -> Tuple[bytes, str]:
+        """Готовый JSON списка активных персонажей и его ETag"""
+        await self.ensure_loaded()
+        return self._public_json, self._etag
+
+
+character_catalog = CharacterCatalog(ttl=settings.character_catalog_ttl)
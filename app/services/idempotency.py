@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple, TypeVar
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class IdempotencyConflict(Exception):
+    """Ключ идемпотентности уже использован с другим содержимым запроса"""
+
+
+class SharedStream:
+    """Поток, который читают несколько подписчиков.
+
+    Источник вычитывается фоновой задачей в буфер, поэтому генерация не
+    обрывается, когда уходит клиент, а повтор с тем же ключом получает поток
+    с начала и дальше в реальном времени.
+    """
+    
+    def __init__(self, source: AsyncIterator[str]):
+        self.items: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._pump(source))
+    
+    async def _pump(self, source: AsyncIterator[str]):
+        try:
+            async for item in source:
+                self.items.append(item)
+                self._changed.set()
+        except Exception as e:
+            logger.error(f"Shared stream failed: {e}")
+            self.error = e
+        finally:
+            self.done = True
+            self._changed.set()
+    
+    async def subscribe(self) -> AsyncIterator[str]:
+        position = 0
+        while True:
+            while position < len(self.items):
+                yield self.items[position]
+                position += 1
+            if self.done:
+                break
+            self._changed.clear()
+            # Пока ждали сброса события, могли прийти новые элементы
+            if position < len(self.items) or self.done:
+                continue
+            await self._changed.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class IdempotencyRegistry:
+    """Выполняющиеся и недавно завершенные операции по ключу идемпотентности.
+
+    Повтор с тем же ключом не запускает работу заново: он ждет выполняющуюся
+    операцию или сразу получает ее результат, пока тот хранится ``ttl``
+    секунд. Ошибка ключ не занимает, и следующий повтор выполнится заново.
+    Повтор с тем же ключом, но другим ``fingerprint`` (отпечатком тела
+    запроса) получает IdempotencyConflict, а не чужой результат.
+    Реестр живет в памяти процесса, как и сами выполняющиеся генерации.
+    """
+    
+    def __init__(self, ttl: float = 300.0, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._running: Dict[Hashable, Tuple[asyncio.Future, Optional[str]]] = {}
+        # Завершенные в порядке завершения, то есть и истечения
+        self._done: "OrderedDict[Hashable, Tuple[float, Any, Optional[str]]]" = OrderedDict()
+        self.hits = 0
+    
+    def _sweep(self):
+        now = time.monotonic()
+        while self._done:
+            expires_at, _, _ = next(iter(self._done.values()))
+            if expires_at > now and len(self._done) <= self.max_entries:
+                break
+            self._done.popitem(last=False)
+    
+    def _store(self, key: Hashable, result: Any, fingerprint: Optional[str] = None):
+        self._done[key] = (time.monotonic() + self.ttl, result, fingerprint)
+        self._done.move_to_end(key)
+        self._sweep()
+    
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[T]], fingerprint: Optional[str] = None) -> T:
+        """Результат операции ``factory`` по ключу: новый, выполняющийся или сохраненный"""
+        self._sweep()
+        if key in self._done:
+            _, result, stored_fingerprint = self._done[key]
+            if stored_fingerprint != fingerprint:
+                raise IdempotencyConflict(f"Key {key} was used with a different request")
+            self.hits += 1
+            logger.info(f"Duplicate request {key}: reusing stored result")
+            return result
+        if key in self._running:
+            future, stored_fingerprint = self._running[key]
+            if stored_fingerprint != fingerprint:
+                raise IdempotencyConflict(f"Key {key} was used with a different request")
+            self.hits += 1
+            logger.info(f"Duplicate request {key}: joining in-flight operation")
+            return await asyncio.shield(future)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._running[key] = (future, fingerprint)
+        try:
+            result = await factory()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Исключение получат ожидающие повторы, владелец пробрасывает его сам
+                future.exception()
+            raise
+        else:
+            future.set_result(result)
+            self._store(key, result, fingerprint)
+            return result
+        finally:
+            del self._running[key]
+    
+    def seen(self, key: Hashable) -> bool:
+        """Отметка о событии; True, если оно уже было в пределах ``ttl``"""
+        self._sweep()
+        if key in self._done or key in self._running:
+            self.hits += 1
+            return True
+        self._store(key, None)
+        return False
+    
+    def forget(self, key: Hashable):
+        self._done.pop(key, None)
+    
+    def stats(self) -> Dict[str, int]:
+        return {"running": len(self._running), "stored": len(self._done), "duplicates": self.hits}
+
+
+idempotency_registry = IdempotencyRegistry(
+    ttl=settings.idempotency_ttl,
+    max_entries=settings.idempotency_max_entries
+)
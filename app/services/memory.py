@@ -0,0 +1,180 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from sqlalchemy import select
+
+from app.ai.scheduler import ScheduledProvider
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.models.database import Message
+
+logger = logging.getLogger(__name__)
+
+
+class ChatMemoryIndex:
+    """Нормированные эмбеддинги сообщений одного чата в непрерывной float32-матрице"""
+    __slots__ = ("vectors", "message_ids", "texts", "size")
+    
+    def __init__(self, dim: int, capacity: int = 64):
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.message_ids = np.zeros(capacity, dtype=np.int64)
+        self.texts: List[str] = []
+        self.size = 0
+    
+    def add(self, message_ids: List[int], texts: List[str], vectors: np.ndarray):
+        needed = self.size + len(message_ids)
+        if needed > len(self.vectors):
+            # Амортизированный рост, как у list
+            capacity = max(needed, 2 * len(self.vectors))
+            vectors_grown = np.zeros((capacity, self.vectors.shape[1]), dtype=np.float32)
+            vectors_grown[:self.size] = self.vectors[:self.size]
+            ids_grown = np.zeros(capacity, dtype=np.int64)
+            ids_grown[:self.size] = self.message_ids[:self.size]
+            self.vectors, self.message_ids = vectors_grown, ids_grown
+        
+        self.vectors[self.size:needed] = vectors
+        self.message_ids[self.size:needed] = message_ids
+        self.texts.extend(texts)
+        self.size = needed
+    
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        before_id: Optional[int] = None,
+        min_score: float = 0.0
+    ) -> List[Tuple[float, int, str]]:
+        """Top-k по скалярному произведению (косинусу) среди сообщений старше before_id"""
+        if self.size == 0 or k <= 0:
+            return []
+        
+        scores = self.vectors[:self.size] @ query
+        if before_id is not None:
+            scores = np.where(self.message_ids[:self.size] < before_id, scores, -np.inf)
+        
+        k = min(k, self.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (float(scores[i]), int(self.message_ids[i]), self.texts[i])
+            for i in top
+            if scores[i] >= min_score
+        ]
+
+
+class SemanticMemory:
+    """Векторная память по чатам: индексация в фоне, поиск по запросу пользователя"""
+    
+    def __init__(self, provider: Optional[ScheduledProvider] = None, model: Optional[str] = None):
+        # Эмбеддинги идут через пул серверов Ollama и планировщик, как и генерация
+        self.provider = provider or ScheduledProvider()
+        self.model = model or settings.memory_embedding_model
+        self._indexes: "OrderedDict[int, ChatMemoryIndex]" = OrderedDict()
+        self._pending: Dict[int, List[Tuple[int, str]]] = {}
+        self._loading: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+    
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    def index_messages(self, chat_id: int, messages: List[Message]):
+        """Постановка только что сохраненных сообщений на индексацию"""
+        if not settings.memory_enabled:
+            return
+        self._pending.setdefault(chat_id, []).extend((msg.id, msg.content) for msg in messages)
+        if chat_id not in self._loading:
+            self._spawn(self._flush(chat_id))
+    
+    async def recall(self, chat_id: int, query: str, before_id: Optional[int] = None) -> List[str]:
+        """Несколько релевантных старых сообщений чата; пусто, если индекс еще не построен"""
+        if not settings.memory_enabled:
+            return []
+        
+        index = self._indexes.get(chat_id)
+        if index is None:
+            self._ensure_loaded(chat_id)
+            return []
+        self._indexes.move_to_end(chat_id)
+        if index.size == 0:
+            return []
+        
+        try:
+            query_vector = (await self._embed([query]))[0]
+        except Exception as e:
+            logger.error(f"Error embedding memory query: {e}")
+            return []
+        
+        results = index.search(query_vector, settings.memory_top_k, before_id, settings.memory_min_score)
+        return [text for _, _, text in results]
+    
+    def _ensure_loaded(self, chat_id: int):
+        if chat_id not in self._loading:
+            self._loading.add(chat_id)
+            self._spawn(self._load(chat_id))
+    
+    async def _flush(self, chat_id: int):
+        if chat_id not in self._indexes:
+            # Индекс соберется из БД целиком, ожидающие сообщения войдут в него
+            self._ensure_loaded(chat_id)
+            return
+        
+        pending = self._pending.pop(chat_id, [])
+        if not pending:
+            return
+        try:
+            await self._add(chat_id, pending)
+        except Exception as e:
+            logger.error(f"Error indexing messages for chat {chat_id}: {e}")
+    
+    async def _load(self, chat_id: int):
+        try:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(
+                    select(Message.id, Message.content)
+                    .where(Message.chat_id == chat_id)
+                    .order_by(Message.id)
+                )
+                rows = [(row.id, row.content) for row in result]
+            
+            loaded_ids = {message_id for message_id, _ in rows}
+            rows.extend(
+                item for item in self._pending.pop(chat_id, [])
+                if item[0] not in loaded_ids
+            )
+            await self._add(chat_id, rows)
+        except Exception as e:
+            logger.error(f"Error building memory index for chat {chat_id}: {e}")
+        finally:
+            self._loading.discard(chat_id)
+    
+    async def _add(self, chat_id: int, rows: List[Tuple[int, str]]):
+        batch_size = settings.memory_embed_batch_size
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            vectors = await self._embed([text for _, text in batch])
+            
+            index = self._indexes.get(chat_id)
+            if index is None or (index.size == 0 and index.vectors.shape[1] != vectors.shape[1]):
+                index = ChatMemoryIndex(dim=vectors.shape[1])
+                self._indexes[chat_id] = index
+            index.add([message_id for message_id, _ in batch], [text for _, text in batch], vectors)
+        
+        if chat_id not in self._indexes:
+            self._indexes[chat_id] = ChatMemoryIndex(dim=1, capacity=0)
+        self._indexes.move_to_end(chat_id)
+        while len(self._indexes) > settings.memory_max_chats:
+            self._indexes.popitem(last=False)
+    
+    async def _embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.asarray(await self.provider.embed(self.model, texts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+semantic_memory = SemanticMemory()
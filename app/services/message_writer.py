@@ -0,0 +1,357 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError, ResponseError
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.models.database import Message
+
+logger = logging.getLogger(__name__)
+
+# id выдаются заранее из последовательности таблицы: без коммита и в порядке вызовов
+ALLOCATE_IDS_SQL = text("SELECT nextval(pg_get_serial_sequence('message', 'id')) FROM generate_series(1, :count)")
+
+STREAM_KEY = "messages:write-behind"
+STREAM_GROUP = "message-writer"
+DEAD_LETTER_KEY = "messages:dead-letter"
+
+# Ошибки конкретных строк (удаленный чат, слишком длинное значение): повтор их не исправит
+ROW_ERRORS = (IntegrityError, DataError)
+
+
+def _to_row(message: Message) -> dict:
+    return {
+        "id": message.id,
+        "chat_id": message.chat_id,
+        "content": message.content,
+        "is_user_message": message.is_user_message,
+        # Умолчания колонок при executemany не подставляются
+        "tokens_used": message.tokens_used or 0,
+        "created_at": message.created_at,
+    }
+
+
+class WriteQueue(ABC):
+    """Очередь сообщений, ожидающих пакетной вставки"""
+    
+    @abstractmethod
+    async def put(self, rows: List[dict]):
+        """Постановка строк; после возврата они не теряются (в пределах гарантий хранилища)"""
+    
+    @abstractmethod
+    async def take(self, batch_size: int, interval: float) -> Tuple[List[str], List[dict]]:
+        """Пакет строк: как только набралось ``batch_size`` или прошло ``interval`` секунд"""
+    
+    async def ack(self, tokens: List[str]):
+        """Подтверждение записи пакета в БД"""
+    
+    async def drain(self) -> List[dict]:
+        """Все оставшиеся строки при остановке"""
+        return []
+    
+    async def dead_letter(self, rows: List[dict]):
+        """Строки, которые БД не примет никогда; в памяти от них остается только запись в логе"""
+    
+    async def close(self):
+        pass
+
+
+class MemoryWriteQueue(WriteQueue):
+    """Очередь в памяти процесса: быстро, но неподтвержденное теряется при падении"""
+    
+    def __init__(self):
+        self._rows: List[dict] = []
+        self._batch_size = 1
+        self._ready = asyncio.Event()
+    
+    async def put(self, rows: List[dict]):
+        self._rows.extend(rows)
+        if len(self._rows) >= self._batch_size:
+            self._ready.set()
+    
+    async def take(self, batch_size: int, interval: float) -> Tuple[List[str], List[dict]]:
+        # Ждем первую строку, затем добираем пакет не дольше interval
+        self._batch_size = 1
+        if not self._rows:
+            self._ready.clear()
+            await self._ready.wait()
+        if len(self._rows) < batch_size:
+            self._batch_size = batch_size
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+        
+        batch = self._rows[:batch_size]
+        del self._rows[:batch_size]
+        return [], batch
+    
+    async def drain(self) -> List[dict]:
+        rows, self._rows = self._rows, []
+        return rows
+
+
+class RedisWriteQueue(WriteQueue):
+    """Redis Stream с группой потребителей: записи переживают перезапуск процесса.
+
+    Запись удаляется из потока только после коммита в БД. Записи упавших
+    процессов забирает любой живой через XAUTOCLAIM; повторная вставка
+    безопасна, так как id строк назначены заранее (ON CONFLICT DO NOTHING).
+    """
+    
+    def __init__(self, url: str, claim_idle: float = 60.0):
+        self.client = redis.from_url(url, decode_responses=True)
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self.claim_idle_ms = int(claim_idle * 1000)
+        self._group_ready = False
+    
+    async def _ensure_group(self):
+        if self._group_ready:
+            return
+        try:
+            await self.client.xgroup_create(STREAM_KEY, STREAM_GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+    
+    async def put(self, rows: List[dict]):
+        await self.client.xadd(STREAM_KEY, {"rows": json.dumps(rows, default=datetime.isoformat)})
+    
+    @staticmethod
+    def _decode(entries) -> Tuple[List[str], List[dict]]:
+        tokens, rows = [], []
+        for entry_id, fields in entries:
+            tokens.append(entry_id)
+            for row in json.loads(fields["rows"]):
+                row["created_at"] = datetime.fromisoformat(row["created_at"])
+                rows.append(row)
+        return tokens, rows
+    
+    async def take(self, batch_size: int, interval: float) -> Tuple[List[str], List[dict]]:
+        await self._ensure_group()
+        
+        # Сначала записи, которые давно висят у других (упавших) потребителей
+        _, claimed, *_ = await self.client.xautoclaim(
+            STREAM_KEY, STREAM_GROUP, self.consumer, self.claim_idle_ms, count=batch_size
+        )
+        tokens, rows = self._decode(claimed)
+        
+        deadline = time.monotonic() + interval
+        while len(rows) < batch_size:
+            # Пока пакет пуст, ждем подольше; начатый добираем до дедлайна
+            block = 1000 if not rows else int((deadline - time.monotonic()) * 1000)
+            if block <= 0:
+                break
+            response = await self.client.xreadgroup(
+                STREAM_GROUP, self.consumer, {STREAM_KEY: ">"}, count=batch_size - len(rows), block=block
+            )
+            if not response:
+                if rows:
+                    break
+                continue
+            entry_tokens, entry_rows = self._decode(response[0][1])
+            tokens.extend(entry_tokens)
+            rows.extend(entry_rows)
+        return tokens, rows
+    
+    async def ack(self, tokens: List[str]):
+        if not tokens:
+            return
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.xack(STREAM_KEY, STREAM_GROUP, *tokens)
+            pipe.xdel(STREAM_KEY, *tokens)
+            await pipe.execute()
+    
+    async def dead_letter(self, rows: List[dict]):
+        await self.client.xadd(DEAD_LETTER_KEY, {"rows": json.dumps(rows, default=datetime.isoformat)})
+    
+    async def close(self):
+        await self.client.aclose()
+
+
+class MessageWriter:
+    """Отложенная (write-behind) запись сообщений чата.
+
+    Запрос получает id из последовательности, кладет строки в очередь и сразу
+    отвечает; фоновый сброс вставляет их пакетами одним executemany. Пока
+    строки не в БД, ``pending`` отдает их истории чата (read-your-writes).
+    С Redis оверлей видит только процесс, принявший сообщение; записи,
+    вставленные другими процессами, вычищаются из него по ``overlay_ttl``.
+    """
+    
+    def __init__(self, queue: Optional[WriteQueue] = None):
+        if queue is None:
+            queue = RedisWriteQueue(settings.redis_url) if settings.message_queue_backend == "redis" else MemoryWriteQueue()
+        self.queue = queue
+        self._overlay: Dict[int, Dict[int, Tuple[Message, float]]] = {}
+        self._overlay_size = 0
+        self._in_hand: List[dict] = []
+        self._task: Optional[asyncio.Task] = None
+        self.flushed = 0
+        self.batches = 0
+        self.rejected = 0
+    
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+    
+    async def save(self, db: AsyncSession, messages: List[Message]) -> bool:
+        """Назначает id и ставит сообщения в очередь; False - записать напрямую.
+
+        Прямая запись нужна, когда очередь недоступна или отстала больше
+        чем на ``message_max_pending`` строк: это естественное торможение
+        запросов вместо неограниченного роста памяти.
+        """
+        result = await db.execute(ALLOCATE_IDS_SQL, {"count": len(messages)})
+        now = datetime.utcnow()
+        for message, message_id in zip(messages, sorted(result.scalars().all())):
+            message.id = message_id
+            message.created_at = now
+        
+        if self._overlay_size >= settings.message_max_pending:
+            logger.warning(f"Message write queue is {self._overlay_size} rows behind, writing directly")
+            return False
+        try:
+            await self.queue.put([_to_row(message) for message in messages])
+        except RedisError as e:
+            logger.warning(f"Message write queue unavailable, writing directly: {e}")
+            return False
+        
+        enqueued_at = time.monotonic()
+        for message in messages:
+            self._overlay.setdefault(message.chat_id, {})[message.id] = (message, enqueued_at)
+        self._overlay_size += len(messages)
+        return True
+    
+    def pending(self, chat_id: int) -> List[Message]:
+        """Сообщения чата, еще не записанные в БД"""
+        entries = self._overlay.get(chat_id)
+        if not entries:
+            return []
+        return [message for message, _ in entries.values()]
+    
+    def _forget(self, rows: List[dict]):
+        for row in rows:
+            entries = self._overlay.get(row["chat_id"])
+            if entries and entries.pop(row["id"], None) is not None:
+                self._overlay_size -= 1
+                if not entries:
+                    del self._overlay[row["chat_id"]]
+    
+    def _prune_overlay(self):
+        # Только для общей очереди: чужие процессы не сообщают о вставке наших строк
+        if not isinstance(self.queue, RedisWriteQueue) or not self._overlay_size:
+            return
+        expired_before = time.monotonic() - settings.message_overlay_ttl
+        self._forget([
+            {"chat_id": chat_id, "id": message_id}
+            for chat_id, entries in self._overlay.items()
+            for message_id, (_, enqueued_at) in entries.items()
+            if enqueued_at < expired_before
+        ])
+    
+    @staticmethod
+    async def _insert(rows: List[dict]):
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                insert(Message.__table__).on_conflict_do_nothing(index_elements=["id"]),
+                rows
+            )
+            await db.commit()
+    
+    async def _insert_valid(self, rows: List[dict]) -> List[dict]:
+        """Вставка с делением пакета пополам при ошибке строки; возвращает отвергнутые БД строки.
+
+        Временные ошибки (соединение, таймаут) пробрасываются: пакет повторяется
+        целиком, уже вставленные части пропускаются по id.
+        """
+        try:
+            await self._insert(rows)
+            return []
+        except ROW_ERRORS as e:
+            if len(rows) == 1:
+                logger.error(f"Message {rows[0]['id']} for chat {rows[0]['chat_id']} rejected by database: {e}")
+                return rows
+        middle = len(rows) // 2
+        return await self._insert_valid(rows[:middle]) + await self._insert_valid(rows[middle:])
+    
+    async def _reject(self, rows: List[dict]):
+        self.rejected += len(rows)
+        try:
+            await self.queue.dead_letter(rows)
+        except RedisError as e:
+            logger.warning(f"Failed to dead-letter {len(rows)} messages: {e}")
+    
+    async def _flush_loop(self):
+        while True:
+            tokens, rows = await self.queue.take(settings.message_flush_batch, settings.message_flush_interval)
+            self._prune_overlay()
+            if not rows:
+                continue
+            
+            self._in_hand = rows
+            attempt = 0
+            while True:
+                try:
+                    rejected = await self._insert_valid(rows)
+                    break
+                except Exception as e:
+                    # Временная ошибка: пакет не выбрасываем, повторяем, пока БД не примет
+                    attempt += 1
+                    delay = min(0.1 * 2 ** attempt, 10.0)
+                    logger.error(f"Error flushing {len(rows)} messages (attempt {attempt}), retry in {delay:.1f}s: {e}")
+                    await asyncio.sleep(delay)
+            self._in_hand = []
+            if rejected:
+                await self._reject(rejected)
+            
+            try:
+                await self.queue.ack(tokens)
+            except RedisError as e:
+                # Неподтвержденные записи вставятся повторно и будут пропущены по id
+                logger.warning(f"Failed to ack flushed messages: {e}")
+            self._forget(rows)
+            self.flushed += len(rows) - len(rejected)
+            self.batches += 1
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+            logger.info(f"Message write-behind started ({type(self.queue).__name__})")
+    
+    async def close(self):
+        """Остановка сброса и запись всего, что осталось в памяти"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        rows = self._in_hand + await self.queue.drain()
+        self._in_hand = []
+        if rows:
+            try:
+                rejected = await self._insert_valid(rows)
+                if rejected:
+                    await self._reject(rejected)
+                self._forget(rows)
+                self.flushed += len(rows) - len(rejected)
+            except Exception as e:
+                logger.error(f"Lost {len(rows)} unflushed messages on shutdown: {e}")
+        await self.queue.close()
+
+
+message_writer = MessageWriter()
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+from sqlalchemy import update
+
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.models.database import User, UserRole
+
+logger = logging.getLogger(__name__)
+
+# Проверка и инкремент одной операцией: два параллельных запроса не проскочат лимит
+CONSUME_SCRIPT = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+if used >= tonumber(ARGV[1]) then
+    return -1
+end
+used = redis.call('INCR', KEYS[1])
+if used == 1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return used
+"""
+
+# Счетчик дня живет чуть дольше суток, чтобы его успели сбросить в БД
+KEY_TTL_SECONDS = 26 * 60 * 60
+
+
+class QuotaStore(ABC):
+    """Хранилище дневных счетчиков сообщений"""
+    
+    @abstractmethod
+    async def consume(self, key: str, limit: int, ttl: int) -> Optional[int]:
+        """Новое значение счетчика или None, если лимит исчерпан"""
+    
+    @abstractmethod
+    async def release(self, key: str):
+        """Возврат одного сообщения (ответ не был выдан)"""
+    
+    @abstractmethod
+    async def get_many(self, keys: List[str]) -> List[int]:
+        pass
+    
+    async def close(self):
+        pass
+
+
+class RedisQuotaStore(QuotaStore):
+    def __init__(self, url: str):
+        self.client = redis.from_url(url, decode_responses=True)
+        self._consume = self.client.register_script(CONSUME_SCRIPT)
+    
+    async def consume(self, key: str, limit: int, ttl: int) -> Optional[int]:
+        used = await self._consume(keys=[key], args=[limit, ttl])
+        return None if used < 0 else used
+    
+    async def release(self, key: str):
+        # DECR на отсутствующем ключе создал бы -1 без TTL
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.decr(key)
+            pipe.expire(key, KEY_TTL_SECONDS)
+            await pipe.execute()
+    
+    async def get_many(self, keys: List[str]) -> List[int]:
+        if not keys:
+            return []
+        return [int(value or 0) for value in await self.client.mget(keys)]
+    
+    async def close(self):
+        await self.client.aclose()
+
+
+class MemoryQuotaStore(QuotaStore):
+    """Счетчики в памяти процесса: для тестов и запуска без Redis"""
+    
+    def __init__(self):
+        self._counters: Dict[str, Tuple[int, float]] = {}
+    
+    def _get(self, key: str) -> int:
+        item = self._counters.get(key)
+        if item is None:
+            return 0
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            del self._counters[key]
+            return 0
+        return value
+    
+    async def consume(self, key: str, limit: int, ttl: int) -> Optional[int]:
+        used = self._get(key)
+        if used >= limit:
+            return None
+        expires_at = self._counters[key][1] if used else time.monotonic() + ttl
+        self._counters[key] = (used + 1, expires_at)
+        return used + 1
+    
+    async def release(self, key: str):
+        used = self._get(key)
+        if used:
+            self._counters[key] = (used - 1, self._counters[key][1])
+    
+    async def get_many(self, keys: List[str]) -> List[int]:
+        return [self._get(key) for key in keys]
+
+
+class MessageQuota:
+    """Дневной лимит сообщений пользователя, общий для веба и бота.
+
+    Проверка и списание выполняются одной атомарной операцией над счетчиком
+    ``quota:<дата>:<user_id>``. Строка ``user`` на пути запроса не трогается:
+    ``messages_used_today`` обновляется фоновым сбросом для отчетности.
+    """
+    
+    def __init__(self, store: Optional[QuotaStore] = None):
+        if store is None:
+            store = RedisQuotaStore(settings.redis_url) if settings.quota_backend == "redis" else MemoryQuotaStore()
+        self.store = store
+        self._fallback: Optional[MemoryQuotaStore] = None
+        self._dirty: Set[Tuple[int, date]] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+    
+    @staticmethod
+    def limit_for(user: User) -> int:
+        return settings.premium_messages_per_day if user.role == UserRole.PREMIUM else settings.free_messages_per_day
+    
+    @staticmethod
+    def _key(user_id: int, day: date) -> str:
+        return f"quota:{day.isoformat()}:{user_id}"
+    
+    def _fallback_store(self) -> QuotaStore:
+        # Redis недоступен: лимит продолжает действовать в пределах процесса
+        if self._fallback is None:
+            self._fallback = MemoryQuotaStore()
+        return self._fallback
+    
+    async def try_consume(self, user: User) -> bool:
+        """Списывает одно сообщение; False, если дневной лимит исчерпан"""
+        day = datetime.utcnow().date()
+        key = self._key(user.id, day)
+        limit = self.limit_for(user)
+        try:
+            used = await self.store.consume(key, limit, KEY_TTL_SECONDS)
+        except RedisError as e:
+            logger.warning(f"Quota store unavailable, using in-process counters: {e}")
+            used = await self._fallback_store().consume(key, limit, KEY_TTL_SECONDS)
+        
+        if used is None:
+            return False
+        self._dirty.add((user.id, day))
+        return True
+    
+    async def refund(self, user_id: int):
+        """Возврат списанного сообщения, если ответ не удалось выдать"""
+        key = self._key(user_id, datetime.utcnow().date())
+        try:
+            await self.store.release(key)
+        except RedisError as e:
+            logger.warning(f"Quota store unavailable, using in-process counters: {e}")
+            await self._fallback_store().release(key)
+    
+    async def used_today(self, user_id: int) -> int:
+        key = self._key(user_id, datetime.utcnow().date())
+        try:
+            return (await self.store.get_many([key]))[0]
+        except RedisError:
+            return (await self._fallback_store().get_many([key]))[0]
+    
+    async def flush(self):
+        """Запись счетчиков измененных пользователей в user.messages_used_today"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        
+        today = datetime.utcnow().date()
+        # Вчерашние счетчики уже не нужны в отчете о текущем дне
+        items = [(user_id, day) for user_id, day in dirty if day == today]
+        if not items:
+            return
+        
+        try:
+            counts = await self.store.get_many([self._key(user_id, day) for user_id, day in items])
+            now = datetime.utcnow()
+            async with AsyncSessionLocal() as db:
+                await db.execute(update(User), [
+                    {"id": user_id, "messages_used_today": count, "last_message_date": now}
+                    for (user_id, _), count in zip(items, counts)
+                ])
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Error flushing message quota: {e}")
+            self._dirty.update(items)
+    
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(settings.quota_flush_interval)
+            await self.flush()
+    
+    def start(self):
+        """Запуск периодического сброса счетчиков в БД"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+    
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        await self.store.close()
+
+
+message_quota = MessageQuota()
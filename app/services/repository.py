@@ -0,0 +1,162 @@
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from app.models.database import Character, Chat, Message, User
+from app.services.message_writer import message_writer
+
+
+async def upsert_telegram_user(
+    db: AsyncSession,
+    telegram_id: int,
+    username: Optional[str],
+    first_name: Optional[str],
+    last_name: Optional[str]
+) -> User:
+    """Регистрация пользователя Telegram или обновление его профиля.
+
+    Один запрос INSERT ... ON CONFLICT DO UPDATE ... RETURNING: без гонки
+    между проверкой и вставкой при повторном /start.
+    """
+    statement = insert(User).values(
+        telegram_id=telegram_id,
+        username=username,
+        first_name=first_name,
+        last_name=last_name
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[User.telegram_id],
+        set_={
+            "username": statement.excluded.username,
+            "first_name": statement.excluded.first_name,
+            "last_name": statement.excluded.last_name,
+        }
+    ).returning(User)
+    
+    result = await db.execute(
+        select(User).from_statement(statement),
+        execution_options={"populate_existing": True}
+    )
+    user = result.scalar_one()
+    await db.commit()
+    return user
+
+
+async def get_user_by_telegram_id(db: AsyncSession, telegram_id: int) -> Optional[User]:
+    result = await db.execute(select(User).where(User.telegram_id == telegram_id))
+    return result.scalar_one_or_none()
+
+
+async def get_user_with_latest_chat(db: AsyncSession, telegram_id: int) -> Tuple[Optional[User], Optional[Chat]]:
+    """Пользователь и его последний чат одним запросом (по индексу user_id, created_at)"""
+    latest = aliased(Chat)
+    latest_chat_id = (
+        select(latest.id)
+        .where(latest.user_id == User.id)
+        .order_by(latest.created_at.desc())
+        .limit(1)
+        .correlate(User)
+        .scalar_subquery()
+    )
+    result = await db.execute(
+        select(User, Chat)
+        .outerjoin(Chat, Chat.id == latest_chat_id)
+        .where(User.telegram_id == telegram_id)
+    )
+    row = result.first()
+    if row is None:
+        return None, None
+    return row[0], row[1]
+
+
+async def get_user_chat(db: AsyncSession, chat_id: int, user_id: int) -> Optional[Chat]:
+    """Чат, если он принадлежит пользователю"""
+    result = await db.execute(select(Chat).where(Chat.id == chat_id, Chat.user_id == user_id))
+    return result.scalar_one_or_none()
+
+
+async def list_user_chats(db: AsyncSession, user_id: int) -> List[Chat]:
+    result = await db.execute(
+        select(Chat).where(Chat.user_id == user_id).order_by(Chat.created_at.desc())
+    )
+    return list(result.scalars().all())
+
+
+async def create_chat(db: AsyncSession, user_id: int, character_id: int, title: str) -> Chat:
+    chat = Chat(user_id=user_id, character_id=character_id, title=title)
+    db.add(chat)
+    await db.commit()
+    return chat
+
+
+async def list_characters(db: AsyncSession) -> List[Character]:
+    result = await db.execute(select(Character).order_by(Character.id))
+    return list(result.scalars().all())
+
+
+async def get_recent_messages(
+    db: AsyncSession,
+    chat_id: int,
+    limit: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None
+) -> List[Message]:
+    """Страница истории чата по keyset-курсору, в хронологическом порядке.
+
+    Возвращает не более ``limit`` последних сообщений с id < before_id
+    (и id > after_id, если задан) одним индексным запросом.
+    """
+    # Снимок до запроса: строка, вставленная между ними, попадет хотя бы в одно из двух
+    pending = message_writer.pending(chat_id)
+    
+    query = select(Message).where(Message.chat_id == chat_id)
+    if before_id is not None:
+        query = query.where(Message.id < before_id)
+    if after_id is not None:
+        query = query.where(Message.id > after_id)
+    
+    result = await db.execute(query.order_by(Message.id.desc()).limit(limit))
+    messages = list(result.scalars().all())
+    messages.reverse()
+    
+    if pending:
+        # Еще не записанные сообщения (write-behind) видны автору сразу
+        merged = {message.id: message for message in messages}
+        for message in pending:
+            if (before_id is None or message.id < before_id) and (after_id is None or message.id > after_id):
+                merged.setdefault(message.id, message)
+        messages = [merged[message_id] for message_id in sorted(merged)][-limit:]
+    return messages
+
+
+async def save_exchange(
+    db: AsyncSession,
+    chat_id: int,
+    user_content: str,
+    ai_content: str,
+    tokens_used: Optional[int] = None
+) -> Tuple[Message, Message]:
+    """Сообщение пользователя и ответ персонажа в одной транзакции.
+
+    При включенном write-behind строки уходят в очередь пакетной записи.
+    """
+    user_message = Message(
+        chat_id=chat_id,
+        content=user_content,
+        is_user_message=True
+    )
+    ai_message = Message(
+        chat_id=chat_id,
+        content=ai_content,
+        is_user_message=False,
+        tokens_used=tokens_used
+    )
+    if message_writer.running and await message_writer.save(db, [user_message, ai_message]):
+        return user_message, ai_message
+    
+    db.add_all([user_message, ai_message])
+    await db.commit()
+    return user_message, ai_message
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from typing import List, Optional, Set
+
+from sqlalchemy import select
+
+from app.ai.providers import GenerationRequest, LLMProvider, OpenAIProvider
+from app.ai.scheduler import ScheduledProvider
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.models.database import Chat, Message
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SYSTEM_PROMPT = """Ты ведешь краткое содержание переписки пользователя с персонажем.
+Сохраняй факты о пользователе, его предпочтения, договоренности и важные события.
+Пиши на русском языке, в третьем лице, не длиннее 150 слов.
+Отвечай только текстом содержания, без вступлений."""
+
+
+class ConversationSummarizer:
+    """Фоновое сворачивание старых сообщений чата в хранимую сводку"""
+    
+    def __init__(self, provider: Optional[LLMProvider] = None, model: Optional[str] = None):
+        if provider is None:
+            provider = ScheduledProvider() if settings.use_ollama else OpenAIProvider()
+        self.provider = provider
+        self.model = model or (settings.ollama_default_model if settings.use_ollama else settings.openai_model)
+        self._running: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+    
+    def schedule(self, chat_id: int):
+        """Запуск обновления сводки в фоне, вне пути запроса"""
+        if not settings.summary_enabled or chat_id in self._running:
+            return
+        self._running.add(chat_id)
+        task = asyncio.create_task(self._run(chat_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, chat_id: int):
+        try:
+            await self.update_summary(chat_id)
+        except Exception as e:
+            logger.error(f"Error updating summary for chat {chat_id}: {e}")
+        finally:
+            self._running.discard(chat_id)
+    
+    async def update_summary(self, chat_id: int) -> bool:
+        """Сворачивает накопившиеся сообщения, если их набралось не меньше K"""
+        async with AsyncSessionLocal() as db:
+            chat = await db.get(Chat, chat_id)
+            if not chat:
+                return False
+            
+            result = await db.execute(
+                select(Message)
+                .where(Message.chat_id == chat_id, Message.id > (chat.summary_message_id or 0))
+                .order_by(Message.id)
+            )
+            pending = result.scalars().all()
+            
+            # Последние сообщения остаются в промпте дословно
+            keep = settings.summary_keep_recent
+            foldable = pending[:-keep] if keep else pending
+            if len(foldable) < settings.summary_every_messages:
+                return False
+            
+            summary = await self._summarize(chat.summary, foldable)
+            if not summary:
+                return False
+            
+            chat.summary = summary
+            chat.summary_message_id = foldable[-1].id
+            await db.commit()
+            logger.info(f"Chat {chat_id}: folded {len(foldable)} messages into summary")
+            return True
+    
+    async def _summarize(self, previous_summary: Optional[str], messages: List[Message]) -> str:
+        transcript = "\n".join(
+            f"{'Пользователь' if msg.is_user_message else 'Персонаж'}: {msg.content}"
+            for msg in messages
+        )
+        prompt = (
+            f"Текущее краткое содержание:\n{previous_summary or 'пока нет'}\n\n"
+            f"Новые сообщения:\n{transcript}\n\n"
+            "Обнови краткое содержание с учетом новых сообщений."
+        )
+        return await self.provider.generate(GenerationRequest(
+            model=self.model,
+            system_prompt=SUMMARY_SYSTEM_PROMPT,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=settings.summary_max_tokens,
+            temperature=0.3
+        ))
+
+
+summarizer = ConversationSummarizer()
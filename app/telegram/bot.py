@@ -1,5 +1,5 @@
 import logging
-from datetime import datetime, timedelta
+from typing import Optional
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
@@ -8,34 +8,47 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from app.core.config import settings
 from app.core.database import AsyncSessionLocal
-from app.models.database import User, Character, Chat, Message, UserRole
+from app.models.database import UserRole
 from app.ai.service import AIService
+from app.services.admission import AdmissionRejected, admission_controller
+from app.services.character_catalog import character_catalog
+from app.services.idempotency import idempotency_registry
+from app.services.memory import semantic_memory
+from app.services.quota import message_quota
+from app.services.repository import (
+    create_chat,
+    get_recent_messages,
+    get_user_by_telegram_id,
+    get_user_with_latest_chat,
+    save_exchange,
+    upsert_telegram_user
+)
+from app.services.summarizer import summarizer
+from app.telegram.ratelimit import outbound_limiter, reset_send_priority, set_send_priority
+from app.telegram.streaming import StreamingReply
+from app.telegram.webhook import update_scheduler
 
 logger = logging.getLogger(__name__)
 
 ai_service = AIService()
 bot = Bot(token=settings.telegram_token)
+bot.session.middleware(outbound_limiter)
 dp = Dispatcher()
 
 
 async def start(message: types.Message):
     user = message.from_user
-    async with AsyncSessionLocal() as db:
-        
-        try:
-            db_user = db.query(User).filter(User.telegram_id == user.id).first()
-            
-            if not db_user:
-                db_user = User(
-                    telegram_id=user.id,
-                    username=user.username,
-                    first_name=user.first_name,
-                    last_name=user.last_name
-                )
-                db.add(db_user)
-                db.commit()
-            
-            welcome_text = f"""Привет, {user.first_name}! 👋
+    try:
+        async with AsyncSessionLocal() as db:
+            await upsert_telegram_user(db, user.id, user.username, user.first_name, user.last_name)
+        await show_main_menu(message, user.first_name)
+    except Exception as e:
+        logger.error(f"Error in start command: {e}")
+        await message.answer("Произошла ошибка. Попробуйте позже.")
+
+
+async def show_main_menu(message: types.Message, first_name: Optional[str]):
+    welcome_text = f"""Привет, {first_name}! 👋
 
     Добро пожаловать в AI Girls - мир эротических AI персонажей! 
 
@@ -47,27 +60,22 @@ async def start(message: types.Message):
     💳 Получи премиум для большего количества сообщений
 
     Выбери действие:"""
-            
-            builder = InlineKeyboardBuilder()
-            builder.add(types.InlineKeyboardButton(text="👥 Персонажи", callback_data="characters"))
-            builder.add(types.InlineKeyboardButton(text="💬 Мои чаты", callback_data="my_chats"))
-            builder.add(types.InlineKeyboardButton(text="💳 Премиум", callback_data="premium"))
-            builder.add(types.InlineKeyboardButton(text="ℹ️ Помощь", callback_data="help"))
-            builder.adjust(2)
-            
-            await message.answer(welcome_text, reply_markup=builder.as_markup())
-            
-        except Exception as e:
-            logger.error(f"Error in start command: {e}")
-            await message.answer("Произошла ошибка. Попробуйте позже.")
+    
+    builder = InlineKeyboardBuilder()
+    builder.add(types.InlineKeyboardButton(text="👥 Персонажи", callback_data="characters"))
+    builder.add(types.InlineKeyboardButton(text="💬 Мои чаты", callback_data="my_chats"))
+    builder.add(types.InlineKeyboardButton(text="💳 Премиум", callback_data="premium"))
+    builder.add(types.InlineKeyboardButton(text="ℹ️ Помощь", callback_data="help"))
+    builder.adjust(2)
+    
+    await message.answer(welcome_text, reply_markup=builder.as_markup())
 
 
 async def show_characters(callback: types.CallbackQuery):
     await callback.answer()
     
-    db = SessionLocal()
     try:
-        characters = db.query(Character).filter(Character.is_active == True).all()
+        characters = await character_catalog.active()
         
         if not characters:
             await callback.message.edit_text("Персонажи временно недоступны.")
@@ -89,12 +97,10 @@ async def show_characters(callback: types.CallbackQuery):
         builder.adjust(1)
         
         await callback.message.edit_text(text, reply_markup=builder.as_markup())
-        
+    
     except Exception as e:
         logger.error(f"Error showing characters: {e}")
         await callback.message.edit_text("Произошла ошибка. Попробуйте позже.")
-    finally:
-        db.close()
 
 
 async def start_chat(callback: types.CallbackQuery):
@@ -103,12 +109,12 @@ async def start_chat(callback: types.CallbackQuery):
     character_id = int(callback.data.split("_")[-1])
     user_id = callback.from_user.id
     
-    db = SessionLocal()
     try:
-        character = db.query(Character).filter(Character.id == character_id).first()
-        user = db.query(User).filter(User.telegram_id == user_id).first()
+        character = await character_catalog.get(character_id)
+        async with AsyncSessionLocal() as db:
+            user = await get_user_by_telegram_id(db, user_id)
         
-        if not character or not user:
+        if not character or not character.is_active or not user:
             await callback.message.edit_text("Персонаж не найден.")
             return
         
@@ -125,13 +131,8 @@ async def start_chat(callback: types.CallbackQuery):
             )
             return
         
-        chat = Chat(
-            user_id=user.id,
-            character_id=character.id,
-            title=f"Чат с {character.name}"
-        )
-        db.add(chat)
-        db.commit()
+        async with AsyncSessionLocal() as db:
+            await create_chat(db, user.id, character.id, f"Чат с {character.name}")
         
         welcome_msg = f"""💕 Привет! Я {character.name}!
 
@@ -140,112 +141,132 @@ async def start_chat(callback: types.CallbackQuery):
 Давай познакомимся поближе... 😊
 
 Просто напиши мне что-нибудь!"""
-        
+
         builder = InlineKeyboardBuilder()
         builder.add(types.InlineKeyboardButton(text="🔙 К персонажам", callback_data="characters"))
         
         await callback.message.edit_text(welcome_msg, reply_markup=builder.as_markup())
-        
+    
     except Exception as e:
         logger.error(f"Error starting chat: {e}")
         await callback.message.edit_text("Произошла ошибка. Попробуйте позже.")
-    finally:
-        db.close()
+
+
+def busy_text(rejection: AdmissionRejected) -> str:
+    if rejection.reason == "user_busy":
+        return "✋ Я еще отвечаю на предыдущее сообщение, дождитесь ответа."
+    return f"⏳ Сейчас слишком много собеседников. Попробуйте еще раз через {rejection.retry_after_seconds} с."
 
 
 async def handle_message(message: types.Message):
     user_id = message.from_user.id
     message_text = message.text
     
-    db = SessionLocal()
+    # То же сообщение, доставленное повторно, не должно запускать вторую генерацию
+    if idempotency_registry.seen(("telegram-message", message.chat.id, message.message_id)):
+        logger.info(f"Duplicate message {message.message_id} in chat {message.chat.id} ignored")
+        return
+    
+    priority_token = None
     try:
-        user = db.query(User).filter(User.telegram_id == user_id).first()
-        if not user:
-            await message.answer("Пожалуйста, начните с /start")
-            return
-        
-        current_chat = db.query(Chat).filter(
-            Chat.user_id == user.id
-        ).order_by(Chat.created_at.desc()).first()
-        
-        if not current_chat:
-            builder = InlineKeyboardBuilder()
-            builder.add(types.InlineKeyboardButton(text="👥 Персонажи", callback_data="characters"))
+        # Чтение укладывается в два запроса; соединение не держится, пока модель генерирует ответ
+        async with AsyncSessionLocal() as db:
+            user, current_chat = await get_user_with_latest_chat(db, user_id)
+            if not user:
+                await message.answer("Пожалуйста, начните с /start")
+                return
+            priority_token = set_send_priority(user.role != UserRole.FREE)
             
-            await message.answer(
-                "Выберите персонажа для начала чата!",
-                reply_markup=builder.as_markup()
-            )
-            return
-        
-        if not await check_message_limit(user, db):
-            builder = InlineKeyboardBuilder()
-            builder.add(types.InlineKeyboardButton(text="💳 Получить премиум", callback_data="premium"))
+            character = await character_catalog.get(current_chat.character_id) if current_chat else None
+            if not character:
+                builder = InlineKeyboardBuilder()
+                builder.add(types.InlineKeyboardButton(text="👥 Персонажи", callback_data="characters"))
+                
+                await message.answer(
+                    "Выберите персонажа для начала чата!",
+                    reply_markup=builder.as_markup()
+                )
+                return
             
-            await message.answer(
-                f"Достигнут лимит сообщений на сегодня ({settings.free_messages_per_day}).\n"
-                "Получите премиум для большего количества сообщений!",
-                reply_markup=builder.as_markup()
+            if not await message_quota.try_consume(user):
+                builder = InlineKeyboardBuilder()
+                builder.add(types.InlineKeyboardButton(text="💳 Получить премиум", callback_data="premium"))
+                
+                await message.answer(
+                    f"Достигнут лимит сообщений на сегодня ({settings.free_messages_per_day}).\n"
+                    "Получите премиум для большего количества сообщений!",
+                    reply_markup=builder.as_markup()
+                )
+                return
+            
+            recent_messages = await get_recent_messages(
+                db, current_chat.id, settings.prompt_history_fetch_limit, after_id=current_chat.summary_message_id
             )
-            return
         
-        user_message = Message(
-            chat_id=current_chat.id,
-            content=message_text,
-            is_user_message=True
-        )
-        db.add(user_message)
-        
-        character = current_chat.character
         conversation_history = [
             {
                 "content": msg.content,
                 "is_user_message": msg.is_user_message
             }
-            for msg in current_chat.messages[-10:]
+            for msg in recent_messages
         ]
         
-        await message.answer("💭 Думаю...")
-        
-        ai_response = await ai_service.generate_response(
-            character.personality,
-            character.description,
-            conversation_history,
-            message_text
-        )
-        
-        ai_message = Message(
-            chat_id=current_chat.id,
-            content=ai_response,
-            is_user_message=False,
-            tokens_used=ai_service.count_tokens(ai_response)
-        )
-        db.add(ai_message)
-        
-        user.messages_used_today += 1
-        user.last_message_date = datetime.utcnow()
-        
-        db.commit()
-        
-        await message.answer(ai_response)
-        
+        reply = StreamingReply(message.bot, message.chat.id)
+        try:
+            await reply.start()
+            
+            async with admission_controller.admit(user.id, user.role):
+                # Релевантные сообщения старше тех, что уже попадут в промпт; эмбеддинг запроса
+                # нагружает тот же бэкенд, что и генерация, поэтому ищем только после допуска
+                memories = await semantic_memory.recall(
+                    current_chat.id,
+                    message_text,
+                    before_id=recent_messages[0].id if recent_messages else None
+                )
+                chunks = []
+                served_by = []
+                async for chunk in ai_service.stream_response(
+                    character.personality,
+                    character.description,
+                    conversation_history,
+                    message_text,
+                    chat_id=current_chat.id,
+                    summary=current_chat.summary,
+                    memories=memories,
+                    character_name=character.name,
+                    on_queue=reply.queued,
+                    premium=user.role != UserRole.FREE,
+                    on_provider=served_by.append
+                ):
+                    chunks.append(chunk)
+                    reply.feed("".join(chunks))
+            
+            ai_response = ai_service.post_process(
+                "".join(chunks), served_by[0] if served_by else None, character_name=character.name
+            )
+            await reply.finish(ai_response)
+            
+            async with AsyncSessionLocal() as db:
+                user_message, ai_message = await save_exchange(
+                    db, current_chat.id, message_text, ai_response, ai_service.count_tokens(ai_response)
+                )
+        except AdmissionRejected as e:
+            await message_quota.refund(user.id)
+            await reply.finish(busy_text(e))
+            return
+        except Exception:
+            # Сообщение не сохранено, списанный лимит возвращаем
+            await message_quota.refund(user.id)
+            raise
+        summarizer.schedule(current_chat.id)
+        semantic_memory.index_messages(current_chat.id, [user_message, ai_message])
+    
     except Exception as e:
         logger.error(f"Error handling message: {e}")
         await message.answer("Произошла ошибка. Попробуйте позже.")
     finally:
-        db.close()
-
-
-async def check_message_limit(user: User, db) -> bool:
-    today = datetime.utcnow().date()
-    last_message_date = user.last_message_date.date() if user.last_message_date else None
-    
-    if last_message_date != today:
-        user.messages_used_today = 0
-        db.commit()
-    
-    limit = settings.premium_messages_per_day if user.role == UserRole.PREMIUM else settings.free_messages_per_day
-    return user.messages_used_today < limit
+        if priority_token is not None:
+            reset_send_priority(priority_token)
 
 
 async def show_premium(callback: types.CallbackQuery):
@@ -260,7 +281,7 @@ async def show_premium(callback: types.CallbackQuery):
 • Специальным функциям
 
 Выберите план:"""
-    
+
     builder = InlineKeyboardBuilder()
     builder.add(types.InlineKeyboardButton(text="💳 Месячная подписка - $9.99", callback_data="subscribe_monthly"))
     builder.add(types.InlineKeyboardButton(text="💳 Годовая подписка - $99.99", callback_data="subscribe_yearly"))
@@ -318,7 +339,9 @@ async def handle_callback(callback: types.CallbackQuery):
     data = callback.data
     
     if data == "start":
-        await start(callback.message)
+        # callback.message отправлено ботом: пользователь берется из callback
+        await callback.answer()
+        await show_main_menu(callback.message, callback.from_user.first_name)
     elif data == "characters":
         await show_characters(callback)
     elif data.startswith("chat_with_"):
@@ -331,21 +354,49 @@ async def handle_callback(callback: types.CallbackQuery):
         await handle_subscription(callback)
 
 
+_handlers_registered = False
+
+
 def register_handlers():
+    global _handlers_registered
+    if _handlers_registered:
+        return
     dp.message.register(start, Command("start"))
     dp.callback_query.register(handle_callback)
     dp.message.register(handle_message, lambda message: message.text and not message.text.startswith('/'))
+    _handlers_registered = True
 
 
 async def start_bot():
+    """Запуск бота в режиме long polling"""
     if not settings.telegram_token:
         logger.error("Telegram token not set!")
         return
     
     register_handlers()
     
-    if settings.telegram_webhook_url:
-        await bot.set_webhook(url=settings.telegram_webhook_url)
-        await dp.start_polling(bot, webhook_url=settings.telegram_webhook_url)
-    else:
-        await dp.start_polling(bot)
+    # Webhook и polling взаимоисключающие: снимаем webhook, если он был установлен
+    await bot.delete_webhook()
+    await dp.start_polling(bot)
+
+
+async def start_webhook():
+    """Регистрация webhook и запуск воркеров, обрабатывающих обновления из очереди"""
+    if not settings.telegram_token or not settings.telegram_webhook_url:
+        logger.error("Telegram token or webhook URL not set!")
+        return
+    
+    register_handlers()
+    update_scheduler.start(bot, dp)
+    await bot.set_webhook(
+        url=settings.telegram_webhook_url,
+        secret_token=settings.telegram_webhook_secret,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=settings.telegram_webhook_max_connections
+    )
+    logger.info(f"Telegram webhook set: {settings.telegram_webhook_url}")
+
+
+async def stop_webhook():
+    await update_scheduler.stop()
+    await bot.session.close()
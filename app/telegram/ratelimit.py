@@ -0,0 +1,269 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import statistics
+import time
+from collections import deque
+from contextvars import ContextVar, Token
+from typing import Deque, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, SendChatAction, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_PREMIUM = 0
+PRIORITY_DEFAULT = 1
+
+_send_priority: ContextVar[int] = ContextVar("telegram_send_priority", default=PRIORITY_DEFAULT)
+
+
+def set_send_priority(premium: bool) -> Token:
+    """Приоритет исходящих запросов текущего обработчика.
+
+    Возвращенный токен нужно передать в ``reset_send_priority`` по окончании:
+    воркер планировщика обновлений живет долго, и приоритет одного
+    пользователя не должен достаться следующему.
+    """
+    return _send_priority.set(PRIORITY_PREMIUM if premium else PRIORITY_DEFAULT)
+
+
+def reset_send_priority(token: Token):
+    _send_priority.reset(token)
+
+
+class TokenBucket:
+    """Ведро токенов: ``rate`` запросов в секунду с запасом ``capacity``"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self) -> float:
+        """Сколько ждать до свободного токена; 0, если можно отправлять"""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    def take(self):
+        self.tokens -= 1
+    
+    async def acquire(self):
+        while (delay := self.delay()) > 0:
+            await asyncio.sleep(delay)
+        self.take()
+    
+    def block(self, seconds: float):
+        """Пауза по retry_after от Telegram; накопленный запас сгорает"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+    
+    def idle(self) -> bool:
+        self.delay()
+        return self.tokens >= self.capacity
+
+
+class PriorityGate:
+    """Общий лимит запросов к Bot API с очередью по приоритету.
+
+    Пока очередь пуста и токены есть, запрос проходит сразу; иначе ожидающие
+    пропускаются по одному в порядке (приоритет, время постановки).
+    """
+    
+    def __init__(self, rate: float, capacity: float):
+        self.bucket = TokenBucket(rate, capacity)
+        self._heap: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._pump: Optional[asyncio.Task] = None
+    
+    @property
+    def waiting(self) -> int:
+        return len(self._heap)
+    
+    async def acquire(self, priority: int):
+        if not self._heap and self.bucket.delay() <= 0:
+            self.bucket.take()
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), future))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._release())
+        await future
+    
+    async def _release(self):
+        while self._heap:
+            delay = self.bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._heap)
+            # Отмененный ожидающий (обработчик прервали) токен не тратит
+            if future.cancelled():
+                continue
+            self.bucket.take()
+            future.set_result(None)
+
+
+class ChatLane:
+    """Исходящие одного чата: свой лимит и строгий порядок отправки"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.bucket = TokenBucket(rate, capacity)
+        self.lock = asyncio.Lock()
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Слой исходящих запросов бота (middleware сессии aiogram).
+
+    Каждый запрос с ``chat_id`` проходит лимит своего чата (~1 сообщение в
+    секунду, в группах 20 в минуту) и общий лимит бота (~30 в секунду), где
+    премиум-пользователи идут раньше бесплатных. На 429 чат ставится на паузу
+    по ``retry_after`` и запрос повторяется. Статус «печатает» в лимит чата не
+    входит: это не сообщение.
+    """
+    
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: float = 3.0,
+        group_rate_per_minute: float = 20.0,
+        max_retries: int = 3,
+        max_lanes: int = 10000
+    ):
+        # Малый запас: иначе после простоя в первую секунду уйдет почти двойной лимит
+        self.gate = PriorityGate(global_rate, max(1.0, global_rate / 10))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_minute / 60
+        self.max_retries = max_retries
+        self.max_lanes = max_lanes
+        self._lanes: Dict[int, ChatLane] = {}
+        self._wait_times: Deque[float] = deque(maxlen=1000)
+        self._latencies: Deque[float] = deque(maxlen=1000)
+        self.queued = 0
+        self.sent = 0
+        self.rate_limited = 0
+    
+    def _lane(self, chat_id) -> ChatLane:
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            if len(self._lanes) >= self.max_lanes:
+                self._prune()
+            # Отрицательные id и @username - группы и каналы, у них лимит строже
+            if isinstance(chat_id, str) or chat_id < 0:
+                lane = ChatLane(self.group_rate, 1)
+            else:
+                lane = ChatLane(self.chat_rate, self.chat_burst)
+            self._lanes[chat_id] = lane
+        return lane
+    
+    def _prune(self):
+        for chat_id in [
+            chat_id for chat_id, lane in self._lanes.items()
+            if not lane.lock.locked() and lane.bucket.idle()
+        ]:
+            del self._lanes[chat_id]
+    
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType]
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        
+        lane = None if isinstance(method, SendChatAction) else self._lane(chat_id)
+        enqueued_at = time.monotonic()
+        self.queued += 1
+        try:
+            if lane is None:
+                return await self._send(make_request, bot, method, None, enqueued_at)
+            async with lane.lock:
+                return await self._send(make_request, bot, method, lane.bucket, enqueued_at)
+        finally:
+            self.queued -= 1
+    
+    async def _send(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+        bucket: Optional[TokenBucket],
+        enqueued_at: float
+    ) -> Response[TelegramType]:
+        for attempt in range(self.max_retries + 1):
+            if bucket is not None:
+                await bucket.acquire()
+            await self.gate.acquire(_send_priority.get())
+            if attempt == 0:
+                self._wait_times.append(time.monotonic() - enqueued_at)
+            
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.rate_limited += 1
+                logger.warning(
+                    f"Telegram 429 on {type(method).__name__} in chat {method.chat_id}, "
+                    f"retry after {e.retry_after}s (attempt {attempt + 1})"
+                )
+                if attempt == self.max_retries:
+                    raise
+                if bucket is not None:
+                    bucket.block(e.retry_after)
+                else:
+                    await asyncio.sleep(e.retry_after)
+                continue
+            
+            self.sent += 1
+            self._latencies.append(time.monotonic() - enqueued_at)
+            return response
+    
+    @staticmethod
+    def _percentiles(samples: Deque[float]) -> Dict[str, float]:
+        if len(samples) < 2:
+            value = round(samples[0] * 1000, 1) if samples else 0.0
+            return {"p50_ms": value, "p95_ms": value}
+        quantiles = statistics.quantiles(samples, n=20)
+        return {"p50_ms": round(quantiles[9] * 1000, 1), "p95_ms": round(quantiles[18] * 1000, 1)}
+    
+    def stats(self) -> Dict[str, object]:
+        """Глубина очередей и задержки отправки по последним запросам"""
+        return {
+            "queued": self.queued,
+            "global_waiting": self.gate.waiting,
+            "chats": len(self._lanes),
+            "sent": self.sent,
+            "rate_limited": self.rate_limited,
+            "queue_wait": self._percentiles(self._wait_times),
+            "send_latency": self._percentiles(self._latencies),
+        }
+
+
+outbound_limiter = OutboundLimiter(
+    global_rate=settings.telegram_global_rate,
+    chat_rate=settings.telegram_chat_rate,
+    chat_burst=settings.telegram_chat_burst,
+    group_rate_per_minute=settings.telegram_group_rate_per_minute,
+    max_retries=settings.telegram_send_retries
+)
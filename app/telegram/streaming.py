@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.enums import ChatAction
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Лимит длины текста одного сообщения Telegram
+MAX_MESSAGE_LENGTH = 4096
+PLACEHOLDER_TEXT = "💭 Думаю..."
+CURSOR = " ▌"
+
+
+class StreamingReply:
+    """Потоковый ответ в Telegram через редактирование одного сообщения.
+
+    Токены копятся и выводятся правкой заглушки не чаще ``interval`` секунд и
+    только при заметном приросте текста. Если Telegram отвечает RetryAfter,
+    интервал увеличивается до подсказанного значения и затем плавно
+    возвращается к базовому.
+    """
+    
+    def __init__(
+        self,
+        bot: Bot,
+        chat_id: int,
+        interval: Optional[float] = None,
+        min_chars: Optional[int] = None
+    ):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.base_interval = interval if interval is not None else settings.telegram_stream_edit_interval
+        self.interval = self.base_interval
+        self.min_chars = min_chars if min_chars is not None else settings.telegram_stream_min_chars
+        self.message_id: Optional[int] = None
+        self._shown = ""
+        self._last_edit = 0.0
+        self._blocked_until = 0.0
+        self._edit_task: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        """Статус «печатает» и сообщение-заглушка, которое будет дописываться"""
+        try:
+            await self.bot.send_chat_action(self.chat_id, ChatAction.TYPING)
+        except Exception as e:
+            logger.debug(f"Failed to send chat action: {e}")
+        message = await self.bot.send_message(self.chat_id, PLACEHOLDER_TEXT)
+        self.message_id = message.message_id
+        self._last_edit = time.monotonic()
+    
+    def queued(self, position: int, eta: float):
+        """Позиция в очереди генерации вместо заглушки, пока ответ не начался"""
+        now = time.monotonic()
+        if (
+            self.message_id is None
+            or self._shown
+            or (self._edit_task is not None and not self._edit_task.done())
+            or now < self._blocked_until
+            # Первый статус показываем сразу, последующие не чаще обычных правок
+            or (self._edit_task is not None and now - self._last_edit < self.interval)
+        ):
+            return
+        self._last_edit = now
+        self._edit_task = asyncio.create_task(self._edit_status(
+            f"⏳ Много желающих пообщаться. Вы в очереди: {position}, ответ примерно через {max(1, round(eta))} с"
+        ))
+    
+    async def _edit_status(self, text: str):
+        # Статус не считается показанным текстом ответа
+        if await self._edit(text):
+            self._shown = ""
+    
+    def feed(self, text: str):
+        """Новый накопленный текст ответа; правка уходит в фоне, если пора"""
+        now = time.monotonic()
+        if (
+            self.message_id is None
+            or (self._edit_task is not None and not self._edit_task.done())
+            or now < self._blocked_until
+            or now - self._last_edit < self.interval
+            or len(text) - len(self._shown) < self.min_chars
+        ):
+            return
+        self._last_edit = now
+        self._edit_task = asyncio.create_task(self._edit(text[:MAX_MESSAGE_LENGTH - len(CURSOR)] + CURSOR))
+    
+    async def _edit(self, text: str) -> bool:
+        try:
+            await self.bot.edit_message_text(text=text, chat_id=self.chat_id, message_id=self.message_id)
+            self._shown = text
+            # Успешная правка: осторожно возвращаемся к базовой частоте
+            self.interval = max(self.base_interval, self.interval * 0.8)
+            return True
+        except TelegramRetryAfter as e:
+            self.interval = max(self.interval * 2, float(e.retry_after))
+            self._blocked_until = time.monotonic() + e.retry_after
+            logger.warning(f"Telegram edit rate limit in chat {self.chat_id}, retry after {e.retry_after}s")
+        except TelegramBadRequest as e:
+            # «message is not modified» и подобное: текст на экране уже актуален
+            logger.debug(f"Edit skipped in chat {self.chat_id}: {e}")
+        return False
+    
+    async def finish(self, text: str):
+        """Финальный текст: последняя правка и продолжение отдельными сообщениями при переполнении"""
+        if self._edit_task is not None:
+            await asyncio.gather(self._edit_task, return_exceptions=True)
+        
+        text = text or "..."
+        parts = [text[i:i + MAX_MESSAGE_LENGTH] for i in range(0, len(text), MAX_MESSAGE_LENGTH)]
+        
+        if self.message_id is None:
+            await self.bot.send_message(self.chat_id, parts[0])
+        elif parts[0] != self._shown:
+            # Финальную правку нельзя пропустить: ждем, сколько просит Telegram
+            delay = self._blocked_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if not await self._edit(parts[0]):
+                delay = self._blocked_until - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    await self._edit(parts[0])
+        
+        for part in parts[1:]:
+            await self.bot.send_message(self.chat_id, part)
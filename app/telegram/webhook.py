@@ -0,0 +1,129 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, Hashable, List, Optional, Set
+
+from aiogram import Bot, Dispatcher, types
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateScheduler:
+    """Планировщик входящих обновлений Telegram.
+
+    Обновления раскладываются по очередям пользователей (``from_user.id``):
+    внутри пользователя строгий FIFO и не больше одного обновления в работе,
+    между пользователями параллельно, но не больше ``workers`` одновременно.
+    Пользователь с непустой очередью после каждого обновления встает в конец
+    общей очереди готовых, поэтому длинная очередь одного не задерживает других.
+    """
+    
+    def __init__(self, workers: int = 8, queue_size: int = 10000, per_user_limit: int = 5):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.per_user_limit = per_user_limit
+        self._pending: Dict[Hashable, Deque[types.Update]] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._active: Set[Hashable] = set()
+        self._size = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._tasks: List[asyncio.Task] = []
+        self._bot: Optional[Bot] = None
+        self._dp: Optional[Dispatcher] = None
+        self.processed = 0
+        self.dropped = 0
+    
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+    
+    @property
+    def queued(self) -> int:
+        return self._size
+    
+    def start(self, bot: Bot, dp: Dispatcher):
+        if self.running:
+            return
+        self._bot, self._dp = bot, dp
+        self._tasks = [
+            asyncio.create_task(self._worker(index), name=f"telegram-worker-{index}")
+            for index in range(self.workers)
+        ]
+        logger.info(f"Telegram update workers started: {self.workers}")
+    
+    @staticmethod
+    def _user_key(update: types.Update) -> Hashable:
+        user = getattr(update.event, "from_user", None)
+        if user is not None:
+            return user.id
+        # Обновления без пользователя (опросы, статусы чатов) упорядочивать не нужно
+        return ("update", update.update_id)
+    
+    def submit(self, update: types.Update) -> bool:
+        """Постановка обновления в очередь; False, если общая очередь переполнена.
+
+        Если у пользователя уже ``per_user_limit`` необработанных обновлений,
+        новое отбрасывается: повторная доставка его не спасет, а ответы на
+        лавину сообщений пользователю все равно не нужны.
+        """
+        if self._size >= self.queue_size:
+            return False
+        
+        key = self._user_key(update)
+        pending = self._pending.setdefault(key, deque())
+        if len(pending) >= self.per_user_limit:
+            self.dropped += 1
+            logger.warning(f"Dropping update {update.update_id}: user {key} has {len(pending)} queued updates")
+            return True
+        
+        pending.append(update)
+        self._size += 1
+        self._drained.clear()
+        # Пользователь в работе снова встанет в очередь готовых сам, по окончании обработки
+        if len(pending) == 1 and key not in self._active:
+            self._ready.put_nowait(key)
+        return True
+    
+    async def _worker(self, index: int):
+        while True:
+            key = await self._ready.get()
+            pending = self._pending[key]
+            update = pending.popleft()
+            self._size -= 1
+            self._active.add(key)
+            try:
+                await self._dp.feed_update(self._bot, update)
+            except Exception as e:
+                logger.error(f"Error processing update {update.update_id} in worker {index}: {e}")
+            finally:
+                self.processed += 1
+                self._active.discard(key)
+                if pending:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+                    if self._size == 0 and not self._active:
+                        self._drained.set()
+    
+    async def stop(self, timeout: float = 10.0):
+        """Дообработка очередей и остановка воркеров"""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Telegram update queue not drained, dropping {self._size} updates")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+update_scheduler = UpdateScheduler(
+    workers=settings.telegram_webhook_workers,
+    queue_size=settings.telegram_update_queue_size,
+    per_user_limit=settings.telegram_user_queue_limit
+)
@@ -1,21 +1,43 @@
+import asyncio
+import hashlib
+import json
+import logging
 from datetime import datetime
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional, Set, Tuple
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.security import HTTPBearer
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from sqlalchemy.orm import joinedload
 
-from app.core.database import get_db
-from app.models.database import User, Character, Chat, Message, UserRole
+from app.core.auth import create_access_token, get_current_user, principal_cache, verify_telegram_login
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal, get_db
+from app.models.database import Message, User, UserRole
 from app.ai.service import AIService
 from app.billing.service import BillingService
+from app.services.admission import AdmissionRejected, AdmissionTicket, admission_controller
+from app.services.character_catalog import CharacterRecord, character_catalog
+from app.services.idempotency import IdempotencyConflict, SharedStream, idempotency_registry
+from app.services.memory import semantic_memory
+from app.services.quota import message_quota
+from app.services.repository import (
+    create_chat as insert_chat,
+    get_recent_messages,
+    get_user_chat,
+    list_user_chats,
+    save_exchange,
+    upsert_telegram_user
+)
+from app.services.summarizer import summarizer
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
-security = HTTPBearer()
 ai_service = AIService()
+# Фоновые задачи, которые должны пережить отмену запроса (сохранение оборванного ответа)
+_background_tasks: Set[asyncio.Task] = set()
 billing_service = BillingService()
 
 
@@ -51,75 +73,71 @@ class SubscriptionRequest(BaseModel):
     subscription_type: str
 
 
-async def get_current_user(
-    token: str = Depends(security),
+class TelegramLoginRequest(BaseModel):
+    id: int
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    username: Optional[str] = None
+    photo_url: Optional[str] = None
+    auth_date: int
+    hash: str
+
+
+class TokenResponse(BaseModel):
+    access_token: str
+    token_type: str = "bearer"
+
+
+@router.post("/auth/telegram", response_model=TokenResponse)
+async def login_telegram(
+    login_request: TelegramLoginRequest,
     db: AsyncSession = Depends(get_db)
-) -> User:
-    # Для демонстрации используем простую проверку
-    # В реальном приложении здесь должна быть проверка JWT токена
-    try:
-        # Пока что ищем первого пользователя в базе
-        result = await db.execute(select(User).limit(1))
-        user = result.scalar_one_or_none()
-        if not user:
-            # Если пользователей нет, создаем тестового
-            user = User(
-                telegram_id=123456789,
-                username="test_user",
-                first_name="Тест",
-                last_name="Пользователь",
-                role=UserRole.FREE
-            )
-            db.add(user)
-            await db.commit()
-            await db.refresh(user)
-        return user
-    except Exception as e:
-        raise e
+):
+    """Вход через Telegram Login Widget: выдает JWT"""
+    data = {key: str(value) for key, value in login_request.model_dump(exclude_none=True).items()}
+    if not verify_telegram_login(data):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid authentication credentials"
+            detail="Invalid Telegram login data"
         )
+    
+    user = await upsert_telegram_user(
+        db,
+        login_request.id,
+        login_request.username,
+        login_request.first_name,
+        login_request.last_name
+    )
+    
+    principal_cache.put(user)
+    return TokenResponse(access_token=create_access_token(user))
 
 
 @router.get("/characters", response_model=List[CharacterResponse])
 async def get_characters(
-    current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    request: Request,
+    current_user: User = Depends(get_current_user)
 ):
-    result = await db.execute(select(Character).where(Character.is_active == True))
-    characters = result.scalars().all()
-    return [
-        CharacterResponse(
-            id=char.id,
-            name=char.name,
-            description=char.description,
-            personality=char.personality,
-            avatar_url=char.avatar_url,
-            is_premium=char.is_premium
-        )
-        for char in characters
-    ]
+    return await _characters_response(request)
 
 
 @router.get("/characters/public", response_model=List[CharacterResponse])
-async def get_characters_public(
-    db: AsyncSession = Depends(get_db)
-):
+async def get_characters_public(request: Request):
     """Получить список персонажей без аутентификации"""
-    result = await db.execute(select(Character).where(Character.is_active == True))
-    characters = result.scalars().all()
-    return [
-        CharacterResponse(
-            id=char.id,
-            name=char.name,
-            description=char.description,
-            personality=char.personality,
-            avatar_url=char.avatar_url,
-            is_premium=char.is_premium
-        )
-        for char in characters
-    ]
+    return await _characters_response(request)
+
+
+async def _characters_response(request: Request) -> Response:
+    """Заранее сериализованный каталог; 304, если у клиента актуальная версия"""
+    body, etag = await character_catalog.public_json()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def _character_response(character: CharacterRecord) -> CharacterResponse:
+    return CharacterResponse(**character.public_dict())
 
 
 @router.get("/chats", response_model=List[ChatResponse])
@@ -127,25 +145,19 @@ async def get_user_chats(
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    result = await db.execute(select(Chat).where(Chat.user_id == current_user.id))
-    chats = result.scalars().all()
-    return [
-        ChatResponse(
+    responses = []
+    for chat in await list_user_chats(db, current_user.id):
+        character = await character_catalog.get(chat.character_id)
+        if not character:
+            continue
+        responses.append(ChatResponse(
             id=chat.id,
             title=chat.title,
-            character=CharacterResponse(
-                id=chat.character.id,
-                name=chat.character.name,
-                description=chat.character.description,
-                personality=chat.character.personality,
-                avatar_url=chat.character.avatar_url,
-                is_premium=chat.character.is_premium
-            ),
+            character=_character_response(character),
             created_at=chat.created_at,
             updated_at=chat.updated_at
-        )
-        for chat in chats
-    ]
+        ))
+    return responses
 
 
 @router.post("/chats")
@@ -154,9 +166,8 @@ async def create_chat(
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    result = await db.execute(select(Character).where(Character.id == character_id))
-    character = result.scalar_one_or_none()
-    if not character:
+    character = await character_catalog.get(character_id)
+    if not character or not character.is_active:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Character not found"
@@ -168,14 +179,7 @@ async def create_chat(
             detail="Premium character requires premium subscription"
         )
     
-    chat = Chat(
-        user_id=current_user.id,
-        character_id=character.id,
-        title=f"Чат с {character.name}"
-    )
-    db.add(chat)
-    await db.commit()
-    await db.refresh(chat)
+    chat = await insert_chat(db, current_user.id, character.id, f"Чат с {character.name}")
     
     return {"chat_id": chat.id, "title": chat.title}
 
@@ -183,13 +187,13 @@ async def create_chat(
 @router.get("/chats/{chat_id}/messages", response_model=List[MessageResponse])
 async def get_chat_messages(
     chat_id: int,
+    before_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=200),
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    result = await db.execute(
-        select(Chat).where(Chat.id == chat_id, Chat.user_id == current_user.id)
-    )
-    chat = result.scalar_one_or_none()
+    """Страница истории чата: последние ``limit`` сообщений с id < before_id"""
+    chat = await get_user_chat(db, chat_id, current_user.id)
     
     if not chat:
         raise HTTPException(
@@ -197,8 +201,7 @@ async def get_chat_messages(
             detail="Chat not found"
         )
     
-    result = await db.execute(select(Message).where(Message.chat_id == chat_id))
-    messages = result.scalars().all()
+    messages = await get_recent_messages(db, chat_id, limit, before_id=before_id)
     return [
         MessageResponse(
             id=msg.id,
@@ -215,63 +218,95 @@ async def send_message(
     chat_id: int,
     message_request: MessageRequest,
     current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, max_length=128)
 ):
-    result = await db.execute(
-        select(Chat).where(Chat.id == chat_id, Chat.user_id == current_user.id).options(joinedload(Chat.character))
+    if idempotency_key is None:
+        return await _send_message(chat_id, message_request, current_user, db)
+    # Повтор с тем же ключом получает ответ первой попытки, а не вторую генерацию
+    try:
+        return await idempotency_registry.run(
+            ("message", current_user.id, chat_id, idempotency_key),
+            lambda: _send_message(chat_id, message_request, current_user, db),
+            _fingerprint(message_request)
+        )
+    except IdempotencyConflict as e:
+        raise _conflict_error() from e
+
+
+def _fingerprint(message_request: MessageRequest) -> str:
+    return hashlib.sha256(message_request.content.encode("utf-8")).hexdigest()
+
+
+def _conflict_error() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        detail="Idempotency-Key was already used with a different message"
     )
-    chat = result.scalar_one_or_none()
+
+
+async def _send_message(chat_id: int, message_request: MessageRequest, current_user: User, db: AsyncSession) -> dict:
+    chat = await get_user_chat(db, chat_id, current_user.id)
+    character = await character_catalog.get(chat.character_id) if chat else None
     
-    if not chat:
+    if not chat or not character:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Chat not found"
         )
     
-    if not await check_message_limit(current_user, db):
+    if not await message_quota.try_consume(current_user):
         raise HTTPException(
             status_code=status.HTTP_429_TOO_MANY_REQUESTS,
             detail="Message limit exceeded"
         )
     
-    user_message = Message(
-        chat_id=chat.id,
-        content=message_request.content,
-        is_user_message=True
-    )
-    db.add(user_message)
-    
-    # Получаем историю сообщений
-    result = await db.execute(select(Message).where(Message.chat_id == chat_id).order_by(Message.created_at.desc()).limit(10))
-    recent_messages = result.scalars().all()
-    
-    conversation_history = [
-        {
-            "content": msg.content,
-            "is_user_message": msg.is_user_message
-        }
-        for msg in reversed(recent_messages)
-    ]
-    
-    ai_response = await ai_service.generate_response(
-        chat.character.personality,
-        chat.character.description,
-        conversation_history,
-        message_request.content
-    )
-    
-    ai_message = Message(
-        chat_id=chat.id,
-        content=ai_response,
-        is_user_message=False,
-        tokens_used=ai_service.count_tokens(ai_response)
-    )
-    db.add(ai_message)
-    
-    current_user.messages_used_today += 1
-    current_user.last_message_date = datetime.utcnow()
-    
-    await db.commit()
+    try:
+        # Получаем историю сообщений до добавления нового, чтобы оно не попало в промпт дважды
+        recent_messages = await get_recent_messages(
+            db, chat_id, settings.prompt_history_fetch_limit, after_id=chat.summary_message_id
+        )
+        
+        conversation_history = [
+            {
+                "content": msg.content,
+                "is_user_message": msg.is_user_message
+            }
+            for msg in recent_messages
+        ]
+        
+        async with admission_controller.admit(current_user.id, current_user.role):
+            # Релевантные сообщения старше тех, что уже попадут в промпт; эмбеддинг запроса
+            # нагружает тот же бэкенд, что и генерация, поэтому ищем только после допуска
+            memories = await semantic_memory.recall(
+                chat.id,
+                message_request.content,
+                before_id=recent_messages[0].id if recent_messages else None
+            )
+            ai_response = await ai_service.generate_response(
+                character.personality,
+                character.description,
+                conversation_history,
+                message_request.content,
+                chat_id=chat.id,
+                summary=chat.summary,
+                memories=memories,
+                character_name=character.name,
+                premium=current_user.role != UserRole.FREE
+            )
+        
+        user_message, ai_message = await save_exchange(
+            db, chat.id, message_request.content, ai_response, ai_service.count_tokens(ai_response)
+        )
+    except AdmissionRejected as e:
+        await message_quota.refund(current_user.id)
+        raise _busy_error(e)
+    except Exception:
+        # Сообщение не сохранено, списанный лимит возвращаем
+        await message_quota.refund(current_user.id)
+        raise
+    summarizer.schedule(chat.id)
+    semantic_memory.index_messages(chat.id, [user_message, ai_message])
     
     return {
         "user_message": MessageResponse(
@@ -289,17 +324,235 @@ async def send_message(
     }
 
 
-async def check_message_limit(user: User, db: AsyncSession) -> bool:
-    today = datetime.utcnow().date()
-    last_message_date = user.last_message_date.date() if user.last_message_date else None
+@router.post("/chats/{chat_id}/messages/stream")
+async def send_message_stream(
+    chat_id: int,
+    message_request: MessageRequest,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, max_length=128)
+):
+    """Отправка сообщения с потоковой выдачей ответа через Server-Sent Events.
+
+    С заголовком ``Idempotency-Key`` генерация идет в фоне независимо от
+    соединения, а повтор с тем же ключом получает тот же поток с начала.
+    """
+    if idempotency_key is None:
+        ticket, stream = await _open_stream(chat_id, message_request, current_user, db)
+        # Если поток так и не начнется (клиент ушел), слот освободится здесь
+        return _sse_response(stream, BackgroundTask(admission_controller.release, ticket))
+    
+    async def open_shared() -> SharedStream:
+        _, stream = await _open_stream(chat_id, message_request, current_user, db)
+        return SharedStream(stream)
+    
+    try:
+        shared = await idempotency_registry.run(
+            ("message", current_user.id, chat_id, idempotency_key),
+            open_shared,
+            _fingerprint(message_request)
+        )
+    except IdempotencyConflict as e:
+        raise _conflict_error() from e
+    return _sse_response(shared.subscribe())
+
+
+async def _open_stream(
+    chat_id: int,
+    message_request: MessageRequest,
+    current_user: User,
+    db: AsyncSession
+) -> Tuple[AdmissionTicket, AsyncIterator[str]]:
+    chat = await get_user_chat(db, chat_id, current_user.id)
+    character = await character_catalog.get(chat.character_id) if chat else None
+    
+    if not chat or not character:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Chat not found"
+        )
+    
+    if not await message_quota.try_consume(current_user):
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Message limit exceeded"
+        )
+    
+    # Слот берем до начала ответа, чтобы при перегрузке вернуть 503, а не оборванный поток,
+    # и до поиска воспоминаний: эмбеддинг запроса нагружает тот же бэкенд, что и генерация
+    try:
+        ticket = await admission_controller.acquire(current_user.id, current_user.role)
+    except AdmissionRejected as e:
+        await message_quota.refund(current_user.id)
+        raise _busy_error(e)
+    
+    try:
+        # Получаем историю сообщений
+        recent_messages = await get_recent_messages(
+            db, chat_id, settings.prompt_history_fetch_limit, after_id=chat.summary_message_id
+        )
+        
+        conversation_history = [
+            {
+                "content": msg.content,
+                "is_user_message": msg.is_user_message
+            }
+            for msg in recent_messages
+        ]
+        
+        memories = await semantic_memory.recall(
+            chat.id,
+            message_request.content,
+            before_id=recent_messages[0].id if recent_messages else None
+        )
+    except Exception:
+        # Ответа не будет: слот освобождаем, списанный лимит возвращаем
+        admission_controller.release(ticket)
+        await message_quota.refund(current_user.id)
+        raise
+    
+    return ticket, _stream_reply(
+        chat.id,
+        current_user.id,
+        character,
+        conversation_history,
+        message_request.content,
+        ticket,
+        chat.summary,
+        memories,
+        current_user.role != UserRole.FREE
+    )
+
+
+def _sse_response(stream: AsyncIterator[str], background: Optional[BackgroundTask] = None) -> StreamingResponse:
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=background
+    )
+
+
+def _busy_error(rejection: AdmissionRejected) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many concurrent messages" if rejection.reason == "user_busy" else "Service is busy",
+        headers={"Retry-After": str(rejection.retry_after_seconds)}
+    )
+
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _save_reply(chat_id: int, user_id: int, content: str, ai_response: str) -> Optional[Tuple[Message, Message]]:
+    """Сохранение потокового ответа; пустой или несохраненный ответ возвращает списанный лимит"""
+    if not ai_response:
+        await message_quota.refund(user_id)
+        return None
+    # Сессия запроса к этому моменту может быть уже закрыта, поэтому сохраняем в своей
+    try:
+        async with AsyncSessionLocal() as db:
+            user_message, ai_message = await save_exchange(
+                db, chat_id, content, ai_response, ai_service.count_tokens(ai_response)
+            )
+    except Exception as e:
+        logger.error(f"Error saving streamed message: {e}")
+        await message_quota.refund(user_id)
+        return None
+    
+    summarizer.schedule(chat_id)
+    semantic_memory.index_messages(chat_id, [user_message, ai_message])
+    return user_message, ai_message
+
+
+async def _stream_reply(
+    chat_id: int,
+    user_id: int,
+    character: CharacterRecord,
+    conversation_history: List[dict],
+    content: str,
+    ticket: AdmissionTicket,
+    summary: Optional[str] = None,
+    memories: Optional[List[str]] = None,
+    premium: bool = False
+) -> AsyncIterator[str]:
+    # Токены и позиция в очереди генерации приходят из разных мест, сводим их в одну очередь событий
+    events: asyncio.Queue = asyncio.Queue()
     
-    if last_message_date != today:
-        user.messages_used_today = 0
-        await db.commit()
+    # Провайдер, выдавший ответ, от него зависит постобработка
+    served_by: List[str] = []
     
-    from app.core.config import settings
-    limit = settings.premium_messages_per_day if user.role == UserRole.PREMIUM else settings.free_messages_per_day
-    return user.messages_used_today < limit
+    def on_queue(position: int, eta: float):
+        events.put_nowait(("queue", {"position": position, "eta": round(eta, 1)}))
+    
+    async def produce():
+        try:
+            async for chunk in ai_service.stream_response(
+                character.personality,
+                character.description,
+                conversation_history,
+                content,
+                chat_id=chat_id,
+                summary=summary,
+                memories=memories,
+                character_name=character.name,
+                on_queue=on_queue,
+                premium=premium,
+                on_provider=served_by.append
+            ):
+                events.put_nowait(("token", {"text": chunk}))
+        finally:
+            events.put_nowait(("end", None))
+    
+    chunks = []
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            event, data = await events.get()
+            if event == "end":
+                break
+            if event == "token":
+                chunks.append(data["text"])
+            yield _sse_event(event, data)
+        # Ошибка генерации пробрасывается, как и без очереди событий
+        await producer
+    except BaseException:
+        # Клиент ушел (GeneratorExit, CancelledError) или генерация упала посреди ответа:
+        # выданную часть сохраняем, а без нее возвращаем лимит. Отдельной задачей,
+        # потому что текущую отменяют вместе с соединением
+        partial = ""
+        if chunks:
+            partial = ai_service.post_process("".join(chunks), served_by[0] if served_by else None, character_name=character.name)
+        task = asyncio.create_task(_save_reply(chat_id, user_id, content, partial))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        raise
+    finally:
+        producer.cancel()
+        admission_controller.release(ticket)
+    
+    ai_response = ai_service.post_process("".join(chunks), served_by[0] if served_by else None, character_name=character.name)
+    saved = await _save_reply(chat_id, user_id, content, ai_response)
+    if saved is None:
+        yield _sse_event("error", {"detail": "Failed to save message"})
+        return
+    user_message, ai_message = saved
+    
+    yield _sse_event("done", {
+        "user_message": MessageResponse(
+            id=user_message.id,
+            content=user_message.content,
+            is_user_message=True,
+            created_at=user_message.created_at
+        ).model_dump(mode="json"),
+        "ai_message": MessageResponse(
+            id=ai_message.id,
+            content=ai_message.content,
+            is_user_message=False,
+            created_at=ai_message.created_at
+        ).model_dump(mode="json")
+    })
 
 
 @router.post("/subscription")
@@ -341,7 +594,7 @@ async def get_user_profile(
         "role": current_user.role,
         "subscription_type": current_user.subscription_type,
         "subscription_expires": current_user.subscription_expires,
-        "messages_used_today": current_user.messages_used_today,
+        "messages_used_today": await message_quota.used_today(current_user.id),
         "created_at": current_user.created_at
     }
 
@@ -1,9 +1,16 @@
+import asyncio
 from typing import List, Dict, Any
 from fastapi import APIRouter, HTTPException, status
+from app.ai.ollama_pool import ollama_pool
+from app.ai.model_routing import model_router
 from app.ai.ollama_service import OllamaService
+from app.ai.response_cache import response_cache
+from app.ai.routing import provider_router
+from app.ai.scheduler import generation_scheduler
 from app.core.config import settings
 
 router = APIRouter()
+# Клиент ollama синхронный: его вызовы уходят в поток, чтобы не блокировать event loop
 ollama_service = OllamaService(base_url=settings.ollama_base_url)
 
 
@@ -11,7 +18,7 @@ ollama_service = OllamaService(base_url=settings.ollama_base_url)
 async def get_models():
     """Получение списка доступных моделей"""
     try:
-        models = ollama_service.list_models()
+        models = await asyncio.to_thread(ollama_service.list_models)
         return models
     except Exception as e:
         raise HTTPException(
@@ -24,7 +31,7 @@ async def get_models():
 async def pull_model(model_name: str):
     """Загрузка модели"""
     try:
-        success = ollama_service.pull_model(model_name)
+        success = await asyncio.to_thread(ollama_service.pull_model, model_name)
         if success:
             return {"message": f"Модель {model_name} успешно загружена"}
         else:
@@ -43,7 +50,7 @@ async def pull_model(model_name: str):
 async def get_model_info(model_name: str):
     """Получение информации о модели"""
     try:
-        info = ollama_service.get_model_info(model_name)
+        info = await asyncio.to_thread(ollama_service.get_model_info, model_name)
         if info:
             return info
         else:
@@ -75,17 +82,27 @@ async def get_recommended_models():
 async def get_ollama_status():
     """Получение статуса Ollama"""
     try:
-        models = ollama_service.list_models()
+        models = await asyncio.to_thread(ollama_service.list_models)
         return {
             "status": "running",
             "models_count": len(models),
             "default_model": settings.ollama_default_model,
-            "base_url": settings.ollama_base_url
+            "base_url": settings.ollama_base_url,
+            "scheduler": generation_scheduler.stats(),
+            "backends": ollama_pool.status(),
+            "routing": provider_router.status(),
+            "model_routing": model_router.status(),
+            "response_cache": response_cache.stats()
         }
     except Exception as e:
         return {
             "status": "error",
             "error": str(e),
             "default_model": settings.ollama_default_model,
-            "base_url": settings.ollama_base_url
+            "base_url": settings.ollama_base_url,
+            "scheduler": generation_scheduler.stats(),
+            "backends": ollama_pool.status(),
+            "routing": provider_router.status(),
+            "model_routing": model_router.status(),
+            "response_cache": response_cache.stats()
         }
@@ -0,0 +1,76 @@
+import hmac
+import logging
+from urllib.parse import urlparse
+
+from aiogram import types
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from pydantic import ValidationError
+
+from app.core.auth import get_current_user
+from app.core.config import settings
+from app.models.database import User, UserRole
+from app.services.admission import admission_controller
+from app.services.idempotency import idempotency_registry
+from app.telegram.bot import bot
+from app.telegram.ratelimit import outbound_limiter
+from app.telegram.webhook import update_scheduler
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# Путь берется из TELEGRAM_WEBHOOK_URL, чтобы nginx проксировал его как есть
+WEBHOOK_PATH = urlparse(settings.telegram_webhook_url or "").path or "/telegram/webhook"
+
+
+@router.post(WEBHOOK_PATH, include_in_schema=False)
+async def telegram_webhook(request: Request):
+    """Прием обновления от Telegram: проверка секрета и постановка в очередь"""
+    received_secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not settings.telegram_webhook_secret or not hmac.compare_digest(
+        received_secret, settings.telegram_webhook_secret
+    ):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid secret token")
+    
+    if not update_scheduler.running:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Bot is not running")
+    
+    try:
+        update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    except (ValueError, ValidationError) as e:
+        logger.warning(f"Malformed Telegram update: {e}")
+        # Telegram повторяет доставку при ошибке, битое обновление повторять незачем
+        return Response(status_code=status.HTTP_200_OK)
+    
+    # Повторная доставка уже принятого обновления (Telegram не дождался ответа)
+    update_key = ("telegram-update", update.update_id)
+    if idempotency_registry.seen(update_key):
+        logger.info(f"Duplicate Telegram update {update.update_id} ignored")
+        return Response(status_code=status.HTTP_200_OK)
+    
+    if not update_scheduler.submit(update):
+        # Telegram доставит обновление повторно, когда очередь разгрузится
+        logger.warning(f"Telegram update queue is full, rejecting update {update.update_id}")
+        idempotency_registry.forget(update_key)
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Update queue is full")
+    
+    return Response(status_code=status.HTTP_200_OK)
+
+
+@router.get("/telegram/stats", include_in_schema=False)
+async def telegram_stats(current_user: User = Depends(get_current_user)):
+    """Очереди входящих обновлений и исходящих запросов бота, допуск к генерации"""
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin only")
+    
+    return {
+        "updates": {
+            "running": update_scheduler.running,
+            "queued": update_scheduler.queued,
+            "processed": update_scheduler.processed,
+            "dropped": update_scheduler.dropped,
+        },
+        "outbound": outbound_limiter.stats(),
+        "admission": admission_controller.stats(),
+        "idempotency": idempotency_registry.stats(),
+    }
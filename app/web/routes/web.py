@@ -2,8 +2,11 @@ from fastapi import APIRouter, Request
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
 
+from app.core.config import settings
+
 router = APIRouter()
 templates = Jinja2Templates(directory="app/web/templates")
+templates.env.globals["telegram_bot_username"] = settings.telegram_bot_username
 
 
 @router.get("/", response_class=HTMLResponse)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест планировщика обновлений Telegram на синтетических обновлениях
+
+Вместо реального диспетчера используется заглушка с задержкой, имитирующей
+вызов модели. Проверяются порядок обработки внутри пользователя, отсутствие
+параллельной обработки одного пользователя и ограничение общей параллельности.
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from aiogram import types
+
+from app.telegram.webhook import UpdateScheduler
+
+
+def make_update(update_id: int, user_id: int, seq: int) -> types.Update:
+    return types.Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": seq,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": f"сообщение {seq}",
+        },
+    })
+
+
+class FakeDispatcher:
+    """Заглушка aiogram Dispatcher: «отвечает» со случайной задержкой"""
+    
+    def __init__(self, latency: float, jitter: float):
+        self.latency = latency
+        self.jitter = jitter
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.users_in_flight = set()
+        self.overlaps = 0
+        self.order_violations = 0
+        self.last_seq: Dict[int, int] = defaultdict(int)
+        self.submitted_at: Dict[int, float] = {}
+        self.latencies: List[float] = []
+    
+    async def feed_update(self, bot, update: types.Update):
+        user_id = update.message.from_user.id
+        seq = update.message.message_id
+        
+        if user_id in self.users_in_flight:
+            self.overlaps += 1
+        if seq <= self.last_seq[user_id]:
+            self.order_violations += 1
+        self.last_seq[user_id] = seq
+        
+        self.users_in_flight.add(user_id)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        finally:
+            self.in_flight -= 1
+            self.users_in_flight.discard(user_id)
+            self.latencies.append(time.perf_counter() - self.submitted_at[update.update_id])
+
+
+async def run(args):
+    dispatcher = FakeDispatcher(args.latency_ms / 1000, args.jitter_ms / 1000)
+    scheduler = UpdateScheduler(
+        workers=args.workers,
+        queue_size=args.queue_size,
+        per_user_limit=args.per_user_limit
+    )
+    scheduler.start(bot=None, dp=dispatcher)
+    
+    print(f"🚀 {args.users} пользователей × {args.messages} сообщений, воркеров: {args.workers}, "
+          f"задержка ответа {args.latency_ms} мс")
+    
+    rejected = 0
+    update_id = 0
+    started = time.perf_counter()
+    for seq in range(1, args.messages + 1):
+        user_ids = list(range(1, args.users + 1))
+        random.shuffle(user_ids)
+        for user_id in user_ids:
+            update_id += 1
+            dispatcher.submitted_at[update_id] = time.perf_counter()
+            if not scheduler.submit(make_update(update_id, user_id, seq)):
+                rejected += 1
+        # Пауза между волнами: пользователи пишут чаще, чем модель отвечает
+        await asyncio.sleep(args.interval_ms / 1000)
+    
+    await scheduler.stop(timeout=3600)
+    elapsed = time.perf_counter() - started
+    
+    latencies = sorted(dispatcher.latencies)
+    print(f"\n📊 Обработано: {scheduler.processed} за {elapsed:.1f} с ({scheduler.processed / elapsed:.0f} обн/с)")
+    print(f"   Отброшено по лимиту пользователя: {scheduler.dropped}, отклонено (очередь полна): {rejected}")
+    print(f"   Задержка от приема до ответа: p50 {statistics.median(latencies) * 1000:.0f} мс, "
+          f"p95 {statistics.quantiles(latencies, n=20)[18] * 1000:.0f} мс, max {latencies[-1] * 1000:.0f} мс")
+    print(f"   Максимум одновременных обработок: {dispatcher.max_in_flight} (лимит {args.workers})")
+    print(f"   Параллельная обработка одного пользователя: {dispatcher.overlaps}")
+    print(f"   Нарушения порядка внутри пользователя: {dispatcher.order_violations}")
+    
+    ok = (
+        dispatcher.overlaps == 0
+        and dispatcher.order_violations == 0
+        and dispatcher.max_in_flight <= args.workers
+    )
+    print("\n✅ Инварианты соблюдены" if ok else "\n❌ Инварианты нарушены")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест планировщика обновлений Telegram")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=8, help="Сообщений от каждого пользователя")
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--queue-size", type=int, default=100_000)
+    parser.add_argument("--per-user-limit", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=200, help="Средняя задержка «ответа модели»")
+    parser.add_argument("--jitter-ms", type=float, default=50)
+    parser.add_argument("--interval-ms", type=float, default=50, help="Пауза между волнами сообщений")
+    args = parser.parse_args()
+    
+    # Предупреждения об отброшенных обновлениях при перегрузке ожидаемы и только мешают отчету
+    logging.basicConfig(level=logging.ERROR)
+    
+    ok = asyncio.run(run(args))
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,10 +7,18 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
+from app.ai.context_cache import context_cache
+from app.ai.ollama_pool import ollama_pool
+from app.ai.prompt_builder import prompt_builder
+from app.ai.providers import close_http_clients
+from app.ai.response_cache import response_cache
 from app.core.config import settings
 from app.core.database import init_db
-from app.telegram.bot import start_bot
-from app.web.routes import api_router, web_router, ollama_router
+from app.services.character_catalog import character_catalog
+from app.services.message_writer import message_writer
+from app.services.quota import message_quota
+from app.telegram.bot import start_bot, start_webhook, stop_webhook
+from app.web.routes import api_router, web_router, ollama_router, telegram_router
 
 logging.basicConfig(
     level=logging.INFO,
@@ -22,8 +30,28 @@ logger = logging.getLogger(__name__)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db()
+    prompt_builder.load_tokenizer()
+    await character_catalog.load()
+    message_quota.start()
+    ollama_pool.start()
+    if settings.message_write_behind:
+        message_writer.start()
+    if settings.ollama_context_cache_path:
+        context_cache.load(settings.ollama_context_cache_path)
     # asyncio.create_task(start_bot())
+    if settings.telegram_token and settings.telegram_webhook_url:
+        await start_webhook()
     yield
+    if settings.telegram_token and settings.telegram_webhook_url:
+        await stop_webhook()
+    if settings.ollama_context_cache_path:
+        context_cache.save(settings.ollama_context_cache_path)
+    if settings.message_write_behind:
+        await message_writer.close()
+    await message_quota.close()
+    await ollama_pool.close()
+    await response_cache.close()
+    await close_http_clients()
 
 
 app = FastAPI(
@@ -45,6 +73,7 @@ app.mount("/static", StaticFiles(directory="app/web/static"), name="static")
 app.include_router(api_router, prefix="/api")
 app.include_router(ollama_router, prefix="/api/ollama")
 app.include_router(web_router)
+app.include_router(telegram_router)
 
 
 if __name__ == "__main__":
@@ -51,7 +51,10 @@ async def main():
             return
         
         # Запускаем Telegram бота в отдельной задаче
-        if settings.telegram_token:
+        if settings.telegram_token and settings.telegram_webhook_url:
+            # Обновления принимает webhook-маршрут веб-сервера (см. lifespan в main.py)
+            logger.info(f"🤖 Telegram бот работает через webhook: {settings.telegram_webhook_url}")
+        elif settings.telegram_token:
             logger.info("🤖 Запуск Telegram бота...")
             # bot_task = asyncio.create_task(start_bot())
         else:
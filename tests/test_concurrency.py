@@ -0,0 +1,169 @@
+import asyncio
+import time
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+from app.ai.providers import GenerationRequest, LLMProvider
+from app.ai.routing import ProviderRouter
+from app.ai.service import AIService
+from app.models.database import UserRole
+from app.services.admission import AdmissionController
+from app.services.character_catalog import CharacterRecord
+from app.services.quota import MemoryQuotaStore, MessageQuota
+from app.web.routes import api
+
+CONCURRENT_MESSAGES = 50
+GENERATION_LATENCY = 0.2
+
+
+class SlowFakeProvider(LLMProvider):
+    """Локальный провайдер: отвечает через фиксированную задержку и считает одновременные генерации"""
+    name = "ollama"
+    
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+    
+    async def generate(self, request: GenerationRequest) -> str:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            return "Привет!"
+        finally:
+            self.in_flight -= 1
+
+
+class InMemoryRepository:
+    """Чаты и сообщения в памяти вместо функций app.services.repository"""
+    
+    def __init__(self):
+        self.chats = {}
+        self.messages = []
+    
+    def add_chat(self, chat_id: int, user_id: int, character_id: int):
+        self.chats[chat_id] = SimpleNamespace(
+            id=chat_id,
+            user_id=user_id,
+            character_id=character_id,
+            summary=None,
+            summary_message_id=None
+        )
+    
+    async def get_user_chat(self, db, chat_id: int, user_id: int):
+        chat = self.chats.get(chat_id)
+        return chat if chat and chat.user_id == user_id else None
+    
+    async def get_recent_messages(self, db, chat_id: int, limit: int, after_id=None):
+        return [msg for msg in self.messages if msg.chat_id == chat_id][-limit:]
+    
+    async def save_exchange(self, db, chat_id: int, user_content: str, ai_content: str, ai_tokens: int):
+        saved = []
+        for content, is_user_message in ((user_content, True), (ai_content, False)):
+            message = SimpleNamespace(
+                id=len(self.messages) + 1,
+                chat_id=chat_id,
+                content=content,
+                is_user_message=is_user_message,
+                created_at=datetime.utcnow()
+            )
+            self.messages.append(message)
+            saved.append(message)
+        return saved[0], saved[1]
+
+
+class ConcurrentSendMessageTest(unittest.IsolatedAsyncioTestCase):
+    """Генерации разных чатов идут параллельно, а не одна за другой"""
+    
+    async def test_concurrent_messages_overlap(self):
+        provider = SlowFakeProvider(GENERATION_LATENCY)
+        ai_service = AIService(
+            providers={"ollama": provider},
+            router=ProviderRouter({"ollama": 10.0}, latency_budget=30.0)
+        )
+        
+        started = time.monotonic()
+        responses = await asyncio.gather(*[
+            ai_service.generate_response(
+                "Дружелюбная",
+                "Тестовый персонаж",
+                [],
+                f"Сообщение {number}",
+                use_ollama=True,
+                character_name="Алиса"
+            )
+            for number in range(CONCURRENT_MESSAGES)
+        ])
+        elapsed = time.monotonic() - started
+        
+        self.assertEqual(len(responses), CONCURRENT_MESSAGES)
+        for response in responses:
+            self.assertTrue(response.startswith("Привет!"), response)
+        self.assertEqual(provider.max_in_flight, CONCURRENT_MESSAGES)
+        # Последовательно это заняло бы CONCURRENT_MESSAGES * GENERATION_LATENCY (10 с)
+        self.assertLess(elapsed, GENERATION_LATENCY * 5)
+    
+    
+    async def test_concurrent_send_message_route(self):
+        provider = SlowFakeProvider(GENERATION_LATENCY)
+        repository = InMemoryRepository()
+        character = CharacterRecord(
+            id=1,
+            name="Алиса",
+            description="Тестовый персонаж",
+            personality="Дружелюбная",
+            avatar_url=None,
+            is_premium=False,
+            is_active=True
+        )
+        quota = MessageQuota(MemoryQuotaStore())
+        users = [
+            SimpleNamespace(id=number + 1, role=UserRole.FREE)
+            for number in range(CONCURRENT_MESSAGES)
+        ]
+        for user in users:
+            repository.add_chat(user.id, user.id, character.id)
+        
+        with mock.patch.multiple(
+            api,
+            ai_service=AIService(
+                providers={"ollama": provider},
+                router=ProviderRouter({"ollama": 10.0}, latency_budget=30.0)
+            ),
+            admission_controller=AdmissionController(max_concurrent=CONCURRENT_MESSAGES),
+            message_quota=quota,
+            get_user_chat=repository.get_user_chat,
+            get_recent_messages=repository.get_recent_messages,
+            save_exchange=repository.save_exchange
+        ), mock.patch.object(api.character_catalog, "get", mock.AsyncMock(return_value=character)), \
+                mock.patch.object(api.semantic_memory, "recall", mock.AsyncMock(return_value=[])), \
+                mock.patch.object(api.semantic_memory, "index_messages"), \
+                mock.patch.object(api.summarizer, "schedule"):
+            started = time.monotonic()
+            responses = await asyncio.gather(*[
+                api.send_message(
+                    user.id,
+                    api.MessageRequest(content=f"Сообщение {user.id}"),
+                    current_user=user,
+                    db=None,
+                    idempotency_key=None
+                )
+                for user in users
+            ])
+            elapsed = time.monotonic() - started
+        
+        self.assertEqual(len(responses), CONCURRENT_MESSAGES)
+        for user, response in zip(users, responses):
+            self.assertEqual(response["user_message"].content, f"Сообщение {user.id}")
+            self.assertTrue(response["ai_message"].content.startswith("Привет!"), response["ai_message"].content)
+            self.assertEqual(await quota.used_today(user.id), 1)
+        self.assertEqual(len(repository.messages), CONCURRENT_MESSAGES * 2)
+        self.assertEqual(provider.max_in_flight, CONCURRENT_MESSAGES)
+        self.assertLess(elapsed, GENERATION_LATENCY * 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,179 @@
+"""
+Пул серверов Ollama на локальных заглушках
+
+Поднимает несколько HTTP-заглушек с API Ollama (/api/tags, /api/ps, /api/generate)
+на свободных портах и проверяет маршрутизацию пула: выбор сервера с загруженной
+моделью, распределение нагрузки, обход упавшего сервера и его возвращение в пул.
+"""
+
+import asyncio
+import json
+import logging
+import socket
+import unittest
+from collections import Counter
+from typing import Set
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+from app.ai.ollama_pool import OllamaPool
+from app.ai.providers import GenerationRequest, close_http_clients
+from app.ai.scheduler import GenerationScheduler, ScheduledProvider
+
+MODEL = "llama2"
+CONCURRENCY = 40
+SLOTS = 4
+LATENCY = 0.1
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class StubOllama:
+    """Заглушка сервера Ollama: отвечает с задержкой и считает запросы"""
+    
+    def __init__(self, name: str, available: Set[str], loaded: Set[str], latency: float):
+        self.name = name
+        self.available = available
+        self.loaded = loaded
+        self.latency = latency
+        self.generations = 0
+        self.port = free_port()
+        self.server = None
+        self.task = None
+    
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+    
+    def app(self) -> FastAPI:
+        app = FastAPI()
+        
+        @app.get("/api/tags")
+        async def tags():
+            return {"models": [{"name": f"{model}:latest"} for model in sorted(self.available)]}
+        
+        @app.get("/api/ps")
+        async def ps():
+            return {"models": [{"name": f"{model}:latest"} for model in sorted(self.loaded)]}
+        
+        @app.post("/api/generate")
+        async def generate(body: dict):
+            self.generations += 1
+            self.loaded.add(body["model"])
+            
+            async def chunks():
+                for word in (self.name, " ответила"):
+                    await asyncio.sleep(self.latency / 2)
+                    yield json.dumps({"model": body["model"], "response": word, "done": False}) + "\n"
+                yield json.dumps({"model": body["model"], "response": "", "done": True, "context": [1, 2, 3]}) + "\n"
+            
+            if body.get("stream", True):
+                return StreamingResponse(chunks(), media_type="application/x-ndjson")
+            await asyncio.sleep(self.latency)
+            return {"model": body["model"], "response": f"{self.name} ответила", "done": True, "context": [1, 2, 3]}
+        
+        return app
+    
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+    
+    async def start(self):
+        config = uvicorn.Config(self.app(), host="127.0.0.1", port=self.port, log_level="error")
+        self.server = uvicorn.Server(config)
+        self.task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+    
+    async def stop(self):
+        self.server.should_exit = True
+        await self.task
+
+
+def request(key: int) -> GenerationRequest:
+    return GenerationRequest(model=MODEL, system_prompt="", prompt="привет", queue_key=key)
+
+
+class OllamaPoolTest(unittest.IsolatedAsyncioTestCase):
+    """Маршрутизация пула: сервер с моделью, распределение, отказ и восстановление"""
+    
+    async def asyncSetUp(self):
+        # Предупреждения о недоступном сервере ожидаемы
+        logging.getLogger("app.ai").setLevel(logging.ERROR)
+        self.warm = StubOllama("warm", available={MODEL}, loaded={MODEL}, latency=LATENCY)
+        self.cold = StubOllama("cold", available={MODEL}, loaded=set(), latency=LATENCY)
+        self.empty = StubOllama("empty", available={"mistral"}, loaded={"mistral"}, latency=LATENCY)
+        self.stubs = [self.warm, self.cold, self.empty]
+        for stub in self.stubs:
+            await stub.start()
+        
+        self.pool = OllamaPool([stub.url for stub in self.stubs], probe_timeout=1.0, cold_penalty=SLOTS)
+        self.provider = ScheduledProvider(self.pool, GenerationScheduler(max_in_flight=SLOTS, queue_timeout=30))
+        await self.pool.probe_all()
+    
+    async def asyncTearDown(self):
+        for stub in self.stubs:
+            if stub.running:
+                await stub.stop()
+        # HTTP-клиенты привязаны к event loop теста
+        await close_http_clients()
+        logging.getLogger("app.ai").setLevel(logging.NOTSET)
+    
+    def served(self) -> Counter:
+        return Counter({stub.name: stub.generations for stub in self.stubs})
+    
+    async def stream_text(self, key: int) -> str:
+        return "".join([chunk async for chunk in self.provider.stream(request(key))])
+    
+    async def stream_many(self, count: int) -> Counter:
+        before = self.served()
+        await asyncio.gather(*(self.stream_text(key) for key in range(count)))
+        return self.served() - before
+    
+    async def test_sequential_requests_go_to_loaded_model(self):
+        before = self.served()
+        for key in range(10):
+            await self.stream_text(key)
+        self.assertEqual(self.served() - before, Counter(warm=10))
+    
+    async def test_load_spreads_across_servers_with_model(self):
+        delta = await self.stream_many(CONCURRENCY)
+        self.assertGreater(delta["warm"], 0, dict(delta))
+        self.assertGreater(delta["cold"], 0, dict(delta))
+        self.assertEqual(delta["empty"], 0, dict(delta))
+        self.assertLessEqual(abs(delta["warm"] - delta["cold"]), CONCURRENCY // 2, dict(delta))
+        for backend in self.pool.backends:
+            self.assertEqual(backend.outstanding, 0)
+    
+    async def test_failed_server_is_bypassed_and_returns(self):
+        await self.warm.stop()
+        before = self.served()
+        texts = await asyncio.gather(*(self.stream_text(key) for key in range(20)), return_exceptions=True)
+        errors = [text for text in texts if isinstance(text, Exception)]
+        self.assertEqual(errors, [])
+        self.assertEqual(self.served() - before, Counter(cold=20))
+        
+        await self.pool.probe_all()
+        self.assertFalse(self.pool.backends[0].healthy)
+        
+        # Поднятый снова сервер возвращается в пул после проверки
+        self.warm.loaded = {MODEL}
+        await self.warm.start()
+        await self.pool.probe_all()
+        delta = await self.stream_many(CONCURRENCY)
+        self.assertTrue(self.pool.backends[0].healthy)
+        self.assertGreater(delta["warm"], 0, dict(delta))
+    
+    async def test_non_streaming_generation(self):
+        text = await self.provider.generate(request(0))
+        self.assertTrue(text.endswith("ответила"), text)
+
+
+if __name__ == "__main__":
+    unittest.main()